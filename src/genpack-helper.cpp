@@ -2,7 +2,16 @@
 #include <sys/stat.h>
 #include <sys/wait.h>
 
+#include <sys/syscall.h>
+#include <sys/ioctl.h>
+#include <sys/xattr.h>
+#include <linux/fs.h>
+#include <linux/openat2.h>
+
 #include <unistd.h>
+#include <signal.h>
+#include <fcntl.h>
+#include <dirent.h>
 #include <pwd.h>
 #include <grp.h>
 
@@ -10,6 +19,12 @@
 #include <fstream>
 #include <cstring>
 #include <functional>
+#include <unordered_set>
+#include <unordered_map>
+#include <thread>
+#include <atomic>
+#include <mutex>
+#include <chrono>
 
 #include <libmount/libmount.h>
 
@@ -129,6 +144,7 @@ void mount_loop(const std::filesystem::path& source,
     mnt_context_set_target(ctx.get(), mountpoint.c_str());
     mnt_context_set_mflags(ctx.get(), MS_RELATIME);
     mnt_context_set_options(ctx.get(), "loop");
+    mnt_context_disable_canonicalize(ctx.get(), 1); // mountpoint may be /proc/self/fd/N which must not be turned back into a path
 
     auto rst = mnt_context_mount(ctx.get());
     auto status = mnt_context_get_status(ctx.get());
@@ -200,6 +216,8 @@ int fork_and_exec(const std::vector<std::string>& cmdline, const std::optional<s
     // else
     if (pid == 0) {
         // Child process
+        signal(SIGINT, SIG_DFL); // broker ignores them, ignored dispositions survive exec
+        signal(SIGTERM, SIG_DFL);
         if (chroot) {
             if (chdir(chroot->c_str()) != 0) {
                 perror("chdir");
@@ -325,6 +343,259 @@ int nspawn(const std::filesystem::path& lower_img,
     return fork_and_exec(nspawn_cmdline);
 }
 
+struct CopyStats {
+    std::atomic<size_t> files_copied = 0;
+    std::atomic<size_t> bytes_copied = 0;
+    std::atomic<size_t> cloned = 0;
+    std::atomic<size_t> errors = 0;
+    size_t files_skipped = 0;
+    size_t entries_removed = 0;
+    size_t hardlinks = 0;
+};
+
+template <typename... Args>
+void copy_error(CopyStats& stats, Args&&... args)
+{
+    static std::mutex mutex;
+    std::lock_guard<std::mutex> lock(mutex);
+    (std::cerr << ... << args) << ": " << strerror(errno) << std::endl;
+    stats.errors++;
+}
+
+struct linux_dirent64 {
+    ino64_t d_ino;
+    off64_t d_off;
+    unsigned short d_reclen;
+    unsigned char d_type;
+    char d_name[];
+};
+
+// Call func(name, d_type) for each entry of directory fd except . and .. using getdents64 directly
+template <typename Func>
+bool for_each_dirent(int fd, Func func)
+{
+    std::vector<char> buf(64 * 1024);
+    while (true) {
+        auto nread = syscall(SYS_getdents64, fd, buf.data(), buf.size());
+        if (nread < 0) return false;
+        if (nread == 0) return true;
+        for (long pos = 0; pos < nread;) {
+            auto d = reinterpret_cast<linux_dirent64*>(buf.data() + pos);
+            pos += d->d_reclen;
+            if (strcmp(d->d_name, ".") == 0 || strcmp(d->d_name, "..") == 0) continue;
+            func(std::string(d->d_name), d->d_type);
+        }
+    }
+}
+
+unsigned char dirent_type(int dirfd, const std::string& name, unsigned char d_type)
+{
+    if (d_type != DT_UNKNOWN) return d_type;
+    //else
+    struct stat st;
+    if (fstatat(dirfd, name.c_str(), &st, AT_SYMLINK_NOFOLLOW) != 0) return DT_UNKNOWN;
+    return IFTODT(st.st_mode);
+}
+
+// Open path relative to root_fd without following any symlink nor leaving root_fd.
+// Images are owned by the original user who can modify them while mounted, so no path inside them can be trusted to stay as it was checked.
+int openat_beneath(int root_fd, const std::string& path, int flags, mode_t mode = 0)
+{
+    struct open_how how = {};
+    how.flags = flags | O_CLOEXEC;
+    how.mode = (flags & O_CREAT)? mode : 0;
+    how.resolve = RESOLVE_BENEATH | RESOLVE_NO_SYMLINKS | RESOLVE_NO_MAGICLINKS;
+    return syscall(SYS_openat2, root_fd, path.c_str(), &how, sizeof(how));
+}
+
+// Parent directory of path opened by openat_beneath() and the last component of path.
+// *at() calls on (fd, name) with no-follow semantics then never touch anything outside of root_fd.
+struct ParentDir {
+    int fd;
+    std::string name;
+    ParentDir(int root_fd, const std::string& path) {
+        auto pos = path.rfind('/');
+        name = pos == std::string::npos? path : path.substr(pos + 1);
+        fd = openat_beneath(root_fd, pos == std::string::npos? "." : path.substr(0, pos), O_PATH | O_DIRECTORY);
+    }
+    ~ParentDir() { if (fd >= 0) close(fd); }
+    ParentDir(const ParentDir&) = delete;
+    ParentDir& operator=(const ParentDir&) = delete;
+    explicit operator bool() const { return fd >= 0; }
+};
+
+std::string proc_fd_path(int fd)
+{
+    return "/proc/self/fd/" + std::to_string(fd);
+}
+
+bool remove_tree(int dirfd, const std::string& name, CopyStats& stats)
+{
+    int fd = openat(dirfd, name.c_str(), O_RDONLY | O_DIRECTORY | O_NOFOLLOW | O_CLOEXEC);
+    if (fd < 0) {
+        copy_error(stats, "Failed to open directory to remove: ", name);
+        return false;
+    }
+    for_each_dirent(fd, [&](const std::string& child, unsigned char d_type) {
+        if (dirent_type(fd, child, d_type) == DT_DIR) remove_tree(fd, child, stats);
+        else if (unlinkat(fd, child.c_str(), 0) != 0) copy_error(stats, "Failed to remove: ", name, "/", child);
+        else stats.entries_removed++;
+    });
+    close(fd);
+    if (unlinkat(dirfd, name.c_str(), AT_REMOVEDIR) != 0) {
+        copy_error(stats, "Failed to remove directory: ", name);
+        return false;
+    }
+    stats.entries_removed++;
+    return true;
+}
+
+// Remove entries under directory fd(relative path prefix) which are not in files_to_copy
+void remove_unlisted(int fd, const std::string& prefix, const std::unordered_set<std::string>& files_to_copy, CopyStats& stats)
+{
+    for_each_dirent(fd, [&](const std::string& name, unsigned char d_type) {
+        auto path = prefix.empty()? name : prefix + "/" + name;
+        auto type = dirent_type(fd, name, d_type);
+        if (files_to_copy.find(path) == files_to_copy.end()) {
+            if (type == DT_DIR) {
+                remove_tree(fd, name, stats);
+            } else if (unlinkat(fd, name.c_str(), 0) != 0) {
+                copy_error(stats, "Failed to remove: ", path);
+            } else {
+                if (debug) std::cout << "Removed: " << path << std::endl;
+                stats.entries_removed++;
+            }
+        } else if (type == DT_DIR) {
+            int child_fd = openat(fd, name.c_str(), O_RDONLY | O_DIRECTORY | O_NOFOLLOW | O_CLOEXEC);
+            if (child_fd < 0) {
+                copy_error(stats, "Failed to open directory: ", path);
+                return;
+            }
+            remove_unlisted(child_fd, path, files_to_copy, stats);
+            close(child_fd);
+        }
+    });
+}
+
+// src_fd and dst_fd may be O_PATH descriptors of any non-symlink file, so xattrs are accessed through their magic links in /proc
+void copy_xattrs(int src_fd, int dst_fd, const std::string& path, CopyStats& stats)
+{
+    auto src = proc_fd_path(src_fd), dst = proc_fd_path(dst_fd);
+    auto size = listxattr(src.c_str(), nullptr, 0);
+    if (size <= 0) return;
+    std::vector<char> names(size);
+    size = listxattr(src.c_str(), names.data(), names.size());
+    if (size < 0) return;
+    std::vector<char> value;
+    for (const char* name = names.data(); name < names.data() + size; name += strlen(name) + 1) {
+        auto value_size = getxattr(src.c_str(), name, nullptr, 0);
+        if (value_size < 0) continue;
+        value.resize(value_size);
+        value_size = getxattr(src.c_str(), name, value.data(), value.size());
+        if (value_size < 0) continue;
+        if (setxattr(dst.c_str(), name, value.data(), value_size, 0) != 0) {
+            copy_error(stats, "Failed to set xattr ", name, " on ", path);
+        }
+    }
+}
+
+bool copy_file_contents(int src_fd, int dst_fd, off_t size, CopyStats& stats)
+{
+    // reflink when both ends are on the same filesystem supporting it
+    if (ioctl(dst_fd, FICLONE, src_fd) == 0) {
+        stats.cloned++;
+        return true;
+    }
+    //else
+    off_t copied = 0;
+    bool use_copy_file_range = true;
+    std::vector<char> buf;
+    while (copied < size) {
+        ssize_t n;
+        if (use_copy_file_range) {
+            n = copy_file_range(src_fd, nullptr, dst_fd, nullptr, size - copied, 0);
+            if (n < 0 && (errno == EXDEV || errno == EINVAL || errno == ENOSYS || errno == EOPNOTSUPP)) {
+                use_copy_file_range = false; // fall back to read/write
+                continue;
+            }
+        } else {
+            if (buf.empty()) buf.resize(1024 * 1024);
+            n = read(src_fd, buf.data(), buf.size());
+            if (n > 0) {
+                for (ssize_t written = 0; written < n;) {
+                    auto w = write(dst_fd, buf.data() + written, n - written);
+                    if (w < 0) return false;
+                    written += w;
+                }
+            }
+        }
+        if (n < 0) return false;
+        if (n == 0) break; // file shrank while copying
+        copied += n;
+    }
+    stats.bytes_copied += copied;
+    return true;
+}
+
+void copy_regular_file(int src_root_fd, int dst_root_fd, const std::string& path, const struct stat& st, CopyStats& stats)
+{
+    int src_fd = openat_beneath(src_root_fd, path, O_RDONLY | O_NOFOLLOW);
+    if (src_fd < 0) {
+        copy_error(stats, "Failed to open source file: ", path);
+        return;
+    }
+    ParentDir dst(dst_root_fd, path);
+    int dst_fd = -1;
+    if (dst) {
+        unlinkat(dst.fd, dst.name.c_str(), 0); // never write into existing file, it may be hardlinked
+        dst_fd = openat(dst.fd, dst.name.c_str(), O_WRONLY | O_CREAT | O_EXCL | O_NOFOLLOW | O_CLOEXEC, 0600);
+    }
+    if (dst_fd < 0) {
+        copy_error(stats, "Failed to create destination file: ", path);
+        close(src_fd);
+        return;
+    }
+    if (!copy_file_contents(src_fd, dst_fd, st.st_size, stats)) {
+        copy_error(stats, "Failed to copy: ", path);
+    } else {
+        copy_xattrs(src_fd, dst_fd, path, stats);
+        // chown first because it clears setuid/setgid bits
+        if (fchown(dst_fd, st.st_uid, st.st_gid) != 0) copy_error(stats, "Failed to chown: ", path);
+        if (fchmod(dst_fd, st.st_mode & 07777) != 0) copy_error(stats, "Failed to chmod: ", path);
+        struct timespec times[2] = {st.st_atim, st.st_mtim};
+        if (futimens(dst_fd, times) != 0) copy_error(stats, "Failed to set times: ", path);
+        stats.files_copied++;
+        if (debug) std::cout << "Copied: " << path << std::endl;
+    }
+    close(dst_fd);
+    close(src_fd);
+}
+
+void copy_metadata(int src_root_fd, int dst_root_fd, const std::string& path, const struct stat& st, CopyStats& stats)
+{
+    ParentDir dst(dst_root_fd, path);
+    if (!dst) {
+        copy_error(stats, "Failed to open parent directory: ", path);
+        return;
+    }
+    if (!S_ISLNK(st.st_mode)) {
+        // O_PATH so that special files are not actually opened. chmod through its magic link can't be redirected by a symlink swapped in.
+        int src_fd = openat_beneath(src_root_fd, path, O_PATH | O_NOFOLLOW);
+        int dst_fd = openat(dst.fd, dst.name.c_str(), O_PATH | O_NOFOLLOW | O_CLOEXEC);
+        if (dst_fd < 0) copy_error(stats, "Failed to open: ", path);
+        else if (src_fd >= 0) copy_xattrs(src_fd, dst_fd, path, stats);
+        // chown first because it clears setuid/setgid bits
+        if (dst_fd >= 0 && fchownat(dst_fd, "", st.st_uid, st.st_gid, AT_EMPTY_PATH) != 0) copy_error(stats, "Failed to chown: ", path);
+        if (dst_fd >= 0 && chmod(proc_fd_path(dst_fd).c_str(), st.st_mode & 07777) != 0) copy_error(stats, "Failed to chmod: ", path);
+        if (dst_fd >= 0) close(dst_fd);
+        if (src_fd >= 0) close(src_fd);
+    } else if (fchownat(dst.fd, dst.name.c_str(), st.st_uid, st.st_gid, AT_SYMLINK_NOFOLLOW) != 0) {
+        copy_error(stats, "Failed to chown: ", path);
+    }
+    struct timespec times[2] = {st.st_atim, st.st_mtim};
+    if (utimensat(dst.fd, dst.name.c_str(), times, AT_SYMLINK_NOFOLLOW) != 0) copy_error(stats, "Failed to set times: ", path);
+}
+
 int copy(const std::filesystem::path& src_img, const std::filesystem::path& dst_img, const std::filesystem::path& dst_dir = "")
 {
     must_be_owned_by_original_user(src_img);
@@ -335,82 +606,568 @@ int copy(const std::filesystem::path& src_img, const std::filesystem::path& dst_
     mount_loop(dst_img, dst_temp_dir.path(), "ext4");
 
     //  - Read file list from stdin
-    //  - remove all files and links in dst except listed
-    //  - remove all empty directories in dst except listed
-    // create temporary file to hold the list of files to copy
-    char temp_file_template[] = "/tmp/genpack-helper.XXXXXX";
-    auto fd = mkstemp(temp_file_template);
-    if (fd < 0) {
-        throw std::runtime_error("Failed to create temporary file for file list");
-    }
-
+    //  - remove all entries in dst except listed (and their ancestors)
+    //  - copy listed entries which differ in size or mtime, like rsync's quick check
+    auto start_time = std::chrono::steady_clock::now();
     std::string line;
-    std::set<std::filesystem::path> files_to_copy;
+    std::vector<std::string> paths;
+    std::unordered_set<std::string> files_to_copy;
     while (std::getline(std::cin, line)) {
         if (line.empty() || line[0] == '#') continue; // Skip empty lines and comments
-        std::string file_str_with_eol = line + "\n";
-        if (debug) std::cout << "Processing file: " << line << std::endl;
-        if (write(fd, file_str_with_eol.c_str(), file_str_with_eol.length()) < 0) {
-            close(fd);
-            throw std::runtime_error("Failed to write to temporary file for file list");
+        while (!line.empty() && line.front() == '/') line.erase(0, 1);
+        while (!line.empty() && line.back() == '/') line.pop_back();
+        if (line.empty()) continue;
+        //else
+        if (("/" + line + "/").find("/../") != std::string::npos || ("/" + line + "/").find("/./") != std::string::npos) {
+            std::cerr << "Invalid path in file list: " << line << std::endl;
+            continue; // Skip invalid paths
+        }
+        //else
+        // register the path and all its ancestors
+        for (auto pos = line.find('/'); ; pos = line.find('/', pos + 1)) {
+            auto ancestor = line.substr(0, pos);
+            if (files_to_copy.insert(ancestor).second) paths.push_back(ancestor);
+            if (pos == std::string::npos) break;
         }
+    }
+    // parents must be processed before children
+    std::sort(paths.begin(), paths.end());
 
-        auto path = std::filesystem::path(line);
-        std::filesystem::path current;
-        for (const auto& part : path) {
-            current /= part;
-            if (part == ".." || part == ".") {
-                std::cerr << "Invalid path in file list: " << path.string() << std::endl;
-                continue; // Skip invalid paths
+    int src_root_fd = open(src_temp_dir.path().c_str(), O_RDONLY | O_DIRECTORY | O_CLOEXEC);
+    int dst_root_fd = open(dst_temp_dir.path().c_str(), O_RDONLY | O_DIRECTORY | O_CLOEXEC);
+    if (src_root_fd < 0 || dst_root_fd < 0) {
+        throw std::runtime_error("Failed to open source or destination directory");
+    }
+    // Ensure the destination directory exists, creating it component by component inside the destination image
+    for (const auto& component : dst_dir.relative_path()) {
+        if (component.empty()) continue;
+        mkdirat(dst_root_fd, component.c_str(), 0755);
+        int fd = openat_beneath(dst_root_fd, component, O_RDONLY | O_DIRECTORY);
+        close(dst_root_fd);
+        dst_root_fd = fd;
+        if (dst_root_fd < 0) throw std::runtime_error("Failed to open destination directory " + dst_dir.string());
+    }
+
+    CopyStats stats;
+    remove_unlisted(dst_root_fd, "", files_to_copy, stats);
+
+    // create directories, symlinks and special files in order. regular files are copied in parallel later.
+    // destination entries of different type are replaced before descending, so that no symlink is followed in destination.
+    std::vector<std::pair<std::string, struct stat>> files_to_copy_contents;
+    std::vector<std::pair<std::string, std::string>> hardlinks_to_create; // (path, first path of the same inode)
+    std::vector<std::pair<std::string, struct stat>> entries_to_fix_metadata;
+    std::unordered_map<ino_t, std::string> first_paths_of_inode; // src is a single filesystem, inode number is enough
+    for (const auto& path : paths) {
+        // every access goes through parent directories opened beneath the roots, never through path as a whole
+        ParentDir src(src_root_fd, path), dst(dst_root_fd, path);
+        struct stat st, dst_st;
+        if (!src || fstatat(src.fd, src.name.c_str(), &st, AT_SYMLINK_NOFOLLOW) != 0) {
+            // the symlink itself is copied as listed, entries through it are not
+            if (errno == ELOOP) std::cerr << "Skipping path under symlink: " << path << std::endl;
+            else if (errno != ENOENT) copy_error(stats, "Failed to stat source: ", path);
+            continue;
+        }
+        if (!dst) {
+            copy_error(stats, "Failed to open destination parent directory: ", path);
+            continue;
+        }
+        bool dst_exists = fstatat(dst.fd, dst.name.c_str(), &dst_st, AT_SYMLINK_NOFOLLOW) == 0;
+        if (dst_exists && (dst_st.st_mode & S_IFMT) != (st.st_mode & S_IFMT)) {
+            if (S_ISDIR(dst_st.st_mode)) remove_tree(dst.fd, dst.name, stats);
+            else unlinkat(dst.fd, dst.name.c_str(), 0);
+            dst_exists = false;
+        }
+
+        if (S_ISREG(st.st_mode) && st.st_nlink > 1) {
+            auto [first, inserted] = first_paths_of_inode.emplace(st.st_ino, path);
+            if (!inserted) {
+                hardlinks_to_create.emplace_back(path, first->second);
+                continue;
+            }
+        }
+
+        if (S_ISDIR(st.st_mode)) {
+            if (!dst_exists && mkdirat(dst.fd, dst.name.c_str(), 0700) != 0) {
+                copy_error(stats, "Failed to create directory: ", path);
+                continue;
+            }
+            entries_to_fix_metadata.emplace_back(path, st);
+        } else if (S_ISREG(st.st_mode)) {
+            if (dst_exists && dst_st.st_size == st.st_size && dst_st.st_mtim.tv_sec == st.st_mtim.tv_sec && dst_st.st_mtim.tv_nsec == st.st_mtim.tv_nsec) {
+                stats.files_skipped++;
+                if (dst_st.st_uid != st.st_uid || dst_st.st_gid != st.st_gid || dst_st.st_mode != st.st_mode) {
+                    entries_to_fix_metadata.emplace_back(path, st);
+                }
+            } else {
+                files_to_copy_contents.emplace_back(path, st);
+            }
+        } else if (S_ISLNK(st.st_mode)) {
+            std::vector<char> target(st.st_size + 1), dst_target(st.st_size + 1);
+            auto len = readlinkat(src.fd, src.name.c_str(), target.data(), target.size());
+            if (len < 0) {
+                copy_error(stats, "Failed to read symlink: ", path);
+                continue;
+            }
+            target.resize(len);
+            target.push_back('\0');
+            if (dst_exists) {
+                auto dst_len = readlinkat(dst.fd, dst.name.c_str(), dst_target.data(), dst_target.size());
+                if (dst_len == len && memcmp(target.data(), dst_target.data(), len) == 0) {
+                    stats.files_skipped++;
+                    continue;
+                }
+                unlinkat(dst.fd, dst.name.c_str(), 0);
+            }
+            if (symlinkat(target.data(), dst.fd, dst.name.c_str()) != 0) {
+                copy_error(stats, "Failed to create symlink: ", path);
+                continue;
+            }
+            entries_to_fix_metadata.emplace_back(path, st);
+        } else {
+            if (dst_exists && dst_st.st_rdev == st.st_rdev) {
+                stats.files_skipped++;
+                continue;
+            }
+            if (dst_exists) unlinkat(dst.fd, dst.name.c_str(), 0);
+            if (mknodat(dst.fd, dst.name.c_str(), st.st_mode, st.st_rdev) != 0) {
+                copy_error(stats, "Failed to create special file: ", path);
+                continue;
             }
+            entries_to_fix_metadata.emplace_back(path, st);
+        }
+    }
+
+    // copy contents of regular files in parallel
+    std::atomic<size_t> next_job = 0;
+    auto num_threads = std::max(1u, std::min(std::thread::hardware_concurrency(), (unsigned)files_to_copy_contents.size()));
+    std::vector<std::thread> threads;
+    for (unsigned i = 0; i < num_threads; i++) {
+        threads.emplace_back([&]() {
+            for (size_t job = next_job++; job < files_to_copy_contents.size(); job = next_job++) {
+                const auto& [path, st] = files_to_copy_contents[job];
+                copy_regular_file(src_root_fd, dst_root_fd, path, st, stats);
+            }
+        });
+    }
+    for (auto& thread : threads) thread.join();
+
+    for (const auto& [path, first_path] : hardlinks_to_create) {
+        ParentDir dst(dst_root_fd, path), first(dst_root_fd, first_path);
+        if (!dst || !first) {
+            copy_error(stats, "Failed to open parent directory: ", path, " -> ", first_path);
+            continue;
+        }
+        struct stat st, first_st;
+        if (fstatat(dst.fd, dst.name.c_str(), &st, AT_SYMLINK_NOFOLLOW) == 0 && fstatat(first.fd, first.name.c_str(), &first_st, AT_SYMLINK_NOFOLLOW) == 0
+            && st.st_ino == first_st.st_ino) continue; // already linked
+        //else
+        unlinkat(dst.fd, dst.name.c_str(), 0);
+        if (linkat(first.fd, first.name.c_str(), dst.fd, dst.name.c_str(), 0) != 0) {
+            copy_error(stats, "Failed to create hardlink: ", path, " -> ", first_path);
+        } else {
+            stats.hardlinks++;
+        }
+    }
+
+    // in reverse order so that directory times are set after their contents have been modified
+    for (auto it = entries_to_fix_metadata.rbegin(); it != entries_to_fix_metadata.rend(); ++it) {
+        copy_metadata(src_root_fd, dst_root_fd, it->first, it->second, stats);
+    }
+    close(dst_root_fd);
+    close(src_root_fd);
+
+    auto elapsed = std::chrono::duration<double>(std::chrono::steady_clock::now() - start_time).count();
+    std::cout << "Copied " << stats.files_copied << " files (" << stats.cloned << " reflinked), "
+        << stats.bytes_copied / 1024 / 1024 << " MiB in " << elapsed << " seconds ("
+        << (elapsed > 0? stats.bytes_copied / 1024.0 / 1024.0 / elapsed : 0) << " MiB/s) using " << num_threads << " threads. "
+        << stats.files_skipped << " unchanged, " << stats.hardlinks << " hardlinks, " << stats.entries_removed << " removed";
+    if (stats.errors > 0) std::cout << ", " << stats.errors << " errors";
+    std::cout << "." << std::endl;
+    return stats.errors > 0? 1 : 0;
+}
+
+// Broker mode: serve privileged requests from genpack over stdin/stdout so that a build needs only one privileged process.
+// Each frame is a native-endian uint32 length followed by NUL-separated fields.
+// Request: <op> <args...>, response: "ok" [result] or "error" <message>.
+// Paths are only accepted inside images mounted by the broker itself, and every mount is undone on EOF.
+void write_sysfs(const std::filesystem::path& path, const std::string& value)
+{
+    std::ofstream f(path);
+    f << value;
+    f.close();
+    if (!f) throw std::runtime_error("Failed to write " + value + " to " + path.string());
+}
+
+// Filesystem mounted by broker, held by file descriptors so that its path is never resolved again.
+// Directories on the path are writable by the original user, who could otherwise replace them with symlinks at any time.
+struct Mount {
+    std::filesystem::path path; // as resolved when mounted, to find the mount by path given by client
+    int parent_fd; // O_PATH of the directory containing mount point
+    std::string name;
+    int root_fd; // O_PATH of the root directory of mounted filesystem
+    std::string target() const { return proc_fd_path(parent_fd) + "/" + name; } // mount point is busy and can't be renamed while mounted
+};
+
+// Empty directory owned by the original user to mount on, pinned from the checks until mount(2) through target().
+// Each directory up to it is opened without following symlinks and must be owned by root or the original user,
+// and may not be writable by others unless sticky like /tmp.
+class MountPoint {
+public:
+    MountPoint(const std::filesystem::path& path) : path_(std::filesystem::canonical(path)) {
+        auto original_uid = getuid();
+        auto check = [&](int fd, const std::filesystem::path& dir) {
+            struct stat st;
+            if (fstat(fd, &st) != 0) throw std::runtime_error("Failed to stat " + dir.string() + ": " + strerror(errno));
+            if (original_uid == 0) return;
             //else
-            files_to_copy.insert(current);
+            if (st.st_uid != 0 && st.st_uid != original_uid) throw std::runtime_error("Directory is not owned by root or the original user: " + dir.string());
+            if ((st.st_mode & S_IWOTH) && !(st.st_mode & S_ISVTX)) throw std::runtime_error("Directory is writable by others: " + dir.string());
+        };
+        parent_fd_ = open("/", O_PATH | O_DIRECTORY | O_CLOEXEC);
+        std::filesystem::path dir = "/";
+        for (const auto& component : path_.parent_path().relative_path()) {
+            check(parent_fd_, dir);
+            dir /= component;
+            int fd = openat(parent_fd_, component.c_str(), O_PATH | O_DIRECTORY | O_NOFOLLOW | O_CLOEXEC);
+            close(parent_fd_);
+            parent_fd_ = fd;
+            if (parent_fd_ < 0) throw std::runtime_error("Failed to open " + dir.string() + ": " + strerror(errno));
         }
+        check(parent_fd_, dir);
+        name_ = path_.filename();
+        fd_ = openat(parent_fd_, name_.c_str(), O_RDONLY | O_DIRECTORY | O_NOFOLLOW | O_CLOEXEC);
+        if (fd_ < 0) throw std::runtime_error("Mount point must be an empty directory: " + path_.string());
+        //else
+        must_be_owned_by_original_user(target());
+        bool empty = true;
+        for_each_dirent(fd_, [&](const std::string&, unsigned char) { empty = false; });
+        if (!empty) throw std::runtime_error("Mount point must be an empty directory: " + path_.string());
     }
-    close(fd);
+    ~MountPoint() {
+        if (fd_ >= 0) close(fd_);
+        if (parent_fd_ >= 0) close(parent_fd_);
+    }
+    MountPoint(const MountPoint&) = delete;
+    MountPoint& operator=(const MountPoint&) = delete;
+
+    const std::filesystem::path& path() const { return path_; }
+    std::string target() const { return proc_fd_path(fd_); }
 
-    std::set<std::filesystem::path> files_to_remove;
-    std::set<std::filesystem::path> dirs_to_remove;
-    auto dst_actual_dir = dst_temp_dir.path() / dst_dir;
-    std::filesystem::create_directories(dst_actual_dir); // Ensure the destination directory exists
-    for (const auto& entry : std::filesystem::recursive_directory_iterator(dst_actual_dir)) {
-        if (files_to_copy.find(std::filesystem::relative(entry.path(), dst_actual_dir)) == files_to_copy.end()) {
-            if (entry.is_regular_file() || entry.is_symlink()) {
-                files_to_remove.insert(entry.path());
-            } else if (entry.is_directory()) {
-                dirs_to_remove.insert(entry.path());
+    // Take the filesystem mounted on target(). Caller must unmount Mount::target() on failure
+    Mount attach() {
+        Mount mount{path_, parent_fd_, name_, openat(parent_fd_, name_.c_str(), O_PATH | O_DIRECTORY | O_NOFOLLOW | O_CLOEXEC)};
+        struct stat st, parent_st;
+        if (mount.root_fd < 0 || fstat(mount.root_fd, &st) != 0 || fstat(parent_fd_, &parent_st) != 0 || st.st_dev == parent_st.st_dev) {
+            // the directory was moved away from its name before mounted on
+            if (mount.root_fd >= 0) close(mount.root_fd);
+            throw std::runtime_error("Mount point was replaced while mounting: " + path_.string());
+        }
+        parent_fd_ = -1;
+        return mount;
+    }
+private:
+    std::filesystem::path path_;
+    int parent_fd_ = -1, fd_ = -1;
+    std::string name_;
+};
+
+class Broker {
+public:
+    ~Broker() {
+        for (auto it = mounts_.rbegin(); it != mounts_.rend(); ++it) {
+            RealRootSection root_section;
+            if (!unmount(*it)) {
+                std::cerr << "Warning: Failed to unmount " << it->path << " (" << strerror(errno) << ")" << std::endl;
             }
         }
     }
 
-    for (const auto& file : files_to_remove) {
-        if (std::filesystem::remove(file)) {
-            if (debug) std::cout << "Removed file: " << file << std::endl;
-        } else {
-            std::cerr << "Failed to remove file: " << file << std::endl;
+    std::string handle(const std::vector<std::string>& fields) {
+        const auto& op = fields.at(0);
+        if (op == "ping") return "";
+        //else
+        if (op == "mount") { // mount <image> <mount_point>
+            MountPoint mount_point(fields.at(2));
+            mount_loop(fields.at(1), mount_point.target());
+            RealRootSection root_section;
+            attach(mount_point);
+            return mount_point.path().string();
+        }
+        //else
+        if (op == "mount-tmpfs") { // mount-tmpfs <mount_point> <size in bytes>
+            MountPoint mount_point(fields.at(1));
+            auto options = "size=" + std::to_string(std::stoull(fields.at(2))) + ",mode=0755";
+            RealRootSection root_section;
+            if (mount("tmpfs", mount_point.target().c_str(), "tmpfs", MS_RELATIME, options.c_str()) != 0) {
+                throw std::runtime_error("Failed to mount tmpfs: " + std::string(strerror(errno)));
+            }
+            attach(mount_point);
+            return mount_point.path().string();
+        }
+        //else
+        if (op == "mount-zram") { // mount-zram <mount_point> <size in bytes> [<mem_limit in bytes>], ext4 on a new compressed RAM disk
+            MountPoint mount_point(fields.at(1));
+            auto size = std::to_string(std::stoull(fields.at(2)));
+            auto mem_limit = fields.size() > 3? std::optional<std::string>(std::to_string(std::stoull(fields.at(3)))) : std::nullopt;
+            RealRootSection root_section;
+            std::string id;
+            std::ifstream("/sys/class/zram-control/hot_add") >> id;
+            if (id.empty()) throw std::runtime_error("Failed to add zram device (is zram module loaded?)");
+            //else
+            auto device = "/dev/zram" + id;
+            try {
+                try { write_sysfs("/sys/block/zram" + id + "/comp_algorithm", "zstd"); }
+                catch (const std::runtime_error&) {} // keep kernel's default algorithm
+                write_sysfs("/sys/block/zram" + id + "/disksize", size);
+                // RAM used by compressed data. writes beyond it fail with I/O error, which remounts read-only
+                if (mem_limit) write_sysfs("/sys/block/zram" + id + "/mem_limit", *mem_limit);
+                if (fork_and_exec({"mkfs.ext4", "-q", device}) != 0) throw std::runtime_error("mkfs.ext4 failed on " + device);
+                //else
+                if (mount(device.c_str(), mount_point.target().c_str(), "ext4", MS_RELATIME, "errors=remount-ro") != 0) {
+                    throw std::runtime_error("Failed to mount " + device + ": " + strerror(errno));
+                }
+                attach(mount_point);
+            }
+            catch (...) {
+                write_sysfs("/sys/class/zram-control/hot_remove", id);
+                throw;
+            }
+            zram_devices_[mount_point.path()] = id;
+            return device;
+        }
+        //else
+        if (op == "umount") { // umount <mount_point>
+            auto it = find_mount(fields.at(1));
+            RealRootSection root_section;
+            if (!unmount(*it)) throw std::runtime_error("umount failed: " + std::string(strerror(errno)));
+            mounts_.erase(it);
+            return "";
+        }
+        //else
+        if (op == "mkdir") { // mkdir <path> (like mkdir -p)
+            auto [root_fd, relative] = confine(fields.at(1), true);
+            int fd = fcntl(root_fd, F_DUPFD_CLOEXEC, 0);
+            for (const auto& component : std::filesystem::path(relative)) {
+                if (component.empty() || component == ".") continue;
+                //else
+                mkdirat(fd, component.c_str(), 0755); // may exist already, opening it tells whether it is a directory
+                int child_fd = openat_beneath(fd, component, O_PATH | O_DIRECTORY);
+                close(fd);
+                fd = child_fd;
+                if (fd < 0) throw std::runtime_error("Failed to create directory " + fields.at(1) + ": " + strerror(errno));
+            }
+            close(fd);
+            return "";
         }
+        //else
+        if (op == "write") { // write <path> <data>
+            auto [root_fd, relative] = confine(fields.at(1));
+            ParentDir parent(root_fd, relative);
+            int fd = parent? openat(parent.fd, parent.name.c_str(), O_WRONLY | O_CREAT | O_TRUNC | O_NOFOLLOW | O_CLOEXEC, 0644) : -1;
+            if (fd < 0) throw std::runtime_error("Failed to open " + fields.at(1) + ": " + strerror(errno));
+            const auto& data = fields.at(2);
+            for (size_t written = 0; written < data.size();) {
+                auto n = write(fd, data.data() + written, data.size() - written);
+                if (n < 0) {
+                    close(fd);
+                    throw std::runtime_error("Failed to write " + fields.at(1) + ": " + strerror(errno));
+                }
+                written += n;
+            }
+            close(fd);
+            return "";
+        }
+        //else
+        if (op == "remove") { // remove <path> (like rm -rf)
+            auto [root_fd, relative] = confine(fields.at(1));
+            ParentDir parent(root_fd, relative);
+            struct stat st;
+            if (!parent || fstatat(parent.fd, parent.name.c_str(), &st, AT_SYMLINK_NOFOLLOW) != 0) {
+                if (errno == ENOENT) return "";
+                //else
+                throw std::runtime_error("Failed to stat " + fields.at(1) + ": " + strerror(errno));
+            }
+            CopyStats stats;
+            if (S_ISDIR(st.st_mode)) remove_tree(parent.fd, parent.name, stats);
+            else if (unlinkat(parent.fd, parent.name.c_str(), 0) != 0) copy_error(stats, "Failed to remove: ", fields.at(1));
+            if (stats.errors > 0) throw std::runtime_error("Failed to remove " + fields.at(1));
+            return "";
+        }
+        //else
+        if (op == "rename") { // rename <src> <dst>
+            auto [src_root_fd, src_relative] = confine(fields.at(1));
+            auto [dst_root_fd, dst_relative] = confine(fields.at(2));
+            ParentDir src(src_root_fd, src_relative), dst(dst_root_fd, dst_relative);
+            if (!src || !dst || renameat(src.fd, src.name.c_str(), dst.fd, dst.name.c_str()) != 0) {
+                throw std::runtime_error("Failed to rename " + fields.at(1) + " to " + fields.at(2) + ": " + strerror(errno));
+            }
+            return "";
+        }
+        //else
+        if (op == "chroot") { // chroot <mount_point> <command> [args...]
+            auto mount_point = proc_fd_path(find_mount(fields.at(1))->root_fd);
+            std::vector<std::string> cmdline(fields.begin() + 2, fields.end());
+            if (cmdline.empty()) throw std::runtime_error("No command given");
+            //else
+            // stdout is the protocol channel, command output goes to stderr
+            int saved_stdout = dup(STDOUT_FILENO);
+            dup2(STDERR_FILENO, STDOUT_FILENO);
+            int status;
+            {
+                RealRootSection root_section;
+                status = fork_and_exec(cmdline, mount_point);
+            }
+            dup2(saved_stdout, STDOUT_FILENO);
+            close(saved_stdout);
+            return std::to_string(status);
+        }
+        //else
+        throw std::runtime_error("Unknown broker operation: " + op);
     }
 
-    std::vector<std::filesystem::path> dirs_to_remove_sorted(dirs_to_remove.begin(), dirs_to_remove.end());
-    std::sort(dirs_to_remove_sorted.begin(), dirs_to_remove_sorted.end(), [](const std::filesystem::path& a, const std::filesystem::path& b) {
-        return a.string().length() > b.string().length();
-    });
+private:
+    // Register filesystem just mounted on mount_point. Caller must be in RealRootSection
+    void attach(MountPoint& mount_point) {
+        try {
+            mounts_.push_back(mount_point.attach());
+        }
+        catch (...) {
+            // what is at the path now is unknown, unmount through the directory pinned by mount_point instead
+            umount2(mount_point.target().c_str(), MNT_DETACH);
+            throw;
+        }
+    }
 
-    for (const auto& dir : dirs_to_remove_sorted) {
-        if (std::filesystem::is_empty(dir)) {
-            if (std::filesystem::remove(dir)) {
-                if (debug) std::cout << "Removed empty directory: " << dir << std::endl;
-            } else {
-                std::cerr << "Failed to remove directory: " << dir << std::endl;
+    std::vector<Mount>::iterator find_mount(const std::filesystem::path& path) {
+        auto mount_point = std::filesystem::canonical(path);
+        auto it = std::find_if(mounts_.begin(), mounts_.end(), [&](const Mount& mount) { return mount.path == mount_point; });
+        if (it == mounts_.end()) throw std::runtime_error("Not mounted by broker: " + mount_point.string());
+        return it;
+    }
+
+    // Unmount and release everything held for mount. Caller must be in RealRootSection
+    bool unmount(Mount& mount) {
+        close(mount.root_fd); // it keeps the filesystem busy
+        mount.root_fd = -1;
+        if (umount(mount.target().c_str()) != 0) {
+            mount.root_fd = openat(mount.parent_fd, mount.name.c_str(), O_PATH | O_DIRECTORY | O_NOFOLLOW | O_CLOEXEC);
+            return false;
+        }
+        //else
+        close(mount.parent_fd);
+        release_zram(mount.path);
+        return true;
+    }
+
+    // Free zram device which was mounted at mount_point, if any. Caller must be in RealRootSection
+    void release_zram(const std::filesystem::path& mount_point) {
+        auto it = zram_devices_.find(mount_point);
+        if (it == zram_devices_.end()) return;
+        //else
+        try {
+            write_sysfs("/sys/block/zram" + it->second + "/reset", "1");
+            write_sysfs("/sys/class/zram-control/hot_remove", it->second);
+        }
+        catch (const std::runtime_error& e) {
+            std::cerr << "Warning: " << e.what() << std::endl;
+        }
+        zram_devices_.erase(it);
+    }
+
+    // Split path into root directory of the broker's mount it leads into and the rest relative to it.
+    // Only the part up to the mount point is resolved here. The rest is inside the image where the original user can swap in symlinks at any time,
+    // so it must be resolved beneath root_fd by the operation itself (openat_beneath(), ParentDir).
+    std::pair<int, std::string> confine(const std::filesystem::path& path, bool allow_mount_point = false) {
+        auto absolute = std::filesystem::absolute(path);
+        std::filesystem::path prefix;
+        for (auto it = absolute.begin(); it != absolute.end(); ++it) {
+            prefix /= *it;
+            std::error_code ec;
+            auto resolved = std::filesystem::canonical(prefix, ec);
+            if (ec) break;
+            //else
+            auto mount = std::find_if(mounts_.begin(), mounts_.end(), [&](const Mount& mount) { return mount.path == resolved; });
+            if (mount == mounts_.end()) continue;
+            //else
+            std::filesystem::path relative;
+            for (++it; it != absolute.end(); ++it) {
+                if (!it->empty()) relative /= *it;
             }
-        } else {
-            if (debug) std::cerr << "Directory not empty, skipping removal: " << dir << std::endl;
+            if (relative.empty() && !allow_mount_point) break;
+            return {mount->root_fd, relative.empty()? "." : relative.string()};
         }
+        throw std::runtime_error("Path is not inside images mounted by broker: " + path.string());
     }
 
-    auto rst = fork_and_exec({"rsync", debug? "-av" : "-a", "--files-from=" + std::string(temp_file_template), "--relative", src_temp_dir.path().string() + "/", (dst_temp_dir.path() / dst_dir).string()});
-    std::filesystem::remove(temp_file_template); // Clean up the temporary file
-    return rst;
+    std::vector<Mount> mounts_;
+    std::map<std::filesystem::path, std::string> zram_devices_;
+};
+
+bool read_fully(int fd, void* buf, size_t size)
+{
+    for (size_t done = 0; done < size;) {
+        auto n = read(fd, (char*)buf + done, size - done);
+        if (n < 0 && errno == EINTR) continue;
+        if (n <= 0) return false;
+        done += n;
+    }
+    return true;
+}
+
+bool write_frame(int fd, const std::vector<std::string>& fields)
+{
+    std::string frame;
+    for (size_t i = 0; i < fields.size(); i++) {
+        if (i > 0) frame.push_back('\0');
+        frame += fields[i];
+    }
+    uint32_t length = frame.size();
+    frame.insert(0, std::string((const char*)&length, sizeof(length)));
+    for (size_t done = 0; done < frame.size();) {
+        auto n = write(fd, frame.data() + done, frame.size() - done);
+        if (n < 0 && errno == EINTR) continue;
+        if (n <= 0) return false;
+        done += n;
+    }
+    return true;
+}
+
+int broker()
+{
+    must_be_owned_by_original_user(".");
+    // genpack may still need mounts while it handles Ctrl+C (e.g. to persist RAM upper), so the broker must not die with it.
+    // mounts are undone only when genpack closes the pipe.
+    signal(SIGINT, SIG_IGN);
+    signal(SIGTERM, SIG_IGN);
+    Broker broker;
+    while (true) {
+        uint32_t length;
+        if (!read_fully(STDIN_FILENO, &length, sizeof(length))) break; // EOF: genpack has finished
+        std::string frame(length, '\0');
+        if (!read_fully(STDIN_FILENO, frame.data(), length)) break;
+        std::vector<std::string> fields;
+        size_t pos = 0;
+        while (true) {
+            // data of write request is the last field and may contain NUL
+            auto next = (fields.size() == 2 && fields[0] == "write")? std::string::npos : frame.find('\0', pos);
+            if (next == std::string::npos) {
+                fields.push_back(frame.substr(pos));
+                break;
+            }
+            fields.push_back(frame.substr(pos, next - pos));
+            pos = next + 1;
+        }
+        if (debug) std::cerr << "Broker request: " << fields[0] << std::endl;
+        std::vector<std::string> response;
+        try {
+            response = {"ok", broker.handle(fields)};
+        }
+        catch (const std::exception& e) {
+            response = {"error", e.what()};
+        }
+        if (!write_frame(STDOUT_FILENO, response)) break;
+    }
+    return 0;
 }
 
 int main(int argc, const char* argv[])
@@ -432,6 +1189,7 @@ int main(int argc, const char* argv[])
     argparse::ArgumentParser lower("lower", "Execute a command in the lower image");
     argparse::ArgumentParser nspawn("nspawn", "Run a command in a lower image using systemd-nspawn");
     argparse::ArgumentParser copy("copy", "Copy files between two images according to filelist from stdin");
+    argparse::ArgumentParser broker("broker", "Serve privileged requests from genpack over stdin/stdout");
 
     std::map<std::string,std::tuple<argparse::ArgumentParser&,std::function<void(argparse::ArgumentParser&)>,std::function<int(const argparse::ArgumentParser&)>>> subcommands = {
         {"ping", {
@@ -566,6 +1324,15 @@ int main(int argc, const char* argv[])
                 return ::copy(src_img, dst_img, dst_dir);
             }
 
+        }},
+        {"broker", {
+            std::ref(broker),
+            [](argparse::ArgumentParser& argparser) {
+                // No arguments needed for broker command
+            },
+            [](const argparse::ArgumentParser& argparser) {
+                return ::broker();
+            }
         }}
     };
 
@@ -601,23 +1368,25 @@ int main(int argc, const char* argv[])
  
     if (subcommand_used == subcommands.end()) {
         std::cerr << "No subcommand specified. Use --help for usage information." << std::endl;
+        return 1;
     }
     //else
 
+    const auto& name = subcommand_used->first;
+    const auto& func = std::get<2>(subcommand_used->second);
+    const auto& parser = std::get<0>(subcommand_used->second);
+
     // Make mount namespace private. This is necessary to ensure that the mounts created by this program do not affect the host system.
-    if (unshare(CLONE_NEWNS) == -1) {
+    // Broker's mounts must be visible to genpack, so it stays in the host namespace and unmounts everything by itself instead.
+    if (name != "broker" && unshare(CLONE_NEWNS) == -1) {
         perror("unshare");
         return 1;
     }
-    if (mount("none", "/", NULL, MS_PRIVATE | MS_REC, NULL) == -1) {
+    if (name != "broker" && mount("none", "/", NULL, MS_PRIVATE | MS_REC, NULL) == -1) {
         perror("mount private");
         return 1;
     }
 
-    const auto& name = subcommand_used->first;
-    const auto& func = std::get<2>(subcommand_used->second);
-    const auto& parser = std::get<0>(subcommand_used->second);
-
     if (debug) {
         return func(parser);
     }
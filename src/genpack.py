@@ -1,14 +1,57 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-import os,logging,tempfile,subprocess,re,json,argparse,json,hashlib,time
+import os,sys,fcntl,logging,tempfile,subprocess,re,json,argparse,json,hashlib,time,inspect,shutil,threading,random,itertools,contextlib,atexit,struct,mmap,select,signal,concurrent.futures
 from datetime import datetime
 
-import json5 # dev-python/json5
-import requests # dev-python/requests
+# json5 (dev-python/json5) and requests (dev-python/requests) are imported where needed to keep startup fast
+
+startup_time = time.monotonic()
 
 DEFAULT_LOWER_SIZE_IN_GIB = 24  # Default max size of lower image in GiB
 DEFAULT_UPPER_SIZE_IN_GIB = 12  # Default max size of upper image in GiB
+DEFAULT_PACK_CACHE_KEEP = 3  # Default number of fingerprint-named outputs kept in pack cache
+DEFAULT_LOWER_SNAPSHOT_KEEP = 3  # Default number of lower image snapshots kept for rollback
+# resource profile keys and systemd scope properties they are applied as (tmpfs_size limits /var/tmp of lower containers instead)
+RESOURCE_PROPERTIES = {"cpu_weight": "CPUWeight", "cpu_quota": "CPUQuota", "memory_high": "MemoryHigh", "memory_max": "MemoryMax", "io_weight": "IOWeight"}
+CONTAINER_SAMPLE_INTERVAL = 0.5  # seconds between cgroup usage samples of a running container
+WATCH_SETTLE_TIME = 0.3  # seconds without further changes before `genpack watch` rebuilds
+WATCH_COMPRESSION = "lz4"  # fast codec used when `genpack watch --repack` repacks
+# content-defined chunking parameters for chunk store
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_AVG_BITS = 16 # average chunk size is about 64KiB
+CHUNK_MAX_SIZE = 256 * 1024
+CHUNK_SEGMENT_SIZE = 64 * 1024 * 1024 # images are split into segments chunked in parallel
+CHUNK_SCAN_BLOCK = 4 * 1024 # bytes whose rolling hashes are computed at once while looking for a cut point
+DEFAULT_CHUNK_STORE_KEEP = 8 # number of most recent chunk indexes whose chunks are kept in chunk store
+DEFAULT_MIXIN_TTL = 300 # seconds during which a mix-in fetched last time is not fetched again
+MAX_PARALLEL_MIXIN_FETCHES = 8
 OVERLAY_SOURCE = "https://github.com/wbrxcorp/genpack-overlay.git"
+DEFAULT_COMPRESSION = "zstd"
+# default level and allowed level range for each compressor. lz4 has only two levels: 1 (default) and 2 (-Xhc)
+SQUASHFS_COMPRESSION_LEVELS = {
+    "gzip": (1, 1, 9),
+    "lzo": (None, 1, 9),
+    "zstd": (3, 1, 22),
+    "lz4": (None, 1, 2),
+    "xz": None,
+    "none": None,
+}
+DEFAULT_EROFS_COMPRESSION = "lz4hc"
+# default level and allowed level range for each erofs compressor
+EROFS_COMPRESSION_LEVELS = {
+    "lz4": None,
+    "lz4hc": (12, 0, 12),
+    "lzma": (6, 0, 109),
+    "deflate": (1, 0, 9),
+    "zstd": (3, 1, 22),
+    "none": None,
+}
+PACK_EXCLUDES = ["build", "build.d", "build.d/*", "var/log/*.log", "var/tmp/*"]
+# (compression, level) pairs compared by `genpack pack --benchmark`
+BENCHMARK_PROFILES = [
+    ("gzip", 1), ("gzip", 9), ("lzo", None), ("lz4", 1), ("lz4", 2), ("xz", None),
+    ("zstd", 1), ("zstd", 3), ("zstd", 9), ("zstd", 15), ("zstd", 19),
+]
 
 arch = os.uname().machine
 
@@ -19,27 +62,50 @@ cache_root = os.path.join(os.path.expanduser("~"), ".cache/genpack")
 cache_arch_dir = os.path.join(cache_root, arch)
 binpkgs_dir = os.path.join(cache_arch_dir, "binpkgs")
 download_dir = os.path.join(cache_root, "download")
+chunk_store_dir = os.path.join(cache_root, "chunks")
+mixin_store_dir = os.path.join(cache_root, "mixins")
+overlay_store_dir = os.path.join(cache_root, "genpack-overlay")
 
 base_url = "http://ftp.iij.ad.jp/pub/linux/gentoo/"
 user_agent = "genpack/0.1"
 overlay_override = None
+genpack_overlay_snapshot = None # (directory, lock file) of genpack-overlay worktree used by this process, see pin_genpack_overlay_snapshot()
+format_override = None # --format, wins over "format" in genpack.json
 independent_binpkgs = False
+offline = False
 deep_depclean = False
 genpack_json = None
 genpack_json_time = None
 
 container_name = "genpack-%d" % os.getpid()
 
+pack_cache_dir = os.path.join(work_dir, "pack-cache")
+
 mixin_root = os.path.join(work_root, "mixins")
 mixins = []
 mixin_genpack_json = {}
+mixin_ttl = None
+lower_snapshot_keep = DEFAULT_LOWER_SNAPSHOT_KEEP
+lower_snapshot_full_copy = False # take full copies of lower image as snapshots where reflink is not available
+auto_rollback = False
+ram_upper = None # RamUpper while upper directory is on tmpfs or zram, see start_ram_upper()
+resources = {} # resource profile of build containers, see get_resource_profile()
 
 class Variant:
     def __init__(self, name):
         self.name = name
         self.lower_image = os.path.join(work_dir, "lower.img") if self.name is None else os.path.join(work_dir, "lower-%s.img" % self.name)
         self.lower_files = os.path.join(work_dir, "lower.files") if self.name is None else os.path.join(work_dir, "lower-%s.files" % self.name)
+        self.emerge_metrics = os.path.join(work_dir, "emerge-metrics.json") if self.name is None else os.path.join(work_dir, "emerge-metrics-%s.json" % self.name)
+        self.lower_index = os.path.join(work_dir, "lower.files.idx") if self.name is None else os.path.join(work_dir, "lower-%s.files.idx" % self.name)
+        self.overlay_head = os.path.join(work_dir, "lower.overlay-head") if self.name is None else os.path.join(work_dir, "lower-%s.overlay-head" % self.name)
+        self.lower_checkpoint = os.path.join(work_dir, "lower.checkpoint.json") if self.name is None else os.path.join(work_dir, "lower-%s.checkpoint.json" % self.name)
+        self.lower_snapshots = os.path.join(work_dir, "lower.snapshots") if self.name is None else os.path.join(work_dir, "lower-%s.snapshots" % self.name)
         self.upper_image = os.path.join(work_dir, "upper.img") if self.name is None else os.path.join(work_dir, "upper-%s.img" % self.name)
+        self.boot_trace = os.path.join(work_dir, "boot-trace.txt") if self.name is None else os.path.join(work_dir, "boot-trace-%s.txt" % self.name)
+        self.boot_sort_file = os.path.join(work_dir, "boot.sort") if self.name is None else os.path.join(work_dir, "boot-%s.sort" % self.name)
+        self.upper_attribution = os.path.join(work_dir, "upper.attribution.json") if self.name is None else os.path.join(work_dir, "upper-%s.attribution.json" % self.name)
+        self.upper_files_manifest = os.path.join(work_dir, "upper.files.json") if self.name is None else os.path.join(work_dir, "upper-%s.files.json" % self.name)
 
 def sudo(cmd):
     # if current user is root, just return the command
@@ -48,9 +114,312 @@ def sudo(cmd):
     #else
     return ['sudo'] + cmd
 
+broker = None # connection to `genpack-helper broker`, see start_broker()
+
+class Broker:
+    """Client of `genpack-helper broker`, a long-lived privileged process which performs mount and file operations
+    requested over a pipe so that each of them does not need to spawn sudo."""
+    def __init__(self, helper="genpack-helper"):
+        # own session so that Ctrl+C on the terminal reaches only genpack, which then closes the pipe to let broker clean up
+        self.process = subprocess.Popen([helper, "broker"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+        self.lock = threading.Lock()
+
+    def request(self, op, *args):
+        frame = b"\0".join(arg if isinstance(arg, bytes) else os.fsencode(arg) for arg in (op,) + args)
+        with self.lock:
+            self.process.stdin.write(struct.pack("=I", len(frame)) + frame)
+            self.process.stdin.flush()
+            header = self.process.stdout.read(4)
+            if len(header) < 4:
+                raise RuntimeError("genpack-helper broker exited unexpectedly")
+            #else
+            status, _, result = self.process.stdout.read(struct.unpack("=I", header)[0]).partition(b"\0")
+        if status != b"ok":
+            raise RuntimeError(f"genpack-helper broker failed to {op} {' '.join(map(str, args[:1]))}: {os.fsdecode(result)}")
+        #else
+        return os.fsdecode(result)
+
+    def close(self):
+        # broker unmounts everything left on EOF
+        self.process.stdin.close()
+        self.process.wait()
+
+def start_broker(helper="genpack-helper"):
+    global broker
+    if os.geteuid() == 0 or shutil.which(helper) is None: return # sudo is not involved or helper is not installed
+    #else
+    try:
+        broker = Broker(helper)
+        broker.request("ping")
+    except (OSError, RuntimeError) as e:
+        logging.warning(f"genpack-helper broker is not available, using sudo instead: {e}")
+        broker = None
+        return
+    #else
+    atexit.register(broker.close)
+    logging.debug("Using genpack-helper broker for privileged operations.")
+
+# privileged operations performed by broker if available, otherwise by sudo.
+# both accept only paths inside images mounted through priv_mount() or priv_mount_ram().
+priv_mounts = [] # mount points for sudo, see priv_confine()
+
+def priv_mount(image, mount_point):
+    if broker is not None: broker.request("mount", image, mount_point)
+    else:
+        run_command(sudo(['mount', image, mount_point]), check=True)
+        priv_mounts.append(os.path.abspath(mount_point))
+
+def priv_umount(mount_point):
+    if broker is not None: broker.request("umount", mount_point)
+    else:
+        run_command(sudo(['umount', mount_point]), check=True)
+        priv_mounts.remove(os.path.abspath(mount_point))
+
+def priv_mount_ram(mount_point, size, kind, mem_limit=None):
+    """Mount size-limited tmpfs, or ext4 on a new zram device whose compressed data may use up to mem_limit bytes of RAM, at mount_point.
+    Returns zram device to be released by priv_release_zram() after unmount, None for tmpfs."""
+    if broker is not None:
+        result = broker.request("mount-" + kind, mount_point, str(size), *([str(mem_limit)] if mem_limit is not None else []))
+        return result if kind == "zram" else None
+    #else
+    if kind == "tmpfs":
+        run_command(sudo(['mount', '-t', 'tmpfs', '-o', f"size={size},mode=0755", 'tmpfs', mount_point]), check=True)
+        priv_mounts.append(os.path.abspath(mount_point))
+        return None
+    #else
+    device = run_command(sudo(['zramctl', '--find']), stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
+    try:
+        if run_command(sudo(['zramctl', '--size', str(size), '--algorithm', 'zstd', device]), stderr=subprocess.DEVNULL).returncode != 0:
+            run_command(sudo(['zramctl', '--size', str(size), device]), check=True) # keep kernel's default algorithm
+        if mem_limit is not None:
+            run_command(sudo(['tee', f"/sys/block/{os.path.basename(device)}/mem_limit"]), input=str(mem_limit), stdout=subprocess.DEVNULL, text=True, check=True)
+        run_command(sudo(['mkfs.ext4', '-q', device]), check=True)
+        # writes beyond mem_limit fail with I/O error, which must not go unnoticed
+        run_command(sudo(['mount', '-o', 'errors=remount-ro', device, mount_point]), check=True)
+    except Exception:
+        run_command(sudo(['zramctl', '--reset', device]))
+        raise
+    priv_mounts.append(os.path.abspath(mount_point))
+    return device
+
+def priv_release_zram(device):
+    if broker is not None: return # broker releases zram device when unmounting
+    #else
+    run_command(sudo(['zramctl', '--reset', device]))
+
+def priv_confine(path, allow_mount_point=False):
+    """Split path into mount point in priv_mounts and the rest, which is resolved by file_op_beneath() as it lies in the image."""
+    path = os.path.abspath(path)
+    for mount_point in priv_mounts:
+        relative = os.path.relpath(path, mount_point)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep): continue
+        if relative == os.curdir and not allow_mount_point: break
+        #else
+        return [mount_point, relative]
+    raise ValueError(f"Path is not inside images mounted by genpack: {path}")
+
+def file_op_beneath(op, *args):
+    # executed as root by priv_*() without broker. must not depend on anything outside this function.
+    # like genpack-helper broker, paths inside image are resolved one component at a time from its mount point without following symlinks
+    # because the image can contain anything, including symlinks pointing outside of it.
+    import os, sys, stat, shutil
+    def open_dir(mount_point, relative, create=False):
+        fd = os.open(mount_point, os.O_RDONLY | os.O_DIRECTORY)
+        for name in relative.split("/"):
+            if name in ("", "."): continue
+            if name == "..": raise ValueError(f"Path must not contain '..': {relative}")
+            #else
+            if create:
+                try: os.mkdir(name, 0o755, dir_fd=fd)
+                except FileExistsError: pass # opening it tells whether it is a directory
+            try:
+                child_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            finally:
+                os.close(fd)
+            fd = child_fd
+        return fd
+    def open_parent(mount_point, relative):
+        dirname, name = os.path.split(relative.rstrip("/"))
+        if name in ("", ".", ".."): raise ValueError(f"Invalid path: {relative}")
+        return open_dir(mount_point, dirname), name
+    if op == "mkdir": # mkdir <mount_point> <relative> (like mkdir -p)
+        os.close(open_dir(args[0], args[1], create=True))
+    elif op == "write": # write <mount_point> <relative>, data from stdin
+        dir_fd, name = open_parent(args[0], args[1])
+        with open(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o644, dir_fd=dir_fd), "wb") as f:
+            f.write(sys.stdin.buffer.read())
+    elif op == "remove": # remove <mount_point> <relative> [<mount_point> <relative>...] (like rm -rf)
+        for mount_point, relative in zip(args[0::2], args[1::2]):
+            dir_fd, name = open_parent(mount_point, relative)
+            try:
+                st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode): shutil.rmtree(name, dir_fd=dir_fd) # fd based, never follows symlinks
+                else: os.unlink(name, dir_fd=dir_fd)
+            except FileNotFoundError:
+                pass
+            finally:
+                os.close(dir_fd)
+    elif op == "rename": # rename <mount_point> <relative> <mount_point> <relative>
+        src_dir_fd, src_name = open_parent(args[0], args[1])
+        dst_dir_fd, dst_name = open_parent(args[2], args[3])
+        os.rename(src_name, dst_name, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+    else:
+        raise ValueError(f"Unknown operation: {op}")
+
+def priv_mkdir(path):
+    if broker is not None: broker.request("mkdir", path)
+    else: run_command(sudo(python_cmdline(sys.executable, file_op_beneath, "mkdir", *priv_confine(path, True))), check=True)
+
+def priv_write(path, data):
+    if broker is not None: broker.request("write", path, data.encode())
+    else: run_command(sudo(python_cmdline(sys.executable, file_op_beneath, "write", *priv_confine(path))), input=data, text=True, check=True)
+
+def priv_remove(*paths):
+    if broker is not None:
+        for path in paths: broker.request("remove", path)
+    else:
+        for i in range(0, len(paths), 64):
+            args = [arg for path in paths[i:i + 64] for arg in priv_confine(path)]
+            run_command(sudo(python_cmdline(sys.executable, file_op_beneath, "remove", *args)), check=True)
+
+def priv_rename(src, dst):
+    if broker is not None: broker.request("rename", src, dst)
+    else: run_command(sudo(python_cmdline(sys.executable, file_op_beneath, "rename", *priv_confine(src), *priv_confine(dst))), check=True)
+
+def priv_chroot(mount_point, cmdline):
+    if broker is not None:
+        returncode = int(broker.request("chroot", mount_point, *cmdline))
+        if returncode != 0: raise subprocess.CalledProcessError(returncode, ["chroot", mount_point] + cmdline)
+    else:
+        run_command(sudo(['chroot', mount_point] + cmdline), check=True)
+
+trace_events = None # list of Chrome trace events, enabled by --timing
+trace_start = time.monotonic()
+
+def trace_now():
+    return (time.monotonic() - trace_start) * 1000000 # Chrome trace timestamps are in microseconds
+
+def read_proc_io():
+    # /proc/self/io includes I/O of children already waited for
+    io = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                io[key] = int(value)
+    except OSError:
+        pass
+    return io.get("read_bytes", 0), io.get("write_bytes", 0)
+
+@contextlib.contextmanager
+def trace_phase(name):
+    """Record wall time, CPU time (including waited children) and block I/O of the enclosed phase. Also usable as a decorator."""
+    if trace_events is None:
+        yield
+        return
+    #else
+    start, start_times, (start_read, start_write) = trace_now(), os.times(), read_proc_io()
+    try:
+        yield
+    finally:
+        end_times, (end_read, end_write) = os.times(), read_proc_io()
+        trace_events.append({"name": name, "cat": "phase", "ph": "X", "ts": start, "dur": trace_now() - start,
+                             "pid": os.getpid(), "tid": threading.get_native_id(),
+                             "args": {"cpu_s": round(sum(end_times[:4]) - sum(start_times[:4]), 3),
+                                      "read_bytes": end_read - start_read, "write_bytes": end_write - start_write}})
+
+def start_command(cmdline, **kwargs):
+    """subprocess.Popen() for a process to be reaped by wait_command(), which records it with its rusage when tracing is enabled."""
+    started = trace_now()
+    proc = subprocess.Popen(cmdline, **kwargs)
+    proc.trace_start = started
+    return proc
+
+def wait_command(proc, timeout=None):
+    """Reap process started by start_command() with wait4() and return its exit code.
+    subprocess.TimeoutExpired is raised if it does not exit within timeout seconds,
+    ChildProcessError if it has been reaped by someone else and its exit code is lost."""
+    if proc.returncode is not None: return proc.returncode
+    #else
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            raise ChildProcessError(f"Exit status of {proc.args} is lost, the process has been reaped elsewhere") from None
+        if pid == proc.pid: break
+        #else
+        if time.monotonic() >= deadline: raise subprocess.TimeoutExpired(proc.args, timeout)
+        #else
+        time.sleep(min(0.1, max(0, deadline - time.monotonic())))
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if trace_events is not None:
+        cmdline = [proc.args] if isinstance(proc.args, (str, bytes, os.PathLike)) else list(proc.args)
+        cmdline = [os.fsdecode(arg) for arg in cmdline]
+        if len(cmdline) > 1 and cmdline[0] == "sudo": cmdline = cmdline[1:]
+        trace_events.append({"name": os.path.basename(cmdline[0].split(" ")[0]), "cat": "command", "ph": "X",
+                             "ts": proc.trace_start, "dur": trace_now() - proc.trace_start,
+                             "pid": os.getpid(), "tid": threading.get_native_id(),
+                             "args": {"cmdline": " ".join(cmdline)[:1000], "cpu_s": round(rusage.ru_utime + rusage.ru_stime, 3),
+                                      "maxrss_kib": rusage.ru_maxrss,
+                                      "read_bytes": rusage.ru_inblock * 512, "write_bytes": rusage.ru_oublock * 512}})
+    return proc.returncode
+
+def poll_command(proc):
+    """Non-blocking wait_command(). Returns None if the process is still running."""
+    try:
+        return wait_command(proc, 0)
+    except subprocess.TimeoutExpired:
+        return None
+
+def run_command(cmdline, input=None, check=False, **kwargs):
+    """subprocess.run() counterpart of start_command() and wait_command()."""
+    if input is not None: kwargs["stdin"] = subprocess.PIPE
+    outputs = {}
+    with start_command(cmdline, **kwargs) as proc:
+        def read(name): outputs[name] = getattr(proc, name).read()
+        readers = [threading.Thread(target=read, args=(name,)) for name in ["stdout", "stderr"] if getattr(proc, name) is not None]
+        for reader in readers: reader.start()
+        if input is not None:
+            # exit code tells what happened if the command stops reading, like subprocess.run()
+            with contextlib.suppress(BrokenPipeError): proc.stdin.write(input)
+            with contextlib.suppress(BrokenPipeError): proc.stdin.close()
+        for reader in readers: reader.join()
+        returncode = wait_command(proc)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmdline, outputs.get("stdout"), outputs.get("stderr"))
+    #else
+    return subprocess.CompletedProcess(cmdline, returncode, outputs.get("stdout"), outputs.get("stderr"))
+
+def enable_tracing():
+    global trace_events
+    trace_events = []
+
+def write_trace(trace_file, top=20):
+    """Write recorded events in Chrome trace format (loadable by Perfetto or chrome://tracing) and print a summary."""
+    os.makedirs(os.path.dirname(trace_file), exist_ok=True)
+    with open(trace_file, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    for category, title in [("phase", "Phases"), ("command", "External commands")]:
+        totals = {}
+        for event in trace_events:
+            if event["cat"] != category: continue
+            t = totals.setdefault(event["name"], [0, 0, 0.0, 0, 0])
+            t[0] += 1
+            t[1] += event["dur"]
+            t[2] += event["args"]["cpu_s"]
+            t[3] += event["args"]["read_bytes"]
+            t[4] += event["args"]["write_bytes"]
+        print(f"\n{title}:")
+        print(f"{'count':>6} {'wall s':>9} {'cpu s':>9} {'read MiB':>9} {'write MiB':>9}  name")
+        for name, (count, wall, cpu, read_bytes, write_bytes) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:top]:
+            print(f"{count:>6} {wall / 1000000:>9.1f} {cpu:>9.1f} {read_bytes / 1024 / 1024:>9.1f} {write_bytes / 1024 / 1024:>9.1f}  {name}")
+    print(f"\nTrace written to {trace_file}. Open it with https://ui.perfetto.dev/ or chrome://tracing")
+
 def url_readlines(url):
     """Read lines from a URL."""
     logging.debug(f"Reading lines from URL: {url}")
+    import requests
     headers = {'User-Agent': user_agent}
     response = requests.get(url, headers=headers)
     response.raise_for_status()  # Raise an error for bad responses
@@ -96,6 +465,7 @@ def headers_to_info(headers):
 def get_headers(url):
     """Get the headers of a URL."""
     logging.debug(f"Getting headers for URL: {url}")
+    import requests
     headers = {'User-Agent': user_agent}
     response = requests.head(url, headers=headers)
     response.raise_for_status()  # Raise an error for bad responses
@@ -103,6 +473,7 @@ def get_headers(url):
     return response.headers
 
 def download(url, dest):
+    import requests
     headers = {'User-Agent': user_agent}
     response = requests.get(url, stream=True, headers=headers)
     response.raise_for_status()  # Raise an error for bad responses
@@ -123,18 +494,19 @@ class TempMount:
     def __enter__(self):
         # Logic to mount the filesystem
         logging.debug(f"Mounting to {self.mount_point}")
-        subprocess.run(sudo(['mount', self.image_path, self.mount_point]), check=True)
+        priv_mount(self.image_path, self.mount_point)
         logging.debug(f"Mounted {self.image_path} at {self.mount_point}")
         return self.mount_point
 
     def __exit__(self, exc_type, exc_value, traceback):
         # Logic to unmount the filesystem
         logging.debug(f"Unmounting {self.mount_point}")
-        subprocess.run(sudo(['umount', self.mount_point]), check=True)
+        priv_umount(self.mount_point)
         # Clean up the temporary mount point
         os.rmdir(self.mount_point)
         logging.debug(f"Temporary mount point removed: {self.mount_point}")
 
+@trace_phase("setup lower image")
 def setup_lower_image(lower_image, stage3_tarball, portage_tarball):
     # create image file
     lower_size_in_gib = genpack_json.get("lower-layer-capacity", DEFAULT_LOWER_SIZE_IN_GIB)
@@ -144,23 +516,24 @@ def setup_lower_image(lower_image, stage3_tarball, portage_tarball):
         f.write(b'\x00')
     try:
         logging.info(f"Formatting filesystem on {lower_image}")
-        subprocess.run(['mkfs.ext4', lower_image], check=True)
+        run_command(['mkfs.ext4', lower_image], check=True)
         logging.info("Filesystem formatted successfully.")
         with TempMount(lower_image) as mount_point:
             logging.info("Extracting stage3 to lower image...")
-            subprocess.run(sudo(['tar', 'xpf', stage3_tarball, '-C', mount_point]), check=True)
+            run_command(sudo(['tar', 'xpf', stage3_tarball, '-C', mount_point]), check=True)
             logging.info("Extracting portage to lower image...")
             portage_dir = os.path.join(mount_point, "var/db/repos/gentoo")
-            subprocess.run(sudo(["mkdir", "-p", portage_dir]), check=True)
-            subprocess.run(sudo(['tar', 'xpf', portage_tarball, '-C', portage_dir, "--strip-components=1"]), check=True)
+            priv_mkdir(portage_dir)
+            run_command(sudo(['tar', 'xpf', portage_tarball, '-C', portage_dir, "--strip-components=1"]), check=True)
             # workaround for https://bugs.gentoo.org/734000
-            subprocess.run(sudo(['chroot', mount_point, "chown", "portage", "/var/cache/distfiles"]), check=True)
-            subprocess.run(sudo(['chroot', mount_point, "chmod", "g+w", "/var/cache/distfiles"]), check=True)
+            priv_chroot(mount_point, ["chown", "portage", "/var/cache/distfiles"])
+            priv_chroot(mount_point, ["chmod", "g+w", "/var/cache/distfiles"])
     except Exception as e:
         logging.error(f"Error setting up lower image: {e}")
         os.remove(lower_image)  # Clean up the image
         raise
 
+@trace_phase("replace portage")
 def replace_portage(lower_image, portage_tarball):
     logging.info(f"Replacing portage in lower image: {lower_image}")
     with TempMount(lower_image) as mount_point:
@@ -169,11 +542,72 @@ def replace_portage(lower_image, portage_tarball):
             # rename the old portage directory to uniqe name using timestamp
             old_portage_dir = portage_dir + ".old-" + datetime.now().strftime("%Y%m%d-%H%M%S")
             logging.info(f"Renaming old portage directory to {old_portage_dir}")
-            subprocess.run(sudo(['mv', portage_dir, old_portage_dir]), check=True)
-        subprocess.run(sudo(["mkdir", "-p", portage_dir]), check=True)
-        subprocess.run(sudo(['tar', 'xpf', portage_tarball, '-C', portage_dir, "--strip-components=1"]), check=True)
+            priv_rename(portage_dir, old_portage_dir)
+        priv_mkdir(portage_dir)
+        run_command(sudo(['tar', 'xpf', portage_tarball, '-C', portage_dir, "--strip-components=1"]), check=True)
         logging.info("Portage replaced successfully.")
 
+def get_resource_profile(stage):
+    """Resource profile for containers of stage ("lower", "upper" or "pack"): common keys overridden by stage-specific ones."""
+    profile = {k: v for k, v in resources.items() if k in RESOURCE_PROPERTIES or k == "tmpfs_size"}
+    profile.update(resources.get(stage, {}))
+    return profile
+
+def resource_properties(stage):
+    return [f"--property={RESOURCE_PROPERTIES[k]}={v}" for k, v in get_resource_profile(stage).items() if k in RESOURCE_PROPERTIES]
+
+def systemd_escape(name):
+    # same as `systemd-escape`, for deriving scope unit name of a container
+    return "".join(c if c.isascii() and (c.isalnum() or c in ":_" or (c == "." and i > 0)) else "".join(f"\\x{b:02x}" for b in c.encode())
+                   for i, c in enumerate(name))
+
+def read_container_usage(cgroup_dir):
+    def read_flat_keyed(name):
+        with open(os.path.join(cgroup_dir, name)) as f:
+            return {k: int(v) for k, v in (line.split() for line in f)}
+    usage = {"cpu_s": read_flat_keyed("cpu.stat")["usage_usec"] / 1000000, "oom_kills": read_flat_keyed("memory.events").get("oom_kill", 0)}
+    peak_file = os.path.join(cgroup_dir, "memory.peak") # Linux 5.19 or later
+    with open(peak_file if os.path.exists(peak_file) else os.path.join(cgroup_dir, "memory.current")) as f:
+        usage["memory_bytes"] = int(f.read())
+    usage["read_bytes"] = usage["write_bytes"] = 0
+    with open(os.path.join(cgroup_dir, "io.stat")) as f:
+        for line in f:
+            fields = dict(field.split("=", 1) for field in line.split()[1:])
+            usage["read_bytes"] += int(fields.get("rbytes", 0))
+            usage["write_bytes"] += int(fields.get("wbytes", 0))
+    return usage
+
+@contextlib.contextmanager
+def container_usage(name):
+    """Sample cgroup of the container while the enclosed block runs it, and report its peak memory, CPU time and I/O."""
+    cgroup_dir = f"/sys/fs/cgroup/machine.slice/machine-{systemd_escape(container_name)}.scope"
+    usage = {}
+    stop = threading.Event()
+    def sample():
+        while True:
+            try:
+                current = read_container_usage(cgroup_dir)
+                current["memory_bytes"] = max(current["memory_bytes"], usage.get("memory_bytes", 0))
+                usage.update(current)
+            except (OSError, KeyError, ValueError):
+                pass # container is not started yet or has already exited
+            if stop.wait(CONTAINER_SAMPLE_INTERVAL): break
+    start = trace_now()
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        sampler.join()
+        if len(usage) > 0:
+            logging.info(f"{name}: peak memory {usage['memory_bytes'] / 1024**3:.2f} GiB, CPU {usage['cpu_s']:.1f}s, "
+                         f"read {usage['read_bytes'] / 1024**2:.0f} MiB, write {usage['write_bytes'] / 1024**2:.0f} MiB"
+                         + (f", {usage['oom_kills']} process(es) killed by OOM killer" if usage["oom_kills"] > 0 else ""))
+            if trace_events is not None:
+                trace_events.append({"name": name, "cat": "container", "ph": "X", "ts": start, "dur": trace_now() - start,
+                                     "pid": os.getpid(), "tid": threading.get_native_id(), "args": usage})
+
 def lower_exec(lower_image, cmdline, env=None):
     if isinstance(cmdline, str):
         cmdline = [cmdline]
@@ -187,9 +621,10 @@ def lower_exec(lower_image, cmdline, env=None):
     # use PID for container name
     nspawn_cmdline = ["systemd-nspawn", "-q", "--suppress-sync=true", 
         "--as-pid2", "-M", container_name, f"--image={lower_image}",
-        "--tmpfs=/var/tmp",
+        "--tmpfs=/var/tmp" + (f":mode=1777,size={get_resource_profile('lower')['tmpfs_size']}" if "tmpfs_size" in get_resource_profile("lower") else ""),
         "--capability=CAP_MKNOD,CAP_SYS_ADMIN,CAP_NET_ADMIN", # Portage's network sandbox needs CAP_NET_ADMIN
-    ]
+    ] + resource_properties("lower")
+    if offline: nspawn_cmdline.append("--private-network")
     if not independent_binpkgs:
         os.makedirs(binpkgs_dir, exist_ok=True)
         nspawn_cmdline.append(f"--bind={binpkgs_dir}:/var/cache/binpkgs{':rootidmap' if os.geteuid() != 0 else ''}")
@@ -198,6 +633,8 @@ def lower_exec(lower_image, cmdline, env=None):
             raise ValueError("overlay-override must be a directory")
         #else
         nspawn_cmdline.append(f"--bind={os.path.abspath(overlay_override)}:/var/db/repos/genpack-overlay")
+    elif os.path.isdir(get_genpack_overlay_dir()):
+        nspawn_cmdline.append(f"--bind={get_genpack_overlay_dir()}:/var/db/repos/genpack-overlay{':rootidmap' if os.geteuid() != 0 else ''}")
     if env is not None:
         if not isinstance(env, dict):
             raise ValueError("env must be a dictionary")
@@ -206,7 +643,8 @@ def lower_exec(lower_image, cmdline, env=None):
             nspawn_cmdline.append(f"--setenv={k}={v}")
     nspawn_cmdline += cmdline
 
-    subprocess.run(sudo(nspawn_cmdline), check=True)
+    with trace_phase("lower: " + " ".join(cmdline)[:80]), container_usage("lower: " + " ".join(cmdline)[:80]):
+        run_command(sudo(nspawn_cmdline), check=True)
 
 def escape_colon(s):
     # systemd-nspawn's some options need colon to be escaped
@@ -223,7 +661,10 @@ def upper_exec(upper_dir, variant, cmdline, user=None):
         f"--bind={os.path.abspath(download_dir)}:/var/cache/download{':rootidmap' if os.geteuid() != 0 else ''}",
         "--capability=CAP_MKNOD,CAP_NET_ADMIN",
         "-E", f"ARTIFACT={genpack_json["name"]}"
-    ]
+    ] + resource_properties("upper")
+    if offline: nspawn_cmdline.append("--private-network")
+    if os.path.isdir(get_genpack_overlay_dir()):
+        nspawn_cmdline.append(f"--bind-ro={get_genpack_overlay_dir()}:/var/db/repos/genpack-overlay")
     if variant.name is not None:
         nspawn_cmdline += ["-E", f"VARIANT={variant.name}"]
 
@@ -235,9 +676,73 @@ def upper_exec(upper_dir, variant, cmdline, user=None):
             raise ValueError("user must be a string")
         #else
         nspawn_cmdline.append(f"--user={user}")
-    subprocess.check_call(sudo(nspawn_cmdline + cmdline))
+    with trace_phase("upper: " + " ".join(cmdline)[:80]), container_usage("upper: " + " ".join(cmdline)[:80]):
+        run_command(sudo(nspawn_cmdline + cmdline), check=True)
+
+def fetch_mixin(mixin, mixin_id, ttl, fetch=True):
+    """Fetch HEAD of mix-in repository shallowly into the store shared by all projects and check it out into project's mixin directory.
+    The checkout borrows objects from the store through git alternates."""
+    url = os.path.abspath(mixin) if os.path.isdir(mixin) else mixin
+    # store is keyed on the resolved url, as the same relative path means different repositories in different projects.
+    # mixin_id is per project and names only the checkout in work/mixins
+    store = os.path.join(mixin_store_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".git")
+    os.makedirs(mixin_store_dir, exist_ok=True)
+    with open(store + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # the store may be used by other genpack processes at the same time
+        if not os.path.isdir(store):
+            run_command(["git", "init", "-q", "--bare", store], check=True)
+            # never prune objects, checkouts of other projects may still refer to them
+            run_command(["git", "-C", store, "config", "gc.auto", "0"], check=True)
+        get_head = lambda: run_command(["git", "-C", store, "rev-parse", "-q", "--verify", "refs/genpack/head"],
+                                          stdout=subprocess.PIPE, text=True).stdout.strip() or None
+        head = get_head()
+        fetched = os.path.join(store, "genpack-fetched")
+        if not fetch:
+            if head is None:
+                raise FileNotFoundError(f"Mix-in {mixin} has never been fetched. Please run 'lower', 'upper' or 'build' online first.")
+            #else
+            logging.debug(f"Using previously fetched mix-in {mixin} ({head[:12]}) without fetching.")
+        elif head is not None and os.path.isfile(fetched) and time.time() - os.path.getmtime(fetched) < ttl:
+            logging.info(f"Mix-in {mixin} was fetched within {ttl} seconds, skipping fetch.")
+        else:
+            logging.info(f"Fetching mix-in {mixin}...")
+            try:
+                run_command(["git", "-C", store, "fetch", "-q", "--depth", "1", "--no-tags", url, "+HEAD:refs/genpack/head"], check=True)
+                with open(fetched, "w") as f:
+                    f.write(mixin + "\n")
+                head = get_head()
+            except subprocess.CalledProcessError:
+                if head is None: raise
+                #else
+                logging.error(f"Failed to update mix-in {mixin}({mixin_id}). Proceeding with previously fetched commit {head[:12]}.")
+        store_shallow = os.path.join(store, "shallow")
 
-def download_mixins():
+        mixin_dir = os.path.join(mixin_root, mixin_id)
+        git_dir = os.path.join(mixin_dir, ".git")
+        alternates = os.path.join(git_dir, "objects/info/alternates")
+        store_objects = os.path.abspath(os.path.join(store, "objects")) + "\n"
+        current_alternates = None
+        if os.path.isfile(alternates):
+            with open(alternates) as f:
+                current_alternates = f.read()
+        else:
+            if os.path.exists(mixin_dir):
+                logging.info(f"Replacing full clone of mix-in {mixin} with checkout from shared store.")
+                shutil.rmtree(mixin_dir)
+            run_command(["git", "init", "-q", mixin_dir], check=True)
+        if current_alternates != store_objects: # new checkout, or one borrowing from a store named by older genpack
+            with open(alternates, "w") as f:
+                f.write(store_objects)
+        if os.path.isfile(store_shallow):
+            shutil.copyfile(store_shallow, os.path.join(git_dir, "shallow"))
+    current = run_command(["git", "-C", mixin_dir, "rev-parse", "-q", "--verify", "HEAD"], stdout=subprocess.PIPE, text=True).stdout.strip()
+    if current != head:
+        run_command(["git", "-C", mixin_dir, "checkout", "-q", "--force", "--detach", head], check=True)
+    return head
+
+@trace_phase("download mixins")
+def download_mixins(fetch=True):
+    """Make mix-ins listed in genpack.json available in work/mixins. With fetch=False, previously fetched commits are used without network access."""
     global mixins, mixin_genpack_json
     mixins_tmp = genpack_json.get("mixin", None)
     if mixins_tmp is None:
@@ -249,68 +754,131 @@ def download_mixins():
     elif not isinstance(mixins_tmp, list):
         raise ValueError("mixins must be a string or a list of strings")
 
-    if not os.path.isdir(mixin_root):
-        os.makedirs(mixin_root, exist_ok=True)
-
     for mixin in mixins_tmp:
         if not isinstance(mixin, str):
             raise ValueError("mixin must be a string")
-        #else
-        # treat sha-256 hash of mixin name as an identifier
-        mixin_id = hashlib.sha256(mixin.encode('utf-8')).hexdigest()
-        mixin_dir = os.path.join(mixin_root, mixin_id)
-        if os.path.isdir(mixin_dir):
-            # perform git pull
-            logging.info(f"Mixin {mixin} already exists, updating...")
-            try:
-                subprocess.run(['git', '-C', mixin_dir, 'pull'], check=True)
-            except subprocess.CalledProcessError as e:
-                logging.error(f"Failed to update mix-in {mixin}({mixin_id}). Proceeding without updating.  If you need to reset mix-ins, remove the directory {mixin_dir} and try again.")
-                continue
-        else:
-            # perform git clone
-            logging.info(f"Downloading mix-in {mixin}...")
-            subprocess.run(['git', 'clone', mixin, mixin_dir], check=True)
-        mixin_genpack_json[mixin_id] = load_genpack_json(mixin_dir)
+    #else
+    mixins_tmp = list(dict.fromkeys(mixins_tmp)) # remove duplicates preserving order
+    if len(mixins_tmp) == 0:
+        return
+    #else
+    if not os.path.isdir(mixin_root):
+        os.makedirs(mixin_root, exist_ok=True)
+
+    # treat sha-256 hash of mixin name as an identifier
+    mixin_ids = [hashlib.sha256(mixin.encode('utf-8')).hexdigest() for mixin in mixins_tmp]
+    ttl = mixin_ttl if mixin_ttl is not None else genpack_json.get("mixin_ttl", DEFAULT_MIXIN_TTL)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_MIXIN_FETCHES, len(mixins_tmp))) as executor:
+        list(executor.map(fetch_mixin, mixins_tmp, mixin_ids, [ttl] * len(mixins_tmp), [fetch] * len(mixins_tmp)))
+
+    for mixin_id in mixin_ids:
+        mixin_genpack_json[mixin_id] = load_genpack_json(os.path.join(mixin_root, mixin_id))[0]
         mixins.append(mixin_id)
 
+def get_genpack_overlay_checkout():
+    """One checkout per OVERLAY_SOURCE is shared by all projects. It is only pulled, builds use worktrees of it."""
+    return os.path.join(overlay_store_dir, hashlib.sha256(OVERLAY_SOURCE.encode()).hexdigest()[:16])
+
+def get_genpack_overlay_dir():
+    """Host directory bind-mounted as /var/db/repos/genpack-overlay.
+    It is a worktree of the commit the shared checkout was at when first needed, which stays the same until this process exits."""
+    if overlay_override is not None: return os.path.abspath(overlay_override)
+    #else
+    if genpack_overlay_snapshot is None:
+        if not os.path.isdir(get_genpack_overlay_checkout()): return get_genpack_overlay_checkout() # not cloned yet
+        #else
+        pin_genpack_overlay_snapshot()
+    return genpack_overlay_snapshot[0]
+
+def pin_genpack_overlay_snapshot():
+    """Switch this process to a worktree of current HEAD of the shared genpack-overlay checkout, creating it if necessary.
+    Worktrees are held by shared lock while in use. The others are removed so that only worktrees in use remain."""
+    global genpack_overlay_snapshot
+    checkout = get_genpack_overlay_checkout()
+    with open(checkout + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # only while looking up HEAD and adding/removing worktrees, not while they are used
+        head = get_git_head(checkout)
+        if head is None: raise RuntimeError(f"genpack-overlay checkout {checkout} is broken. Please remove it and run 'lower' online.")
+        #else
+        snapshot_dir = f"{checkout}-{head[:12]}"
+        snapshot_lock = open(snapshot_dir + ".lock", "w")
+        fcntl.flock(snapshot_lock, fcntl.LOCK_SH)
+        other_dirs = [os.path.join(overlay_store_dir, name) for name in os.listdir(overlay_store_dir) if name.startswith(os.path.basename(checkout) + "-")]
+        other_dirs = [other_dir for other_dir in other_dirs if other_dir != snapshot_dir and os.path.isdir(other_dir)]
+        if not os.path.isdir(snapshot_dir):
+            run_command(["git", "-C", checkout, "worktree", "add", "-q", "--detach", snapshot_dir, head], check=True)
+            # start from the most recently updated metadata cache, egencache regenerates only entries of changed ebuilds
+            caches = [os.path.join(other_dir, "metadata/md5-cache") for other_dir in other_dirs if os.path.isdir(os.path.join(other_dir, "metadata/md5-cache"))]
+            if len(caches) > 0:
+                shutil.copytree(max(caches, key=os.path.getmtime), os.path.join(snapshot_dir, "metadata/md5-cache"))
+        if genpack_overlay_snapshot is not None: genpack_overlay_snapshot[1].close()
+        genpack_overlay_snapshot = (snapshot_dir, snapshot_lock)
+
+        for other_dir in other_dirs:
+            with open(other_dir + ".lock", "w") as other_lock:
+                try:
+                    fcntl.flock(other_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue # used by another genpack process
+                #else
+                logging.debug(f"Removing unused genpack-overlay worktree {other_dir}")
+                if run_command(["git", "-C", checkout, "worktree", "remove", "--force", other_dir]).returncode != 0:
+                    logging.warning(f"Failed to remove genpack-overlay worktree {other_dir}")
+                    continue
+                #else
+                os.remove(other_dir + ".lock") # nobody can open it meanwhile as checkout lock is held
+
+def get_git_head(repo):
+    head = run_command(["git", "-C", repo, "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return head.stdout.strip() if head.returncode == 0 else None
+
+@trace_phase("sync genpack-overlay")
 def sync_genpack_overlay(lower_image):
-    with TempMount(lower_image) as mount_point:
-        genpack_overlay_dir = os.path.join(mount_point, "var/db/repos/genpack-overlay")
-        if os.path.isdir(genpack_overlay_dir):
-            subprocess.run(sudo(['git', '-C', genpack_overlay_dir, 'pull']), check=True)
+    """Bring host-side genpack-overlay checkout up to date and register it in lower image.
+    Returns HEAD commit of the checkout, which tells whether lower image needs to be rebuilt."""
+    if overlay_override is None:
+        os.makedirs(overlay_store_dir, exist_ok=True)
+        checkout = get_genpack_overlay_checkout()
+        if os.path.isdir(checkout) and offline:
+            logging.info("Offline mode, not updating genpack-overlay.")
+        elif offline:
+            raise FileNotFoundError("genpack-overlay has not been cloned yet. Please run 'lower' online first.")
         else:
-            logging.info("Genpack overlay not found, cloning...")
-            subprocess.run(sudo(['git', 'clone', OVERLAY_SOURCE, genpack_overlay_dir]), check=True)
+            # running builds use their own worktrees, so the checkout is locked only while being updated
+            with open(checkout + ".lock", "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logging.info("Waiting for another genpack process updating genpack-overlay...")
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                if os.path.isdir(checkout):
+                    run_command(['git', '-C', checkout, 'pull', '-q', '--ff-only'], check=True)
+                else:
+                    logging.info("Genpack overlay not found, cloning...")
+                    run_command(['git', 'clone', '-q', OVERLAY_SOURCE, checkout], check=True)
+        pin_genpack_overlay_snapshot()
+    genpack_overlay_dir = get_genpack_overlay_dir()
+    with TempMount(lower_image) as mount_point:
+        # mount point of the bind mount. images made by older genpack have a clone here, which is just hidden
+        priv_mkdir(os.path.join(mount_point, "var/db/repos/genpack-overlay"))
         repos_conf = os.path.join(mount_point, "etc/portage/repos.conf/genpack-overlay.conf")
         if not os.path.isfile(repos_conf):
             logging.info("Creating repos.conf for genpack-overlay")
-            subprocess.run(sudo(['mkdir', '-p', os.path.dirname(repos_conf)]), check=True)
-            tee = subprocess.Popen(sudo(['tee', repos_conf]), stdin=subprocess.PIPE, text=True)
-            tee.stdin.write("[genpack-overlay]\nlocation=/var/db/repos/genpack-overlay")
-            tee.stdin.close()
-            tee.wait()
+            priv_mkdir(os.path.dirname(repos_conf))
+            priv_write(repos_conf, "[genpack-overlay]\nlocation=/var/db/repos/genpack-overlay")
         accept_keywords_file = os.path.join(mount_point, "etc/portage/package.accept_keywords/genpack")
         if not os.path.isfile(accept_keywords_file):
             logging.info("Creating package.accept_keywords for genpack")
-            subprocess.run(sudo(['mkdir', '-p', os.path.dirname(accept_keywords_file)]), check=True)
-            tee = subprocess.Popen(sudo(['tee', accept_keywords_file]), stdin=subprocess.PIPE, text=True)
-            tee.stdin.write("dev-cpp/argparse\n")
-            tee.stdin.close()
-            tee.wait()
+            priv_mkdir(os.path.dirname(accept_keywords_file))
+            priv_write(accept_keywords_file, "dev-cpp/argparse\n")
         use_file = os.path.join(mount_point, "etc/portage/package.use/genpack")
         if not os.path.isfile(use_file):
             logging.info("Creating package.use for genpack")
-            subprocess.run(sudo(['mkdir', '-p', os.path.dirname(use_file)]), check=True)
-            tee = subprocess.Popen(sudo(['tee', use_file]), stdin=subprocess.PIPE, text=True)
-            tee.stdin.write("sys-kernel/installkernel dracut\n")
-            tee.stdin.close()
-            tee.wait()
-        overlay_checkfiles = os.listdir(genpack_overlay_dir)
-        overlay_checkfiles.remove(".git")
-        overlay_checkfiles.append(".git/ORIG_HEAD")
-        return get_latest_mtime(*(os.path.join(genpack_overlay_dir, f) for f in overlay_checkfiles if os.path.exists(os.path.join(genpack_overlay_dir, f))))
+            priv_mkdir(os.path.dirname(use_file))
+            priv_write(use_file, "sys-kernel/installkernel dracut\n")
+    return get_git_head(genpack_overlay_dir) # None if overlay-override is not a git repository
 
+@trace_phase("apply portage sets and flags")
 def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packages, devel_packages, accept_keywords, use, license, mask):
     with TempMount(lower_image) as mount_point:
         if accept_keywords is None: accept_keywords = {}
@@ -329,28 +897,16 @@ def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packag
         sets_dir = os.path.join(etc_portage_dir, "sets")
 
         runtime_packages_file = os.path.join(sets_dir, "genpack-runtime")
-        subprocess.run(sudo(["chroot", mount_point, "mkdir", "-p", "/etc/portage/sets"]), check=True)
+        priv_mkdir(sets_dir)
         logging.info(f"Applying runtime packages to {runtime_packages_file}")
-        tee = subprocess.Popen(sudo(['tee', runtime_packages_file]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-        try:
-            for pkg in runtime_packages:
-                tee.stdin.write(f"{pkg}\n")
-        finally:
-            tee.stdin.close()
-            tee.wait()
+        priv_write(runtime_packages_file, "".join(f"{pkg}\n" for pkg in runtime_packages))
         
         if not isinstance(buildtime_packages, list):
             raise ValueError("buildtime_packages must be a list or None")
         #else
         buildtime_packages_file = os.path.join(sets_dir, "genpack-buildtime")
         logging.info(f"Applying buildtime packages to {buildtime_packages_file}")
-        tee = subprocess.Popen(sudo(['tee', buildtime_packages_file]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-        try:
-            for pkg in buildtime_packages:
-                tee.stdin.write(f"{pkg}\n")
-        finally:
-            tee.stdin.close()
-            tee.wait()
+        priv_write(buildtime_packages_file, "".join(f"{pkg}\n" for pkg in buildtime_packages))
 
         if devel_packages is not None:        
             if not isinstance(devel_packages, list):
@@ -358,147 +914,157 @@ def apply_portage_sets_and_flags(lower_image, runtime_packages, buildtime_packag
             #else
             devel_packages_file = os.path.join(sets_dir, "genpack-devel")
             logging.info(f"Applying devel packages to {devel_packages_file}")
-            tee = subprocess.Popen(sudo(['tee', devel_packages_file]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-            try:
-                for pkg in devel_packages:
-                    tee.stdin.write(f"{pkg}\n")
-            finally:
-                tee.stdin.close()
-                tee.wait()
+            priv_write(devel_packages_file, "".join(f"{pkg}\n" for pkg in devel_packages))
         else:
-            subprocess.run(sudo(['rm', '-f', os.path.join(sets_dir, "genpack-devel")]), check=True)
+            priv_remove(os.path.join(sets_dir, "genpack-devel"))
+
+        def package_flags(flags):
+            lines = []
+            for k, v in flags.items():
+                if v is None:
+                    lines.append(f"{k}\n")
+                elif isinstance(v, list):
+                    lines.append(f"{k} {' '.join(v)}\n")
+                else:
+                    lines.append(f"{k} {v}\n")
+            return "".join(lines)
 
         if not isinstance(accept_keywords, dict):
             raise ValueError("accept_keywords must be a dictionary")
         accept_keywords_file = os.path.join(etc_portage_dir, "package.accept_keywords/genpack")
         logging.info(f"Applying accept keywords to {accept_keywords_file}")
-        subprocess.run(sudo(['mkdir', '-p', os.path.dirname(accept_keywords_file)]), check=True)
-        tee = subprocess.Popen(sudo(['tee', accept_keywords_file]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-        try:
-            for k, v in accept_keywords.items():
-                if v is None:
-                    tee.stdin.write(f"{k}\n")
-                elif isinstance(v, list):
-                    tee.stdin.write(f"{k} {' '.join(v)}\n")
-                else:
-                    tee.stdin.write(f"{k} {v}\n")
-        finally:
-            tee.stdin.close()
-            tee.wait()
+        priv_mkdir(os.path.dirname(accept_keywords_file))
+        priv_write(accept_keywords_file, package_flags(accept_keywords))
 
         if not isinstance(use, dict):
             raise ValueError("use must be a dictionary")
         use_file = os.path.join(etc_portage_dir, "package.use/genpack")
         logging.info(f"Applying USE flags to {use_file}")
-        subprocess.run(sudo(['mkdir', '-p', os.path.dirname(use_file)]), check=True)
-        tee = subprocess.Popen(sudo(['tee', use_file]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-        try:
-            for k, v in use.items():
-                if v is None:
-                    tee.stdin.write(f"{k}\n")
-                elif isinstance(v, list):
-                    tee.stdin.write(f"{k} {' '.join(v)}\n")
-                else:
-                    tee.stdin.write(f"{k} {v}\n")
-        finally:
-            tee.stdin.close()
-            tee.wait()
+        priv_mkdir(os.path.dirname(use_file))
+        priv_write(use_file, package_flags(use))
 
         if not isinstance(license, dict):
             raise ValueError("license must be a dictionary")
         license_file = os.path.join(etc_portage_dir, "package.license/genpack")
         logging.info(f"Applying LICENSE flags to {license_file}")
-        subprocess.run(sudo(['mkdir', '-p', os.path.dirname(license_file)]), check=True)
-        tee = subprocess.Popen(sudo(['tee', license_file]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-        try:
-            for k, v in license.items():
-                if v is None:
-                    tee.stdin.write(f"{k}\n")
-                elif isinstance(v, list):
-                    tee.stdin.write(f"{k} {' '.join(v)}\n")
-                else:
-                    tee.stdin.write(f"{k} {v}\n")
-        finally:
-            tee.stdin.close()
-            tee.wait()
+        priv_mkdir(os.path.dirname(license_file))
+        priv_write(license_file, package_flags(license))
 
         if not isinstance(mask, list):
             raise ValueError("mask must be a list")
         mask_file = os.path.join(etc_portage_dir, "package.mask/genpack")
         logging.info(f"Applying masked packages to {mask_file}")
-        subprocess.run(sudo(['mkdir', '-p', os.path.dirname(mask_file)]), check=True)
-        tee = subprocess.Popen(sudo(['tee', mask_file]), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
-        try:
-            for pkg in mask:
-                tee.stdin.write(f"{pkg}\n")
-        finally:
-            tee.stdin.close()
-            tee.wait()
+        priv_mkdir(os.path.dirname(mask_file))
+        priv_write(mask_file, "".join(f"{pkg}\n" for pkg in mask))
 
         # apply savedconfig
         savedconfig_dir = os.path.join(etc_portage_dir, "savedconfig")
         if os.path.isdir("savedconfig"):
             logging.info(f"Installing savedconfig...")
-            subprocess.run(sudo(['rsync', '-rlptD', "--delete", "savedconfig", etc_portage_dir]), check=True)
+            run_command(sudo(['rsync', '-rlptD', "--delete", "savedconfig", etc_portage_dir]), check=True)
         elif os.path.exists(savedconfig_dir):
             logging.info(f"Removing existing savedconfig directory {savedconfig_dir}")
-            subprocess.run(sudo(['rm', '-rf', savedconfig_dir]), check=True)
+            priv_remove(savedconfig_dir)
 
         # apply patches
         patches_dir = os.path.join(etc_portage_dir, "patches")
         if os.path.isdir("patches"):
             logging.info(f"Installing patches...")
-            subprocess.run(sudo(['rsync', '-rlptD', "--delete", "patches", etc_portage_dir]), check=True)
+            run_command(sudo(['rsync', '-rlptD', "--delete", "patches", etc_portage_dir]), check=True)
         elif os.path.exists(patches_dir):
             logging.info(f"Removing existing patches directory {patches_dir}")
-            subprocess.run(sudo(['rm', '-rf', patches_dir]), check=True)
+            priv_remove(patches_dir)
         
         # apply kernel config
         kernel_dir = os.path.join(etc_dir, "kernel")
         if os.path.isdir("kernel"):
             logging.info(f"Installing kernel config...")
-            subprocess.run(sudo(['rsync', '-rlptD', "--delete", "kernel", etc_dir]), check=True)
+            run_command(sudo(['rsync', '-rlptD', "--delete", "kernel", etc_dir]), check=True)
         elif os.path.exists(kernel_dir):
             logging.info(f"Removing existing kernel directory {kernel_dir}")
-            subprocess.run(sudo(['rm', '-rf', kernel_dir]), check=True)
+            priv_remove(kernel_dir)
         
         # apply local overlay
         overlay_dir = os.path.join(mount_point, "var/db/repos/genpack-local-overlay")
         repos_conf = os.path.join(etc_portage_dir, "repos.conf/genpack-local-overlay.conf")
         if os.path.isdir("overlay"):
             logging.info(f"Installing local overlay...")
-            subprocess.run(sudo(['rsync', '-rlptD', "--delete", "overlay/", overlay_dir]), check=True)
+            # metadata cache generated in the image is kept. rsync preserves mtimes so the cache can tell which ebuilds have changed
+            run_command(sudo(['rsync', '-rlptD', "--delete", "--exclude", "/metadata/md5-cache", "overlay/", overlay_dir]), check=True)
+            priv_mkdir(os.path.join(overlay_dir, "metadata/md5-cache")) # portage picks md5-dict cache format when this exists
             if not os.path.isfile(repos_conf):
-                subprocess.run(sudo(['mkdir', '-p', os.path.dirname(repos_conf)]), check=True)
-                tee = subprocess.Popen(sudo(['tee', repos_conf]), stdin=subprocess.PIPE, text=True)
-                try:
-                    tee.stdin.write("[genpack-local-overlay]\nlocation=/var/db/repos/genpack-local-overlay\n")
-                finally:
-                    tee.stdin.close()
-                    tee.wait()
+                priv_mkdir(os.path.dirname(repos_conf))
+                priv_write(repos_conf, "[genpack-local-overlay]\nlocation=/var/db/repos/genpack-local-overlay\n")
             layout_conf = os.path.join(overlay_dir, "metadata/layout.conf")
             if not os.path.exists(layout_conf):
                 logging.info(f"Creating layout.conf for local overlay")
-                subprocess.run(sudo(['mkdir', '-p', os.path.dirname(layout_conf)]), check=True)
-                tee = subprocess.Popen(sudo(['tee', layout_conf]), stdin=subprocess.PIPE, text=True)
-                try:
-                    tee.stdin.write("masters = gentoo\n")
-                finally:
-                    tee.stdin.close()
-                    tee.wait()
+                priv_mkdir(os.path.dirname(layout_conf))
+                priv_write(layout_conf, "masters = gentoo\n")
             repo_name = os.path.join(overlay_dir, "profiles/repo_name")
             if not os.path.exists(repo_name):
                 logging.info(f"Creating repo_name for local overlay")
-                subprocess.run(sudo(['mkdir', '-p', os.path.dirname(repo_name)]), check=True)
-                tee = subprocess.Popen(sudo(['tee', repo_name]), stdin=subprocess.PIPE, text=True)
-                try:
-                    tee.stdin.write("genpack-local-overlay\n")
-                finally:
-                    tee.stdin.close()
-                    tee.wait()
+                priv_mkdir(os.path.dirname(repo_name))
+                priv_write(repo_name, "genpack-local-overlay\n")
         elif os.path.exists(overlay_dir):
             logging.info(f"Removing existing local overlay directory {overlay_dir}")
-            subprocess.run(sudo(['rm', '-rf', overlay_dir, repos_conf]), check=True)
+            priv_remove(overlay_dir, repos_conf)
+
+def count_metadata_cache_entries(md5_cache_dir, since):
+    """Return number of entries in md5-cache directory and how many of them were written at or after since."""
+    total = updated = 0
+    for root, dirs, files in os.walk(md5_cache_dir):
+        for f in files:
+            total += 1
+            if os.stat(os.path.join(root, f)).st_mtime >= since: updated += 1
+    return total, updated
+
+@trace_phase("regenerate metadata cache")
+def regenerate_metadata_cache(lower_image):
+    """Update metadata cache of genpack-overlay and local overlay so that emerge doesn't have to source their ebuilds
+    in every dependency calculation. egencache only regenerates entries whose ebuild or eclasses have changed."""
+    repos = []
+    if overlay_override is None: # don't write root-owned files into user's working tree
+        os.makedirs(os.path.join(get_genpack_overlay_dir(), "metadata/md5-cache"), exist_ok=True)
+        git_exclude = os.path.join(get_genpack_overlay_checkout(), ".git/info/exclude") # shared by its worktrees
+        if "/metadata/md5-cache\n" not in (open(git_exclude).read() if os.path.isfile(git_exclude) else ""):
+            os.makedirs(os.path.dirname(git_exclude), exist_ok=True)
+            with open(git_exclude, "a") as f:
+                f.write("/metadata/md5-cache\n")
+        repos.append("genpack-overlay")
+    if os.path.isdir("overlay"):
+        repos.append("genpack-local-overlay")
+    if len(repos) == 0: return
+    #else
+    egencache_cmd = " && ".join(f"egencache --update --tolerant --repo={repo} --jobs={os.cpu_count() or 1}" for repo in repos)
+    with contextlib.ExitStack() as stack:
+        if "genpack-overlay" in repos:
+            # the worktree of genpack-overlay may be shared with other genpack processes building from the same commit
+            cache_fd = os.open(os.path.join(get_genpack_overlay_dir(), "metadata/md5-cache"), os.O_RDONLY | os.O_DIRECTORY)
+            stack.callback(os.close, cache_fd)
+            try:
+                fcntl.flock(cache_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Waiting for another genpack process regenerating metadata cache of genpack-overlay...")
+                fcntl.flock(cache_fd, fcntl.LOCK_EX)
+        started = time.time()
+        lower_exec(lower_image, ["sh", "-c", egencache_cmd])
+        elapsed = time.time() - started
+
+    counts = {}
+    if "genpack-overlay" in repos:
+        counts["genpack-overlay"] = count_metadata_cache_entries(os.path.join(get_genpack_overlay_dir(), "metadata/md5-cache"), started)
+    if "genpack-local-overlay" in repos:
+        with TempMount(lower_image) as mount_point:
+            counts["genpack-local-overlay"] = count_metadata_cache_entries(os.path.join(mount_point, "var/db/repos/genpack-local-overlay/metadata/md5-cache"), started)
+    for repo, (total, updated) in counts.items():
+        logging.info(f"{repo}: {updated} of {total} metadata cache entries regenerated.")
+    total = sum(total for total, updated in counts.values())
+    updated = sum(updated for total, updated in counts.values())
+    if updated > 0 and total > updated:
+        # extrapolated from cost of sourcing an ebuild in this run, for every ebuild served from cache. not measured
+        logging.info(f"Metadata cache generation took {elapsed:.1f}s, saving an estimated {(total - updated) * elapsed / updated:.1f}s of ebuild sourcing in each dependency calculation.")
+    else:
+        logging.info(f"Metadata cache generation took {elapsed:.1f}s.")
 
 def set_gentoo_profile(lower_image, profile_name):
     with TempMount(lower_image) as mount_point:
@@ -537,7 +1103,7 @@ def set_gentoo_profile(lower_image, profile_name):
         #else
         exact_profile = os.path.join(f"default/linux/{portage_arch[0]}/{latest_subdir}", portage_arch[1] if len(portage_arch) > 1 else "", profile_name)
         logging.info(f"Setting Gentoo profile to {exact_profile} in {mount_point}")
-        subprocess.run(sudo(['chroot', mount_point, "eselect", "profile", "set", exact_profile]), check=True)
+        priv_chroot(mount_point, ["eselect", "profile", "set", exact_profile])
         logging.info(f"Gentoo profile set to {exact_profile} successfully.")
 
 def load_genpack_json(directory="."):
@@ -545,6 +1111,7 @@ def load_genpack_json(directory="."):
 
     genpack_json5 = os.path.join(directory, "genpack.json5")
     if os.path.isfile(genpack_json5):
+        import json5
         json_parser = json5
         json_file = genpack_json5
     genpack_json = os.path.join(directory, "genpack.json")
@@ -711,40 +1278,217 @@ def merge_genpack_json(trunk, branch, path, allowed_properties = ["outfile","dev
                 "services","arch"
             ])
 
+def parse_emerge_log(lines, since=0):
+    """Extract per-package emerge records from lines of emerge.log written at or after the unix time `since`."""
+    records = []
+    in_progress = {}
+    for line in lines:
+        match = re.match(r'^(\d+):\s+(.*)$', line)
+        if match is None: continue
+        #else
+        timestamp, message = int(match.group(1)), match.group(2)
+        if timestamp < since: continue
+        #else
+        if match := re.match(r'^>>> emerge \(\d+ of \d+\) (\S+) to ', message):
+            package = match.group(1)
+            if package in in_progress: in_progress.pop(package)["status"] = "failed"
+            record = {"package": package, "kind": None, "status": "in-progress", "start": timestamp, "end": None,
+                      "duration": None, "fetch": None, "build": None}
+            records.append(record)
+            in_progress[package] = record
+        elif match := re.match(r'^=== \(\d+ of \d+\) (Compiling/Merging|Fetching Binary|Merging Binary) \(([^:]+)::', message):
+            step, record = match.group(1), in_progress.get(match.group(2), None)
+            if record is None: continue
+            #else
+            if step == "Compiling/Merging":
+                record["kind"], record["build_start"] = "source", timestamp
+            elif step == "Fetching Binary":
+                record["kind"], record["fetch_start"] = "binary", timestamp
+            else:
+                record["kind"], record["build_start"] = "binary", timestamp
+                if "fetch_start" in record: record["fetch"] = timestamp - record["fetch_start"]
+        elif match := re.match(r'^::: completed emerge \(\d+ of \d+\) (\S+) to ', message):
+            record = in_progress.pop(match.group(1), None)
+            if record is None: continue
+            #else
+            record["status"], record["end"], record["duration"] = "completed", timestamp, timestamp - record["start"]
+            if "build_start" in record: record["build"] = timestamp - record["build_start"]
+        elif message.startswith("*** exiting"):
+            for record in in_progress.values(): record["status"] = "failed"
+            in_progress.clear()
+    for record in records:
+        record.pop("fetch_start", None)
+        record.pop("build_start", None)
+        if record["status"] == "in-progress": record["status"] = "failed"
+    return records
+
+def report_emerge_metrics(records, metrics_file, top=10):
+    with open(metrics_file, "w") as f:
+        json.dump(records, f, indent=2)
+    if len(records) == 0:
+        logging.info("No packages were emerged.")
+        return
+    #else
+    completed = [record for record in records if record["status"] == "completed"]
+    num_binary = len([record for record in completed if record["kind"] == "binary"])
+    num_source = len([record for record in completed if record["kind"] == "source"])
+    build_time = sum(record["build"] or 0 for record in completed if record["kind"] == "source")
+    logging.info(f"Emerged {len(completed)} packages: {num_binary} from binary packages, {num_source} compiled in {build_time // 60} minutes, "
+                 f"{len(records) - len(completed)} failed. Metrics saved to {metrics_file}")
+    slowest = sorted(completed, key=lambda record: record["duration"], reverse=True)[:top]
+    if len(slowest) > 0:
+        logging.info("Slowest packages:\n" + "\n".join(f"{record['duration']:>7}s  {record['kind'] or '?':<6}  {record['package']}" for record in slowest))
+
+class LowerCheckpoint:
+    """Phases of lower() completed so far, so that a failed lower() resumes where it stopped.
+    Checkpoint is valid only while the inputs of lower() stay the same."""
+    def __init__(self, checkpoint_file, inputs):
+        self.checkpoint_file = checkpoint_file
+        self.inputs = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+        self.completed = []
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("inputs") == self.inputs:
+                self.completed = checkpoint.get("completed", [])
+            else:
+                logging.info("Inputs of lower layer have changed since the last failed run, starting over.")
+        if len(self.completed) > 0:
+            logging.info(f"Resuming lower layer, already completed: {', '.join(self.completed)}")
+
+    def done(self, phase):
+        if phase in self.completed:
+            logging.info(f"Skipping {phase}, completed in a previous run.")
+            return True
+        #else
+        return False
+
+    def complete(self, phase):
+        self.completed.append(phase)
+        LowerCheckpoint.save(self.checkpoint_file, self.inputs, self.completed)
+
+    @staticmethod
+    def save(checkpoint_file, inputs, completed):
+        with open(checkpoint_file + ".tmp", "w") as f:
+            json.dump({"inputs": inputs, "completed": completed}, f)
+        os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+    def remove(self):
+        if os.path.exists(self.checkpoint_file): os.remove(self.checkpoint_file)
+
+def list_lower_snapshots(variant):
+    if not os.path.isdir(variant.lower_snapshots): return []
+    #else
+    # names start with sequence number, so they sort in the order taken
+    return sorted(os.path.join(variant.lower_snapshots, f) for f in os.listdir(variant.lower_snapshots) if f.endswith(".img"))
+
+@trace_phase("snapshot lower image")
+def snapshot_lower_image(variant, phase, checkpoint):
+    """Save a copy-on-write copy of lower image taken before phase, along with the checkpoint state to resume from.
+    Returns False if the snapshot was not taken because reflink is not available and full copies are not allowed."""
+    global lower_snapshot_keep
+    os.makedirs(variant.lower_snapshots, exist_ok=True)
+    snapshots = list_lower_snapshots(variant)
+    sequence = int(os.path.basename(snapshots[-1]).split("-")[0]) + 1 if len(snapshots) > 0 else 0
+    snapshot = os.path.join(variant.lower_snapshots, f"{sequence:06d}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{phase}.img")
+    started = time.monotonic()
+    if run_command(["cp", "--reflink=always", variant.lower_image, snapshot + ".tmp"], stderr=subprocess.DEVNULL).returncode != 0:
+        if os.path.exists(snapshot + ".tmp"): os.remove(snapshot + ".tmp")
+        if not lower_snapshot_full_copy:
+            # a full copy of a lower image before each phase costs minutes and gigabytes
+            logging.warning("Filesystem of work directory does not support reflink, lower image snapshots are disabled. "
+                            "Use --lower-snapshot-full-copy to take full copies instead.")
+            lower_snapshot_keep = 0
+            return False
+        #else
+        logging.info("Filesystem of work directory does not support reflink, taking a sparse full copy of lower image.")
+        run_command(["cp", "--reflink=never", "--sparse=always", variant.lower_image, snapshot + ".tmp"], check=True)
+    os.replace(snapshot + ".tmp", snapshot)
+    with open(snapshot[:-len(".img")] + ".json", "w") as f:
+        json.dump({"phase": phase, "inputs": checkpoint.inputs, "completed": checkpoint.completed}, f)
+    logging.info(f"Took snapshot of lower image before {phase} in {time.monotonic() - started:.1f}s.")
+
+    for old in list_lower_snapshots(variant)[:-lower_snapshot_keep]:
+        logging.debug(f"Removing old lower image snapshot {old}")
+        os.remove(old)
+        if os.path.exists(old[:-len(".img")] + ".json"): os.remove(old[:-len(".img")] + ".json")
+    return True
+
+def rollback_lower_image(variant):
+    """Replace lower image with its latest snapshot. The next lower() resumes from the phase the snapshot was taken before."""
+    snapshots = list_lower_snapshots(variant)
+    if len(snapshots) == 0:
+        raise FileNotFoundError(f"No snapshot of lower image found in {variant.lower_snapshots}.")
+    #else
+    snapshot = snapshots[-1]
+    with open(snapshot[:-len(".img")] + ".json") as f:
+        metadata = json.load(f)
+    os.replace(snapshot, variant.lower_image) # snapshot is consumed, rolling back again goes further back
+    os.remove(snapshot[:-len(".img")] + ".json")
+    LowerCheckpoint.save(variant.lower_checkpoint, metadata["inputs"], metadata["completed"])
+    for stale in [variant.lower_files, variant.lower_index]:
+        if os.path.exists(stale): os.remove(stale)
+    logging.info(f"Lower image rolled back to the state before {metadata['phase']}, {len(snapshots) - 1} older snapshot(s) left.")
+
+@contextlib.contextmanager
+def lower_snapshot(variant, phase, checkpoint):
+    """Take snapshot of lower image before a phase which may leave it broken, and restore it if the phase fails with auto rollback enabled."""
+    if lower_snapshot_keep <= 0 or not snapshot_lower_image(variant, phase, checkpoint):
+        yield
+        return
+    #else
+    try:
+        yield
+    except Exception:
+        if auto_rollback:
+            logging.error(f"{phase} failed, rolling back lower image.")
+            rollback_lower_image(variant)
+        raise
+
+@trace_phase("lower")
 def lower(variant=None, devel=False):
     logging.info("Processing lower layer...")
     os.makedirs(work_dir, exist_ok=True)
     # todo: create .gitignore in work_root
     stage3_is_new = False
-    stage3_url = get_latest_stage3_tarball_url()
-    logging.info(f"Latest stage3 tarball URL: {stage3_url}")
-    stage3_headers = get_headers(stage3_url)
     stage3_tarball = os.path.join(work_dir, "stage3.tar.xz")
     stage3_saved_headers_path = os.path.join(work_dir, "stage3.tar.xz.headers")
     stage3_saved_headers = open(stage3_saved_headers_path).read().strip() if os.path.isfile(stage3_saved_headers_path) else None
-    if stage3_saved_headers != headers_to_info(stage3_headers):
-        logging.info("Stage3 tarball info has changed, downloading new tarball.")
-        stage3_headers = download(stage3_url, stage3_tarball)
-        stage3_is_new = True
-    
     portage_is_new = False
-    portage_url = get_latest_portage_tarball_url()
-    logging.info(f"Latest portage tarball URL: {portage_url}")
-    portage_headers = get_headers(portage_url)
     portage_tarball = os.path.join(work_root, "portage.tar.xz") # because portage tarball is not architecture specific
     portage_saved_headers_path = os.path.join(work_root, "portage.tar.xz.headers")
     portage_saved_headers = open(portage_saved_headers_path).read().strip() if os.path.isfile(portage_saved_headers_path) else None
-    if portage_saved_headers != headers_to_info(portage_headers):
-        logging.info("Portage tarball info has changed, downloading new tarball.")
-        portage_headers = download(portage_url, portage_tarball)
-        portage_is_new = True
+
+    if offline:
+        if not os.path.isfile(stage3_tarball) or not os.path.isfile(portage_tarball):
+            raise FileNotFoundError(f"{stage3_tarball} and {portage_tarball} are required in offline mode. Please run 'lower' online first.")
+        #else
+        logging.info("Offline mode, using previously downloaded stage3 and portage tarballs.")
+        stage3_headers = portage_headers = None
+    else:
+        stage3_url = get_latest_stage3_tarball_url()
+        logging.info(f"Latest stage3 tarball URL: {stage3_url}")
+        stage3_headers = get_headers(stage3_url)
+        if stage3_saved_headers != headers_to_info(stage3_headers):
+            logging.info("Stage3 tarball info has changed, downloading new tarball.")
+            stage3_headers = download(stage3_url, stage3_tarball)
+            stage3_is_new = True
+
+        portage_url = get_latest_portage_tarball_url()
+        logging.info(f"Latest portage tarball URL: {portage_url}")
+        portage_headers = get_headers(portage_url)
+        if portage_saved_headers != headers_to_info(portage_headers):
+            logging.info("Portage tarball info has changed, downloading new tarball.")
+            portage_headers = download(portage_url, portage_tarball)
+            portage_is_new = True
 
     image_is_new = False
     if stage3_is_new or not os.path.isfile(variant.lower_image):
         setup_lower_image(variant.lower_image, stage3_tarball, portage_tarball)
         image_is_new = True
-        with open(stage3_saved_headers_path, 'w') as f:
-            f.write(headers_to_info(stage3_headers))
+        if stage3_headers is not None:
+            with open(stage3_saved_headers_path, 'w') as f:
+                f.write(headers_to_info(stage3_headers))
     elif portage_is_new:
         replace_portage(variant.lower_image, portage_tarball)
 
@@ -752,13 +1496,16 @@ def lower(variant=None, devel=False):
         with open(portage_saved_headers_path, 'w') as f:
             f.write(headers_to_info(portage_headers))
     
-    latest_mtime = sync_genpack_overlay(variant.lower_image)
-    logging.debug(f"Latest genpack-overlay mtime: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(latest_mtime))}")
-    logging.debug(f"lower_files time: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(variant.lower_files))) if os.path.exists(variant.lower_files) else 'N/A'}")
+    overlay_head = sync_genpack_overlay(variant.lower_image)
+    lower_overlay_head = open(variant.overlay_head).read().strip() if os.path.isfile(variant.overlay_head) else None
+    logging.debug(f"genpack-overlay HEAD: {overlay_head}, at last lower: {lower_overlay_head}")
+    overlay_is_new = overlay_head is not None and overlay_head != lower_overlay_head
 
-    if os.path.exists(variant.lower_files) and (stage3_is_new or portage_is_new or os.path.getmtime(variant.lower_files) < latest_mtime):
-        logging.info(f"Removing old {variant.lower_files} file due to changes in stage3 or portage.")
+    if os.path.exists(variant.lower_files) and (stage3_is_new or portage_is_new or overlay_is_new):
+        logging.info(f"Removing old {variant.lower_files} file due to changes in stage3, portage or genpack-overlay.")
         os.remove(variant.lower_files)
+    if image_is_new and os.path.exists(variant.lower_checkpoint):
+        os.remove(variant.lower_checkpoint) # phases completed in the previous image are gone
 
     if os.path.exists(variant.lower_files):
         logging.info("Lower image is up-to-date, skipping.")
@@ -776,12 +1523,16 @@ def lower(variant=None, devel=False):
             "sys-libs/glibc": "audit", # Intentionally causing glibc to be rebuilt
             "sys-kernel/installkernel":"dracut", # genpack depends on dracut
             "sys-fs/squashfs-tools":"lz4 lzma lzo xattr zstd", # genpack uses lz4, lzma, lzo and zstd compression for squashfs
+            "sys-fs/erofs-utils":"lz4 lzma zstd", # for "format": "erofs"
             "app-crypt/libb2":"-openmp", # openmp support brings gcc dependency, which is not generally needed for genpack
             "dev-lang/perl":"minimal",
             "app-editors/vim":"minimal"
         }
     }
 
+    if get_output_format() == "erofs":
+        merged_genpack_json["buildtime_packages"] = ["sys-fs/erofs-utils"]
+
     # merge mixins
     for mixin_id in mixins:
         if mixin_id in mixin_genpack_json:
@@ -798,6 +1549,14 @@ def lower(variant=None, devel=False):
 
     devel = devel or merged_genpack_json.get("devel", False)
 
+    checkpoint = LowerCheckpoint(variant.lower_checkpoint, {
+        "genpack_json": merged_genpack_json, "devel": devel, "circulardep_breaker": genpack_json.get("circulardep_breaker", None),
+        "deep_depclean": deep_depclean, "independent_binpkgs": independent_binpkgs, "overlay_head": overlay_head,
+        "stage3": stage3_saved_headers if stage3_headers is None else headers_to_info(stage3_headers),
+        "portage": portage_saved_headers if portage_headers is None else headers_to_info(portage_headers),
+        "local_files": get_latest_mtime("savedconfig", "patches", "kernel", "overlay"),
+    })
+
     apply_portage_sets_and_flags(variant.lower_image, 
                                 merged_genpack_json.get("packages", []),
                                 merged_genpack_json.get("buildtime_packages", []),
@@ -806,6 +1565,7 @@ def lower(variant=None, devel=False):
                                 merged_genpack_json.get("use", {}), 
                                 merged_genpack_json.get("license", {}), 
                                 merged_genpack_json.get("mask", []))
+    regenerate_metadata_cache(variant.lower_image)
 
     # binpkg_excludes
     binpkg_excludes = merged_genpack_json.get("binpkg_excludes", [])
@@ -814,62 +1574,83 @@ def lower(variant=None, devel=False):
     elif not isinstance(binpkg_excludes, list):
         raise ValueError("binpkg-excludes must be a string or a list of strings")
 
+    emerge_started = int(time.time()) # emerge.log timestamps have one second resolution
+
     # circular dependency breaker
     if "circulardep-breaker" in genpack_json:
         raise ValueError("Use circulardep_breaker instead of circulardep-breaker in genpack.json")
     if "circulardep_breaker" in genpack_json:
         circulardep_breaker_packages = genpack_json["circulardep_breaker"].get("packages", [])
         circulardep_breaker_use = genpack_json["circulardep_breaker"].get("use", None)
-        if len(circulardep_breaker_packages) > 0:
-            logging.info("Emerging circular dependency breaker packages...")
-            env = {"USE": circulardep_breaker_use} if circulardep_breaker_use is not None else None
-            emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-u", "--keep-going"]
+        if len(circulardep_breaker_packages) > 0 and not checkpoint.done("circulardep-breaker"):
+            with lower_snapshot(variant, "circulardep-breaker", checkpoint):
+                logging.info("Emerging circular dependency breaker packages...")
+                env = {"USE": circulardep_breaker_use} if circulardep_breaker_use is not None else None
+                emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-u", "--keep-going"]
+                if len(binpkg_excludes) > 0:
+                    emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
+                    emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
+                if offline: emerge_cmd.append("--getbinpkg=n") # binhost may be enabled in make.conf
+                emerge_cmd += circulardep_breaker_packages
+                lower_exec(variant.lower_image, emerge_cmd, env)
+                checkpoint.complete("circulardep-breaker")
+
+    if not checkpoint.done("world"):
+        with lower_snapshot(variant, "world", checkpoint):
+            logging.info("Emerging all packages...")
+            emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "--keep-going"]
+            if len(binpkg_excludes) > 0:
+                emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
+                emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
+            if offline: emerge_cmd.append("--getbinpkg=n")
+            emerge_cmd += ["@world", "genpack-progs", "@genpack-runtime", "@genpack-buildtime"]
+            if devel:
+                emerge_cmd += ["@genpack-devel"]
+            lower_exec(variant.lower_image, emerge_cmd)
+            checkpoint.complete("world")
+
+    if not checkpoint.done("kernel-modules"):
+        logging.info("Rebuilding kernel modules if necessary...")
+        lower_exec(variant.lower_image, ["rebuild-kernel-modules-if-necessary"])
+        checkpoint.complete("kernel-modules")
+
+    if not checkpoint.done("preserved-rebuild"):
+        with lower_snapshot(variant, "preserved-rebuild", checkpoint):
+            logging.info("Rebuilding preserved packages...")
+            emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y"]
             if len(binpkg_excludes) > 0:
                 emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
                 emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
-            emerge_cmd += circulardep_breaker_packages
-            lower_exec(variant.lower_image, emerge_cmd, env)
-
-    logging.info("Emerging all packages...")
-    emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y", "-uDN", "--keep-going"]
-    if len(binpkg_excludes) > 0:
-        emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
-        emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
-    emerge_cmd += ["@world", "genpack-progs", "@genpack-runtime", "@genpack-buildtime"]
-    if devel:
-        emerge_cmd += ["@genpack-devel"]
-    lower_exec(variant.lower_image, emerge_cmd)
-    logging.info("Rebuilding kernel modules if necessary...")
-    lower_exec(variant.lower_image, ["rebuild-kernel-modules-if-necessary"])
-
-    logging.info("Rebuilding preserved packages...")
-    emerge_cmd = ["emerge", "-bk", "--binpkg-respect-use=y"]
-    if len(binpkg_excludes) > 0:
-        emerge_cmd += ["--usepkg-exclude", " ".join(binpkg_excludes)]
-        emerge_cmd += ["--buildpkg-exclude", " ".join(binpkg_excludes)]
-    emerge_cmd += ["@preserved-rebuild"]
-    lower_exec(variant.lower_image, emerge_cmd)
-
-    logging.info("Unmerging masked packages...")
-    lower_exec(variant.lower_image, ["unmerge-masked-packages"])
-
-    logging.info("Cleaning up...")
-    cleanup_cmd = "emerge --depclean"
-    if deep_depclean:
-        cleanup_cmd += " --with-bdeps=n"
-    cleanup_cmd += " && etc-update --automode -5"
-    cleanup_cmd += " && eclean-dist -d"
-    cleanup_cmd += " && eclean-pkg"
-    if independent_binpkgs:
-        cleanup_cmd += " -d" # with independent binpkgs, we can clean up binpkgs more aggressively
-    lower_exec(variant.lower_image, ["sh", "-c", cleanup_cmd])
+            if offline: emerge_cmd.append("--getbinpkg=n")
+            emerge_cmd += ["@preserved-rebuild"]
+            lower_exec(variant.lower_image, emerge_cmd)
+            checkpoint.complete("preserved-rebuild")
+
+    if not checkpoint.done("unmerge-masked"):
+        logging.info("Unmerging masked packages...")
+        lower_exec(variant.lower_image, ["unmerge-masked-packages"])
+        checkpoint.complete("unmerge-masked")
+
+    if not checkpoint.done("cleanup"):
+        with lower_snapshot(variant, "cleanup", checkpoint):
+            logging.info("Cleaning up...")
+            cleanup_cmd = "emerge --depclean"
+            if deep_depclean:
+                cleanup_cmd += " --with-bdeps=n"
+            cleanup_cmd += " && etc-update --automode -5"
+            cleanup_cmd += " && eclean-dist -d"
+            cleanup_cmd += " && eclean-pkg"
+            if independent_binpkgs:
+                cleanup_cmd += " -d" # with independent binpkgs, we can clean up binpkgs more aggressively
+            lower_exec(variant.lower_image, ["sh", "-c", cleanup_cmd])
+            checkpoint.complete("cleanup")
 
     files = []
     lib64_exists = None
     with TempMount(variant.lower_image) as mount_point:
         # check if lib64 exists
         lib64_exists = os.path.exists(os.path.join(mount_point, "lib64"))
-        list_pkg_files = subprocess.Popen(
+        list_pkg_files = start_command(
             sudo(["chroot", mount_point, "list-pkg-files"]), 
             stdout=subprocess.PIPE,
             text=True,
@@ -884,74 +1665,558 @@ def lower(variant=None, devel=False):
                 #else
                 files.append(line.lstrip('/'))  # remove leading slash
         finally:
-            return_code = list_pkg_files.wait()
+            return_code = wait_command(list_pkg_files)
             if return_code != 0:
                 raise subprocess.CalledProcessError(return_code, list_pkg_files.args)
+        emerge_log = run_command(sudo(["cat", os.path.join(mount_point, "var/log/emerge.log")]), stdout=subprocess.PIPE, text=True, errors="replace")
 
-    with open(variant.lower_files, "w") as f:
-        for file in ["bin", "sbin", "lib", "usr/sbin", "run", "proc", "sys", "root", "home", "tmp", "mnt",
-                     "dev", "dev/console", "dev/null"]:
-            files.append(file)
-        if lib64_exists:
-            files.append("lib64")
-        for file in sorted(files):
+    if emerge_log.returncode == 0:
+        report_emerge_metrics(parse_emerge_log(emerge_log.stdout.splitlines(), emerge_started), variant.emerge_metrics)
+    else:
+        logging.warning("Could not read var/log/emerge.log in lower image, emerge metrics are not available.")
+
+    files = write_lower_files(variant.lower_files, files, lib64_exists)
+    FileIndex.write(variant.lower_index, files, read_package_ownership(variant.lower_image))
+    if overlay_head is not None:
+        with open(variant.overlay_head, "w") as f:
+            f.write(overlay_head)
+    checkpoint.remove()
+
+def write_lower_files(lower_files, files, lib64_exists):
+    """Write files owned by packages in lower image plus essential directories to lower_files, sorted."""
+    files = files + ["bin", "sbin", "lib", "usr/sbin", "run", "proc", "sys", "root", "home", "tmp", "mnt",
+                     "dev", "dev/console", "dev/null"]
+    if lib64_exists:
+        files.append("lib64")
+    files.sort()
+    with open(lower_files, "w") as f:
+        for file in files:
             f.write(file + '\n')
+    return files
 
 def bash(variant):
     logging.info("Running bash in the lower image for debugging.")
     lower_exec(variant.lower_image, "bash")
 
-def copy_upper_files(upper_dir):
-    # copy mixin files
-    for mixin_id in mixins:
-        mixin_dir = os.path.join(mixin_root, mixin_id)
-        mixin_files = os.path.join(mixin_dir, "files")
-        if not os.path.isdir(mixin_files): continue
+def load_lower_files(lower_files):
+    """Load lower files list as a set, including all ancestor directories."""
+    files = set()
+    with open(lower_files, "r") as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'): continue
+            #else
+            files.add(line)
+            dirname = os.path.dirname(line)
+            while dirname != "":
+                files.add(dirname)
+                dirname = os.path.dirname(dirname)
+    return files
+
+class FileIndex:
+    """Sorted, front-coded and memory-mapped list of paths in lower image with their owning packages.
+    Ancestor directories of every path are included and each entry records the index of its parent directory."""
+    MAGIC = b"GPFIDX01"
+    # magic, number of entries, number of packages, restart interval, offsets of restarts, parents, owners and packages
+    HEADER = struct.Struct("=8sIII4Q")
+    RESTART_INTERVAL = 16
+    NONE = 0xffffffff
+
+    @classmethod
+    def write(cls, index_file, files, owners=None):
+        entries = set()
+        for path in files:
+            while path != "" and path not in entries:
+                entries.add(path)
+                path = os.path.dirname(path)
+        keys = sorted(os.fsencode(path) for path in entries)
+        del entries
+        positions = {key: i for i, key in enumerate(keys)}
+        packages = sorted(set(owners.values())) if owners else []
+        package_ids = {package: i for i, package in enumerate(packages)}
+
+        body = bytearray()
+        restarts, parents, owner_ids = [], [], []
+        prev = b""
+        for i, key in enumerate(keys):
+            shared = 0
+            if i % cls.RESTART_INTERVAL == 0:
+                restarts.append(cls.HEADER.size + len(body))
+            else:
+                limit = min(len(prev), len(key))
+                while shared < limit and prev[shared] == key[shared]: shared += 1
+            for value in (shared, len(key) - shared):
+                while value >= 0x80:
+                    body.append((value & 0x7f) | 0x80)
+                    value >>= 7
+                body.append(value)
+            body += key[shared:]
+            prev = key
+            parent = key.rpartition(b"/")[0]
+            parents.append(positions[parent] if parent else cls.NONE)
+            owner = owners.get(os.fsdecode(key), None) if owners else None
+            owner_ids.append(package_ids[owner] if owner is not None else cls.NONE)
+
+        restarts_offset = cls.HEADER.size + len(body)
+        parents_offset = restarts_offset + 4 * len(restarts)
+        owners_offset = parents_offset + 4 * len(parents)
+        packages_offset = owners_offset + 4 * len(owner_ids)
+        tmp_file = index_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(keys), len(packages), cls.RESTART_INTERVAL,
+                                    restarts_offset, parents_offset, owners_offset, packages_offset))
+            f.write(body)
+            for array in (restarts, parents, owner_ids):
+                f.write(struct.pack(f"={len(array)}I", *array))
+            f.write(b"\0".join(package.encode() for package in packages))
+        os.replace(tmp_file, index_file)
+
+    def __init__(self, index_file):
+        with open(index_file, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_entries, num_packages, self.restart_interval, restarts_offset, parents_offset, owners_offset, packages_offset = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{index_file} is not a genpack file index")
         #else
-        logging.info(f"Copying files from mix-in {mixin_id} to upper directory.")
-        subprocess.run(sudo(['cp', '-rdv', mixin_files + '/.', upper_dir]), check=True)
+        num_restarts = (self.num_entries + self.restart_interval - 1) // self.restart_interval
+        view = memoryview(self.mm)
+        self.restarts = view[restarts_offset:restarts_offset + 4 * num_restarts].cast("I")
+        self.parents = view[parents_offset:parents_offset + 4 * self.num_entries].cast("I")
+        self.owners = view[owners_offset:owners_offset + 4 * self.num_entries].cast("I")
+        self.packages = [package.decode() for package in self.mm[packages_offset:].split(b"\0")] if num_packages > 0 else []
+
+    def close(self):
+        for view in (self.restarts, self.parents, self.owners): view.release()
+        self.mm.close()
 
-    # copy files
-    if os.path.isdir("files"):
-        logging.info("Copying files from 'files' directory to upper directory.")
-        subprocess.run(sudo(['cp', '-rdv', 'files/.', upper_dir]), check=True)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.num_entries
+
+    def _varint(self, pos):
+        result = shift = 0
+        while True:
+            byte = self.mm[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80: return result, pos
+            shift += 7
+
+    def _restart_key(self, restart):
+        _, pos = self._varint(self.restarts[restart]) # shared length is always 0 at restart points
+        length, pos = self._varint(pos)
+        return self.mm[pos:pos + length]
+
+    def _scan(self, restart=0):
+        """Yield (index, path bytes) of entries sequentially from the restart point."""
+        i = restart * self.restart_interval
+        if i >= self.num_entries: return
+        #else
+        pos, prev = self.restarts[restart], b""
+        for i in range(i, self.num_entries):
+            shared, pos = self._varint(pos)
+            length, pos = self._varint(pos)
+            prev = prev[:shared] + self.mm[pos:pos + length]
+            pos += length
+            yield i, prev
+
+    def _seek(self, key):
+        """Yield (index, path bytes) of entries sequentially from the first entry not less than key."""
+        lo, hi = 0, len(self.restarts)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._restart_key(mid) <= key: lo = mid
+            else: hi = mid
+        for i, entry in self._scan(lo):
+            if entry >= key: yield i, entry
+
+    def find(self, path):
+        """Return index of path or None."""
+        for i, entry in self._seek(os.fsencode(path)):
+            return i if entry == os.fsencode(path) else None
+        return None
+
+    def __contains__(self, path):
+        return self.find(path) is not None
+
+    def __iter__(self):
+        for _, entry in self._scan():
+            yield os.fsdecode(entry)
+
+    def path(self, i):
+        for _, entry in itertools.islice(self._scan(i // self.restart_interval), i % self.restart_interval, None):
+            return os.fsdecode(entry)
+        raise IndexError(i)
+
+    def parent(self, i):
+        """Return index of parent directory of i-th entry or None if it is at top level."""
+        parent = self.parents[i]
+        return None if parent == self.NONE else parent
+
+    def owner(self, path):
+        """Return package owning path, or None."""
+        i = self.find(path)
+        if i is None or self.owners[i] == self.NONE: return None
+        #else
+        return self.packages[self.owners[i]]
+
+    def iter_prefix(self, prefix):
+        """Yield paths starting with prefix in sorted order."""
+        key = os.fsencode(prefix)
+        for _, entry in self._seek(key):
+            if not entry.startswith(key): break
+            #else
+            yield os.fsdecode(entry)
+
+    def difference(self, sorted_paths):
+        """Yield paths in sorted_paths (sorted by os.fsencode, as the index is) which are not in the index, in a single merge pass."""
+        entries = self._scan()
+        current = next(entries, None)
+        for path in sorted_paths:
+            key = os.fsencode(path)
+            while current is not None and current[1] < key:
+                current = next(entries, None)
+            if current is None or current[1] != key: yield path
+
+    def owners_of(self, sorted_paths):
+        """Yield owning package (or None) of each path in sorted_paths (sorted by os.fsencode), in a single merge pass."""
+        entries = self._scan()
+        current = next(entries, None)
+        for path in sorted_paths:
+            key = os.fsencode(path)
+            while current is not None and current[1] < key:
+                current = next(entries, None)
+            if current is None or current[1] != key or self.owners[current[0]] == self.NONE: yield None
+            else: yield self.packages[self.owners[current[0]]]
+
+def load_lower_index(variant):
+    """Open index of lower files, (re)building it from the text list if it is missing or older."""
+    if not os.path.isfile(variant.lower_index) or os.path.getmtime(variant.lower_index) < os.path.getmtime(variant.lower_files):
+        with open(variant.lower_files) as f:
+            files = [line.rstrip('\n') for line in f if line.strip() != "" and not line.startswith('#')]
+        FileIndex.write(variant.lower_index, files, read_package_ownership(variant.lower_image) if os.path.isfile(variant.lower_image) else None)
+    return FileIndex(variant.lower_index)
+
+def get_files_to_remove(existing_files, files_to_preserve):
+    """Return set of existing files in upper directory which are not preserved, rejecting suspicious paths."""
+    files_to_remove = existing_files - files_to_preserve
+    # safety check
+    for file in files_to_remove:
+        normalized = os.path.normpath(file)
+        if normalized.startswith("..") or normalized.startswith("/"):
+            raise ValueError(f"File to remove {file} is suspicious.")
+    return files_to_remove
+
+def resolve_upper_file_layers():
+    """Resolve mix-in files and project files into {relative path: entry}. Later layers take precedence."""
+    layers = [(f"mixin({mixin_id})", os.path.join(mixin_root, mixin_id, "files")) for mixin_id in mixins]
+    layers.append(("files", "files"))
+
+    resolved = {}
+    for layer_name, layer_dir in layers:
+        if not os.path.isdir(layer_dir): continue
+        #else
+        dirs_to_scan = [""]
+        while len(dirs_to_scan) > 0:
+            rel_dir = dirs_to_scan.pop()
+            with os.scandir(os.path.join(layer_dir, rel_dir)) as it:
+                for entry in it:
+                    path = os.path.join(rel_dir, entry.name)
+                    st = entry.stat(follow_symlinks=False)
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    link_target = os.readlink(entry.path) if entry.is_symlink() else None
+                    resolved[path] = {
+                        "layer": layer_name,
+                        "root": layer_dir,
+                        "is_dir": is_dir,
+                        # directories are compared by mode only, their mtime changes whenever contents change
+                        "source": [layer_name, st.st_mode] if is_dir else [layer_name, st.st_mode, st.st_size, st.st_mtime_ns, link_target],
+                    }
+                    if is_dir: dirs_to_scan.append(path)
+
+    # drop entries whose parent has been replaced by a non-directory in a later layer
+    for path in sorted(resolved.keys(), key=lambda p: p.count('/')):
+        parent = os.path.dirname(path)
+        if parent != "" and (parent not in resolved or not resolved[parent]["is_dir"]):
+            del resolved[path]
+
+    return resolved
+
+def get_upper_file_signature(upper_dir, path, is_dir):
+    try:
+        st = os.lstat(os.path.join(upper_dir, path))
+    except OSError:
+        return None # missing or not accessible without root privilege
+    #else
+    return [st.st_mode] if is_dir else [st.st_mode, st.st_size, st.st_mtime_ns]
+
+@trace_phase("copy files")
+def copy_upper_files(upper_dir, variant, files_to_keep=None):
+    """Incrementally sync mix-in files and project files into upper directory.
+    Files installed by the previous sync are recorded in variant.upper_files_manifest and only changed files are copied.
+    Files which disappeared from source layers are removed unless they are listed in files_to_keep.
+    Returns paths of files copied or removed."""
+    if not os.path.isdir("files"):
+        logging.info("No 'files' directory found, only mix-in files are synced.")
+    resolved = resolve_upper_file_layers()
+
+    manifest = {}
+    if os.path.isfile(variant.upper_files_manifest):
+        with open(variant.upper_files_manifest) as f:
+            manifest = json.load(f)
+
+    files_to_copy = {} # layer root -> list of paths
+    new_manifest = {}
+    for path, entry in resolved.items():
+        prev = manifest.get(path, None)
+        if prev is not None and prev["source"] == entry["source"]:
+            dest_signature = get_upper_file_signature(upper_dir, path, entry["is_dir"])
+            if dest_signature is not None and dest_signature == prev["dest"]:
+                new_manifest[path] = prev
+                continue
+        #else
+        files_to_copy.setdefault(entry["root"], []).append(path)
+
+    files_to_remove = [path for path in manifest if path not in resolved and (files_to_keep is None or path not in files_to_keep)]
+    if len(files_to_remove) > 0:
+        dirs_to_remove = sorted((path for path in files_to_remove if manifest[path].get("is_dir", False)), key=lambda p: p.count('/'), reverse=True)
+        files_to_remove = [path for path in files_to_remove if not manifest[path].get("is_dir", False)]
+        priv_remove(*(os.path.join(upper_dir, path) for path in files_to_remove))
+        for dirname in dirs_to_remove:
+            run_command(sudo(["rmdir", "--ignore-fail-on-non-empty", "--", dirname]), check=True, cwd=upper_dir)
+        files_to_remove += dirs_to_remove
+
+    num_copied = 0
+    changed = [path for path in files_to_remove if not manifest[path].get("is_dir", False)]
+    for layer_root, paths in files_to_copy.items():
+        logging.debug(f"Copying {len(paths)} files from {layer_root} to upper directory.")
+        with tempfile.NamedTemporaryFile(prefix="genpack_files_") as files_from:
+            files_from.write(b"".join(os.fsencode(path) + b'\0' for path in sorted(paths)))
+            files_from.flush()
+            run_command(sudo(["rsync", "-lptD", "--force", "--from0", f"--files-from={files_from.name}", layer_root + "/", upper_dir]), check=True)
+        for path in paths:
+            entry = resolved[path]
+            new_manifest[path] = {
+                "is_dir": entry["is_dir"],
+                "source": entry["source"],
+                "dest": get_upper_file_signature(upper_dir, path, entry["is_dir"])
+            }
+            if not entry["is_dir"]: changed.append(path)
+        num_copied += len(paths)
+
+    with open(variant.upper_files_manifest, "w") as f:
+        json.dump(new_manifest, f)
+
+    logging.info(f"Synced files to upper directory: {num_copied} copied, {len(files_to_remove)} removed, {len(resolved) - num_copied} unchanged.")
+    return changed
+
+class BuildStepTracker:
+    """Attribute files in upper directory to the build step which created or modified them last."""
+    def __init__(self, upper_dir):
+        self.upper_dir = upper_dir
+        self.attribution = {}
+        self.snapshot = self.scan()
+
+    def scan(self):
+        return {entry[0]: (entry[1], entry[5], entry[6], entry[7]) for entry in load_tree(self.upper_dir) if entry[1] != "d"}
+
+    def step_done(self, step):
+        current = self.scan()
+        for path, signature in current.items():
+            if self.snapshot.get(path, None) != signature:
+                self.attribution[path] = step
+        for path in self.snapshot:
+            if path not in current: self.attribution.pop(path, None)
+        self.snapshot = current
+        logging.debug(f"Build step {step} done, {len(self.attribution)} files attributed to build steps so far.")
+
+    def save(self, attribution_file):
+        with open(attribution_file, "w") as f:
+            json.dump(self.attribution, f)
+
+def create_upper_image(variant):
+    with open(variant.upper_image, "wb") as f:
+        f.seek(DEFAULT_UPPER_SIZE_IN_GIB * 1024 * 1024 * 1024 - 1)
+        f.write(b'\x00')
+
+    logging.info(f"Formatting filesystem on {variant.upper_image}")
+    run_command(['mkfs.ext4', variant.upper_image], check=True)
+    logging.info("Filesystem formatted successfully.")
+
+class RamUpper:
+    """Filesystem on tmpfs or zram holding upper directory of a variant instead of upper image.
+    It stays mounted until the genpack process ends so that upper() and pack() share it."""
+    def __init__(self, variant, kind, size):
+        self.variant_name = variant.name
+        self.upper_files_manifest = variant.upper_files_manifest
+        self.kind = kind
+        self.size = size
+        self.persisted = False
+        # compressed data must leave room for the build itself, zram would otherwise push the system into OOM
+        self.mem_limit = min(size, read_mem_available() * 3 // 4) if kind == "zram" else None
+        self.mount_point = tempfile.mkdtemp(prefix="genpack_ram_upper_")
+        try:
+            self.device = priv_mount_ram(self.mount_point, size, kind, self.mem_limit)
+        except Exception:
+            os.rmdir(self.mount_point)
+            raise
+
+    def holds(self, variant):
+        return variant.name == self.variant_name
+
+    def is_full(self):
+        """Whether upper directory has run out of space. On zram, reaching mem_limit shows up as I/O errors instead of ENOSPC."""
+        stat = os.statvfs(self.mount_point)
+        if stat.f_bavail * stat.f_frsize < max(self.size // 100, 64 * 1024 * 1024): return True
+        if stat.f_flag & os.ST_RDONLY: return True # remounted read-only on I/O error
+        if self.device is None: return False
+        #else
+        zram_dir = os.path.join("/sys/block", os.path.basename(self.device))
+        with open(os.path.join(zram_dir, "mm_stat")) as f:
+            mem_used_total, mem_limit = [int(field) for field in f.read().split()[2:4]]
+        with open(os.path.join(zram_dir, "io_stat")) as f:
+            failed_writes = int(f.read().split()[1])
+        return failed_writes > 0 or (mem_limit > 0 and mem_used_total >= mem_limit * 0.95)
+
+    def close(self):
+        priv_umount(self.mount_point)
+        if self.device is not None:
+            priv_release_zram(self.device)
+        os.rmdir(self.mount_point)
+
+def read_mem_available():
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"): return int(line.split()[1]) * 1024
+    return 0
+
+def start_ram_upper(variant, mode):
+    """Put upper directory of variant on tmpfs, or on zram when memory is tight (mode "auto"), for the rest of the process.
+    Upper image is used as before if neither fits or mounting fails."""
+    global ram_upper
+    size = parse_size(genpack_json.get("ram_upper_size", f"{DEFAULT_UPPER_SIZE_IN_GIB}G"))
+    kind = mode
+    if mode == "auto":
+        available = read_mem_available()
+        zram_available = os.path.isdir("/sys/class/zram-control")
+        if available >= size:
+            kind = "tmpfs"
+        elif zram_available and available >= size // 3: # zstd typically compresses a root filesystem to about 1/3
+            kind = "zram"
+        else:
+            logging.info(f"Not enough memory for upper directory ({available / 1024**3:.1f} GiB available), using {variant.upper_image}.")
+            return
+    try:
+        ram_upper = RamUpper(variant, kind, size)
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+        logging.warning(f"Could not set up {kind} for upper directory, using {variant.upper_image} instead: {e}")
+        return
+    # the manifest describes files in upper image, upper directory on RAM starts empty
+    if os.path.exists(variant.upper_files_manifest): os.remove(variant.upper_files_manifest)
+    logging.info(f"Upper directory is on {kind} (up to {size / 1024**3:.1f} GiB).")
+
+@trace_phase("persist upper")
+def persist_ram_upper(variant):
+    """Copy upper directory on RAM into upper image, so that upper-bash can be used on the result."""
+    logging.info(f"Persisting upper directory to {variant.upper_image}...")
+    if not os.path.isfile(variant.upper_image):
+        create_upper_image(variant)
+    with TempMount(variant.upper_image) as mount_point:
+        upper_dir = os.path.join(mount_point, "upper")
+        priv_mkdir(upper_dir)
+        run_command(sudo(["rsync", "-aHAX", "--delete", os.path.join(ram_upper.mount_point, "upper") + "/", upper_dir]), check=True)
+    ram_upper.persisted = True
+
+def stop_ram_upper():
+    global ram_upper
+    if ram_upper is None: return
+    #else
+    if not ram_upper.persisted and os.path.exists(ram_upper.upper_files_manifest):
+        os.remove(ram_upper.upper_files_manifest) # it describes the discarded upper directory, not upper image
+    ram_upper.close()
+    ram_upper = None
+
+def upper_exists(variant):
+    return (ram_upper is not None and ram_upper.holds(variant)) or os.path.isfile(variant.upper_image)
+
+@contextlib.contextmanager
+def mount_upper(variant):
+    """Mount upper image of variant, or use the RAM filesystem if it holds upper directory of the variant."""
+    if ram_upper is not None and ram_upper.holds(variant):
+        yield ram_upper.mount_point
     else:
-        logging.info("No 'files' directory found, skipping file copy.")
+        with TempMount(variant.upper_image) as mount_point:
+            yield mount_point
+
+def list_build_scripts(upper_dir):
+    """List build scripts in upper directory in execution order: /build, files in /build.d and then files in /build.d/<user>,
+    which are run as <user>. Returns list of (path in container, interpreter or None, user or None)."""
+    scripts = []
+    if os.path.isfile(os.path.join(upper_dir, "build")):
+        scripts.append(("/build", None, None))
+    build_script_d = os.path.join(upper_dir, "build.d")
+    if not os.path.isdir(build_script_d): return scripts
+    #else
+    def determine_interpreter(script_path):
+        if os.access(script_path, os.X_OK): return None
+        #else
+        if script_path.endswith(".sh"): return "/bin/sh"
+        #else
+        if script_path.endswith(".py"): return "/usr/bin/python"
+        raise ValueError(f"Script is not executable: {script_path}")
+
+    # os.listdir returns filenames in arbitrary order, sort explicitly to run them in ASCII order
+    user_subdirs = []
+    for script in sorted(os.listdir(build_script_d)):
+        script_path = os.path.join(build_script_d, script)
+        if os.path.isfile(script_path):
+            scripts.append((os.path.join("/build.d", script), determine_interpreter(script_path), None))
+        elif os.path.isdir(script_path):
+            user_subdirs.append(script)
+            logging.debug(f"Found user subdirectory in build.d: {script_path}")
+
+    for subdir in user_subdirs:
+        subdir_path = os.path.join(build_script_d, subdir)
+        for script in sorted(os.listdir(subdir_path)):
+            script_path = os.path.join(subdir_path, script)
+            if not os.path.isfile(script_path):
+                logging.warning(f"Skipping non-file in /build.d/{subdir}: {script}")
+                continue
+            #else
+            scripts.append((os.path.join("/build.d", subdir, script), determine_interpreter(script_path), subdir))
+    return scripts
 
-def upper(variant):
+def run_build_script(upper_dir, variant, script, interpreter, user):
+    logging.info(f"Executing build script: {script}" + (f" as user {user}" if user is not None else ""))
+    upper_exec(upper_dir, variant, [script] if interpreter is None else [interpreter, script], user=user)
+
+@trace_phase("upper")
+def upper(variant, size_profile=False):
     logging.info("Processing upper layer...")
     if not os.path.isfile(variant.lower_image) or not os.path.exists(variant.lower_files):
         raise FileNotFoundError(f"Lower image {variant.lower_image} or lower files {variant.lower_files} does not exist. Please run 'genpack lower' first.")
 
-    # create upper image if it does not exist
-    if not os.path.isfile(variant.upper_image):
-        with open(variant.upper_image, "wb") as f:
-            f.seek(DEFAULT_UPPER_SIZE_IN_GIB * 1024 * 1024 * 1024 - 1)
-            f.write(b'\x00')
-
-        logging.info(f"Formatting filesystem on {variant.upper_image}")
-        subprocess.run(['mkfs.ext4', variant.upper_image], check=True)
-        logging.info("Filesystem formatted successfully.")
+    if not upper_exists(variant):
+        create_upper_image(variant)
 
     # reset upper dir by deleting files not listed in lower_files
     logging.info("Deleting upper files not listed in lower files...")
     files_to_preserve = set()
-    with open(variant.lower_files, "r") as f:
-        for line in f:
-            line = line.rstrip('\n')
-            if not line or line.startswith('#'): continue
-            #else
-            files_to_preserve.add(line)
-            dirname = os.path.dirname(line)
-            while dirname != "":
-                files_to_preserve.add(dirname)
-                dirname = os.path.dirname(dirname)
+    # files installed by the previous sync are also preserved so that unchanged ones need not to be copied again
+    if os.path.isfile(variant.upper_files_manifest):
+        with open(variant.upper_files_manifest) as f:
+            files_to_preserve.update(json.load(f).keys())
 
-    with TempMount(variant.upper_image) as mount_point:
+    with load_lower_index(variant) as lower_files, mount_upper(variant) as mount_point:
         upper_dir = os.path.join(mount_point, "upper")
-        subprocess.run(sudo(["mkdir", "-p", upper_dir]), check=True)
+        priv_mkdir(upper_dir)
         files_to_remove = set()
-        find = subprocess.Popen(sudo(["find", upper_dir, "-printf", "%P\\n"]), stdout=subprocess.PIPE, text=True, bufsize=1)
+        find = start_command(sudo(["find", upper_dir, "-printf", "%P\\n"]), stdout=subprocess.PIPE, text=True, bufsize=1)
         try:
             for line in find.stdout:
                 line = line.rstrip('\n')
@@ -959,37 +2224,28 @@ def upper(variant):
                 #else
                 files_to_remove.add(line)
         finally:
-            find.wait()
+            wait_command(find)
         
-        for file in files_to_preserve:
-            if file in files_to_remove:
-                files_to_remove.remove(file)
-
-        # safety check
-        for file in files_to_remove:
-            normalized = os.path.normpath(file)
-            if normalized.startswith("..") or normalized.startswith("/"):
-                raise ValueError(f"File to remove {file} is suspicious.")
-            
-        def chunk_generator(lst, n):
-            for i in range(0, len(lst), n):
-                yield lst[i : i + n]
-
-        for chunk in chunk_generator(list(files_to_remove), 64):
-            subprocess.run(sudo(["rm", "-rf"] + chunk), check=True, cwd=upper_dir)
+        # lower files are excluded by merging sorted lists against the index instead of loading them into a set
+        files_to_remove = get_files_to_remove(set(lower_files.difference(sorted(files_to_remove, key=os.fsencode))), files_to_preserve)
+        priv_remove(*(os.path.join(upper_dir, path) for path in files_to_remove))
 
         # copy-up from lower to upper
         logging.info("Copying files from lower image to upper directory...")
         with TempMount(variant.lower_image) as mount_point:
-            subprocess.run(sudo(["rsync", "-a", f"--files-from={variant.lower_files}", "--relative", mount_point + "/", upper_dir]), check=True)
+            run_command(sudo(["rsync", "-a", f"--files-from={variant.lower_files}", "--relative", mount_point + "/", upper_dir]), check=True)
+
+        tracker = BuildStepTracker(upper_dir) if size_profile else None
+        def step_done(step):
+            if tracker is not None: tracker.step_done(step)
 
         upper_exec(upper_dir, variant, ["exec-package-scripts-and-generate-metadata"])
+        step_done("package-scripts")
 
         # merge genpack.json
         merged_genpack_json = {}
         for mixin_id in mixins:
-            mixin_genpack_json = mixin_genpack_json.get(mixin_id, {})
-            merge_genpack_json(merged_genpack_json, mixin_genpack_json, [f"mixin({mixin_id})", "genpack.json"], [
+            merge_genpack_json(merged_genpack_json, mixin_genpack_json.get(mixin_id, {}), [f"mixin({mixin_id})", "genpack.json"], [
                 "users","groups", "services", "arch"
             ])
         merge_genpack_json(merged_genpack_json, genpack_json, ["genpack.json"], [
@@ -1051,114 +2307,1090 @@ def upper(variant):
             logging.info("Creating user %s..." % name)
             upper_exec(upper_dir, variant, useradd_cmd)
 
-        copy_upper_files(upper_dir)
-
-        # execute build script if exists
-        build_script = os.path.join(upper_dir, "build")
-        if os.path.isfile(build_script):
-            logging.info(f"Executing build script: /build")
-            upper_exec(upper_dir, variant, ["/build"])
-        build_script_d = os.path.join(upper_dir, "build.d")
-        if os.path.isdir(build_script_d):
-            # os.listdir returns filenames in arbitrary order, usually ASCII order on most filesystems,
-            # but it is not guaranteed by Python. If you want ASCII order, sort explicitly:
-            user_subdirs = []
-            def determine_interpreter(script):
-                if os.access(script_path, os.X_OK): return None
-                #else
-                if script.endswith(".sh"): return "/bin/sh"
-                #else
-                if script.endswith(".py"): return "/usr/bin/python"
-                raise ValueError(f"Script is not executable: {script}")
-
-            for script in sorted(os.listdir(build_script_d)):
-                script_path = os.path.join(build_script_d, script)
-                if os.path.isfile(script_path):
-                    interpreter = determine_interpreter(script_path)
-                    logging.info(f"Executing build script: /build.d/{script}")
-                    script_to_run_in_container = os.path.join("/build.d", script)
-                    upper_exec(upper_dir, variant, [script_to_run_in_container] if interpreter is None else [interpreter, script_to_run_in_container])
-                elif os.path.isdir(script_path):
-                    user_subdirs.append(script)
-                    logging.info(f"Found user subdirectory in build.d: {script_path}")
-            
-            for subdir in user_subdirs:
-                subdir_path = os.path.join(build_script_d, subdir)
-                for script in sorted(os.listdir(subdir_path)):
-                    script_path = os.path.join(subdir_path, script)
-                    if not os.path.isfile(script_path):
-                        logging.warning(f"Skipping non-file in /build.d/{subdir}: {script}")
-                        continue
-                    #else
-                    logging.info(f"Executing build script in user subdirectory: /build.d/{subdir}/{script} as user {subdir}")
-                    interpreter = determine_interpreter(script_path)
-                    script_to_run_in_container = os.path.join("/build.d", subdir, script)
-                    upper_exec(upper_dir, variant, [script_to_run_in_container] if interpreter is None else [interpreter, script_to_run_in_container], user=subdir)
+        step_done("accounts")
+
+        copy_upper_files(upper_dir, variant, lower_files)
+        step_done("files")
+
+        # execute build scripts
+        for script, interpreter, user in list_build_scripts(upper_dir):
+            run_build_script(upper_dir, variant, script, interpreter, user)
+            step_done(script)
 
         # enable services
         services = merged_genpack_json.get("services", [])
         if len(services) > 0:
             upper_exec(upper_dir, variant, ["systemctl", "enable"] + services)
+            step_done("services")
+
+        if tracker is not None:
+            tracker.save(variant.upper_attribution)
+            logging.info(f"Saved build step attribution to {variant.upper_attribution}")
 
 def upper_bash(variant):
-    if not os.path.isfile(variant.upper_image):
+    if not upper_exists(variant):
         raise FileNotFoundError(f"Upper layer image {variant.upper_image} does not exist. Please run 'upper' first")
-    with TempMount(variant.upper_image) as mount_point:
+    with mount_upper(variant) as mount_point, \
+            load_lower_index(variant) if os.path.isfile(variant.lower_files) else contextlib.nullcontext() as lower_files:
         upper_dir = os.path.join(mount_point, "upper")
-        copy_upper_files(upper_dir)
+        copy_upper_files(upper_dir, variant, lower_files)
         logging.info("Running bash in the upper directory for debugging.")
         upper_exec(upper_dir, variant, ["bash"])
 
-def pack(variant, compression=None):
-    if not os.path.isfile(variant.lower_image):
-        raise FileNotFoundError(f"Lower image {variant.lower_image} does not exist. Please run 'lower' first.")
-    if not os.path.isfile(variant.lower_files):
-        raise FileNotFoundError(f"Lower files {variant.lower_files} does not exist. Please run 'lower' first.")
-    if not os.path.isfile(variant.upper_image):
-        raise FileNotFoundError(f"Upper layer image {variant.upper_image} does not exist. Please run 'upper' first.")
+class Inotify:
+    """Minimal inotify(7) binding through ctypes. Directories added with add_tree() are watched recursively."""
+    IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x4, 0x8, 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII") # struct inotify_event without name
+
+    def __init__(self):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        #else
+        self.watches = {} # watch descriptor -> (directory, recursive)
+
+    def add_watch(self, directory, recursive=False):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            import ctypes
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {directory}")
+        #else
+        self.watches[wd] = (directory, recursive)
+
+    def add_tree(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d != ".git"]
+            self.add_watch(dirpath, True)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for events and return changed paths.
+        None in the result means events were lost and everything should be rescanned."""
+        if not select.select([self.fd], [], [], timeout)[0]: return []
+        #else
+        data = os.read(self.fd, 65536)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0"))
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                paths.append(None)
+                continue
+            #else
+            if mask & self.IN_IGNORED: # watched directory has been removed
+                self.watches.pop(wd, None)
+                continue
+            #else
+            if wd not in self.watches: continue
+            #else
+            directory, recursive = self.watches[wd]
+            path = os.path.join(directory, name)
+            if recursive and mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO) and os.path.isdir(path):
+                self.add_tree(path)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# genpack.json keys which take effect only by 'genpack lower'
+LOWER_GENPACK_JSON_KEYS = ["packages", "buildtime_packages", "devel_packages", "accept_keywords", "use", "mask", "license",
+                           "binpkg_excludes", "circulardep_breaker", "gentoo_profile"]
+
+def reload_genpack_json():
+    """Reload genpack.json and mix-ins' genpack.json after they have changed. Returns True if lower layer is affected."""
+    global genpack_json
+    lower_config = lambda: [genpack_json.get(key, None) for key in LOWER_GENPACK_JSON_KEYS] + [mixin_genpack_json.get(mixin_id, {}).get(key, None) for mixin_id in mixins for key in LOWER_GENPACK_JSON_KEYS]
+    before = lower_config()
+    name = genpack_json["name"]
+    genpack_json = load_genpack_json()[0]
+    genpack_json.setdefault("name", name)
+    for mixin_id in mixins:
+        mixin_genpack_json[mixin_id] = load_genpack_json(os.path.join(mixin_root, mixin_id))[0]
+    return lower_config() != before
+
+def watch(variant, repack=False, compression=None):
+    """Build upper layer, then keep it up to date with files, build scripts, mix-ins and genpack.json as they are edited.
+    Only changed files are synced into upper directory. Build scripts which have changed, or which mention a changed file
+    by its absolute path, are run again. A change in genpack.json runs the whole upper layer again."""
+    if not os.path.isfile(variant.lower_image) or not os.path.isfile(variant.lower_files):
+        raise FileNotFoundError(f"Lower image {variant.lower_image} or lower files {variant.lower_files} does not exist. Please run 'genpack lower' first.")
     #else
+    with Inotify() as inotify:
+        inotify.add_watch(".")
+        for layer_dir in [os.path.join(mixin_root, mixin_id) for mixin_id in mixins] + ["files"]:
+            if os.path.isdir(layer_dir): inotify.add_tree(layer_dir)
+        genpack_json_files = {os.path.join(directory, name) for directory in ["."] + [os.path.join(mixin_root, mixin_id) for mixin_id in mixins]
+                              for name in ["genpack.json", "genpack.json5"]}
+        changed = [None] # None means everything, build whole upper layer first
+        while True:
+            started = time.monotonic()
+            try:
+                if None in changed or any(path in genpack_json_files for path in changed):
+                    if None not in changed:
+                        logging.info("genpack.json has changed, rebuilding upper layer.")
+                        if reload_genpack_json():
+                            logging.warning("Packages or portage settings in genpack.json have changed. Run 'genpack lower' to apply them.")
+                    upper(variant)
+                    if repack: pack(variant, compression or WATCH_COMPRESSION)
+                else:
+                    with mount_upper(variant) as mount_point, load_lower_index(variant) as lower_files:
+                        upper_dir = os.path.join(mount_point, "upper")
+                        changed_files = copy_upper_files(upper_dir, variant, lower_files)
+                        for script, interpreter, user in list_build_scripts(upper_dir) if len(changed_files) > 0 else []:
+                            with open(os.path.join(upper_dir, script.lstrip("/")), errors="replace") as f:
+                                text = f.read()
+                            if script.lstrip("/") in changed_files or any("/" + path in text for path in changed_files):
+                                run_build_script(upper_dir, variant, script, interpreter, user)
+                    if repack and len(changed_files) > 0: pack(variant, compression or WATCH_COMPRESSION)
+                logging.info(f"Rebuilt in {time.monotonic() - started:.1f}s.")
+            except Exception as e:
+                logging.error(f"Rebuild failed: {e}") # keep watching, the next edit may fix it
+
+            changed = []
+            logging.info("Watching for changes, press Ctrl+C to stop.")
+            while len(changed) == 0:
+                changed = inotify.read()
+                while True: # let editors and git finish writing
+                    more = inotify.read(WATCH_SETTLE_TIME)
+                    if len(more) == 0: break
+                    #else
+                    changed += more
+                if "./files" in changed and os.path.isdir("files") and not any(directory == "files" for directory, recursive in inotify.watches.values()):
+                    inotify.add_tree("files") # files directory has been created
+                # other entries in project directory do not matter
+                changed = [path for path in changed if path is None or os.path.dirname(path) != "." or path in genpack_json_files or path == "./files"]
+
+def watch_until_interrupted(variant, repack=False, compression=None, persist=False):
+    """Run watch() until Ctrl+C, then copy upper directory on RAM into upper image if persist is requested."""
+    try:
+        watch(variant, repack, compression)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching.")
+        if ram_upper is None or not persist: return
+        #else
+        # another Ctrl+C must not leave upper image half-copied. ignored disposition is inherited by rsync, too
+        previous_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            persist_ram_upper(variant)
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
+def parse_size(size):
+    """Parse size like 131072, "128K", "1M" or "2G" into bytes."""
+    if isinstance(size, int): return size
+    #else
+    if not isinstance(size, str):
+        raise ValueError(f"Invalid size: {size}")
+    m = re.fullmatch(r'(\d+)\s*([KMGT]?)i?B?', size.strip(), re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"Invalid size: {size}")
+    #else
+    return int(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " ")
+
+def get_squashfs_compression_opts(compression, level=None, block_size=None, dict_size=None):
+    if compression not in SQUASHFS_COMPRESSION_LEVELS:
+        raise ValueError(f"Unknown compression type: {compression}")
+    #else
+    levels = SQUASHFS_COMPRESSION_LEVELS[compression]
+    if level is None and levels is not None:
+        level = levels[0]
+    if level is not None:
+        if levels is None:
+            raise ValueError(f"Compression type {compression} does not support compression level")
+        if not isinstance(level, int) or level < levels[1] or level > levels[2]:
+            raise ValueError(f"Compression level for {compression} must be an integer between {levels[1]} and {levels[2]}")
+
+    if compression == "none":
+        opts = ["-no-compression"]
+    else:
+        opts = ["-comp", compression]
+    if compression == "lz4":
+        if level is not None and level > 1: opts += ["-Xhc"]
+    elif level is not None:
+        opts += ["-Xcompression-level", str(level)]
+
+    if block_size is None and compression == "xz":
+        block_size = "1M"
+    if block_size is not None:
+        block_size_in_bytes = parse_size(block_size)
+        if block_size_in_bytes < 4096 or block_size_in_bytes > 1024 * 1024 or block_size_in_bytes & (block_size_in_bytes - 1) != 0:
+            raise ValueError(f"block_size must be a power of 2 between 4K and 1M: {block_size}")
+        #else
+        opts += ["-b", str(block_size_in_bytes)]
 
+    if dict_size is not None:
+        if compression != "xz":
+            raise ValueError("dict_size is only supported by xz compression")
+        #else
+        opts += ["-Xdict-size", str(dict_size)]
+    return opts
+
+def scan_tree(root, hash_contents="0", jobs="0"):
+    # executed as root by load_tree(). must not depend on anything outside this function.
+    # prints one JSON array per entry: [path, type, mode, uid, gid, size, mtime_ns, link target/sha256/rdev]
+    import os, json, stat, hashlib, concurrent.futures
+    entries = []
+    dirs_to_scan = [""]
+    while len(dirs_to_scan) > 0:
+        rel_dir = dirs_to_scan.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                path = os.path.join(rel_dir, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode): file_type, extra = "d", None
+                elif stat.S_ISREG(st.st_mode): file_type, extra = "f", None
+                elif stat.S_ISLNK(st.st_mode): file_type, extra = "l", os.readlink(entry.path)
+                else: file_type, extra = "o", st.st_rdev
+                entries.append([path, file_type, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid, st.st_size, st.st_mtime_ns, extra])
+                if file_type == "d": dirs_to_scan.append(path)
+    if hash_contents == "1":
+        def sha256(path):
+            h = hashlib.sha256()
+            with open(os.path.join(root, path), "rb") as f:
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data: break
+                    h.update(data)
+            return h.hexdigest()
+        files = [entry for entry in entries if entry[1] == "f"]
+        # hashlib releases GIL while hashing, so threads scale across cores
+        with concurrent.futures.ThreadPoolExecutor(max_workers=int(jobs) or os.cpu_count()) as executor:
+            for entry, digest in zip(files, executor.map(sha256, (entry[0] for entry in files))):
+                entry[7] = digest
+    entries.sort(key=lambda entry: entry[0])
+    for entry in entries:
+        print(json.dumps(entry))
+
+def load_tree(root, hash_contents=False):
+    """Scan a directory tree with root privilege and return sorted list of entries (see scan_tree)."""
+    entries = []
+    scan = start_command(sudo(python_cmdline(sys.executable, scan_tree, root, "1" if hash_contents else "0")), stdout=subprocess.PIPE, text=True)
+    try:
+        for line in scan.stdout:
+            entries.append(json.loads(line))
+    finally:
+        if wait_command(scan) != 0:
+            raise subprocess.CalledProcessError(scan.returncode, scan.args)
+    return entries
+
+@trace_phase("fingerprint")
+def get_upper_fingerprint(entries, pack_options, ignore_mtime=False):
+    """Fingerprint of upper directory entries (see load_tree) and pack options, along with total size of files to be packed.
+    Metadata (including mtime unless ignore_mtime) and content hashes if entries have them are used."""
+    h = hashlib.sha256(json.dumps(pack_options).encode())
+    total_size = 0
+    for entry in entries:
+        if entry[1] == "f": total_size += entry[5]
+        if ignore_mtime: entry = entry[:6] + [None] + entry[7:]
+        h.update(json.dumps(entry).encode() + b'\n')
+    return h.hexdigest(), total_size
+
+def get_output_format(output_format=None):
+    if output_format is None:
+        output_format = format_override or genpack_json.get("format", "squashfs")
+    if output_format not in ["squashfs", "erofs"]:
+        raise ValueError(f"Unknown output format: {output_format}")
+    #else
+    return output_format
+
+def get_outfile(variant, output_format=None):
     merged_genpack_json = {}
-    merge_genpack_json(merged_genpack_json, genpack_json, ["genpack.json"], ["outfile","variants"])
+    merge_genpack_json(merged_genpack_json, genpack_json, ["genpack.json"], ["outfile","variants"], variant)
 
     name = genpack_json["name"]
     if variant is not None and variant.name is not None:
         name += f"-{variant.name}"
-    outfile = merged_genpack_json.get("outfile", f"{name}-{arch}.squashfs")
+    return merged_genpack_json.get("outfile", f"{name}-{arch}.{get_output_format(output_format)}")
 
+def get_erofs_compression_opts(compression, level=None, cluster_size=None, processors=None):
+    if compression not in EROFS_COMPRESSION_LEVELS:
+        raise ValueError(f"Unknown compression type for erofs: {compression}")
+    #else
+    levels = EROFS_COMPRESSION_LEVELS[compression]
+    if level is None and levels is not None:
+        level = levels[0]
+    if level is not None:
+        if levels is None:
+            raise ValueError(f"Compression type {compression} does not support compression level")
+        if not isinstance(level, int) or level < levels[1] or level > levels[2]:
+            raise ValueError(f"Compression level for {compression} must be an integer between {levels[1]} and {levels[2]}")
+        if compression == "lzma" and 9 < level < 100: # 100-109 are the extreme variants of 0-9
+            raise ValueError("Compression level for lzma must be between 0 and 9, or between 100 and 109")
+
+    opts = []
+    if compression != "none":
+        opts.append(f"-z{compression}" if level is None else f"-z{compression},{level}")
+    if cluster_size is not None:
+        # physical cluster size is erofs' counterpart of squashfs block size
+        opts.append(f"-C{parse_size(cluster_size)}")
+    if processors is not None:
+        opts.append(f"--workers={processors}")
+    return opts
+
+def pack_exclude_regex(pattern):
+    """Convert a PACK_EXCLUDES wildcard into POSIX extended regex for mkfs.erofs --exclude-regex."""
+    regex = ""
+    for c in pattern:
+        if c == '*': regex += "[^/]*"
+        elif c == '?': regex += "[^/]"
+        elif c in ".^$+(){}[]|\\": regex += "\\" + c
+        else: regex += c
+    return f"^{regex}$"
+
+# like mksquashfs -wildcards, '*' does not match '/' and whatever is under an excluded directory is excluded as well
+pack_excludes_re = re.compile("(?:" + "|".join(pack_exclude_regex(pattern)[1:-1] for pattern in PACK_EXCLUDES) + ")(?:/.*)?", re.DOTALL)
+
+def is_excluded_from_pack(path):
+    return pack_excludes_re.fullmatch(path) is not None
+
+def get_compression_opts(output_format, compression=None, compression_level=None, block_size=None, processors=None):
+    """Resolve compression options from arguments and genpack.json. Returns compression type and command line options."""
     if compression is None:
-        compression = genpack_json.get("compression", "gzip")
-    
-    compression_opts = []
-    if compression == "xz":
-        compression_opts = ["-comp", "xz", "-b", "1M"]
-    elif compression == "gzip":
-        compression_opts = ["-Xcompression-level", "1"]
-    elif compression == "lzo":
-        compression_opts = ["-comp", "lzo"]
-    elif compression == "none":
-        compression_opts = ["-no-compression"]
+        compression = genpack_json.get("compression", DEFAULT_COMPRESSION if output_format == "squashfs" else DEFAULT_EROFS_COMPRESSION)
+    if compression_level is None:
+        compression_level = genpack_json.get("compression_level", None)
+    if block_size is None:
+        block_size = genpack_json.get("block_size", None)
+    if processors is None:
+        processors = genpack_json.get("processors", None)
+    if processors is not None and (not isinstance(processors, int) or processors < 1):
+        raise ValueError("processors must be a positive integer")
+    if output_format == "squashfs":
+        compression_opts = get_squashfs_compression_opts(compression, compression_level, block_size, genpack_json.get("dict_size", None))
+        if processors is not None:
+            compression_opts += ["-processors", str(processors)]
     else:
-        raise ValueError(f"Unknown compression type: {compression}")
+        compression_opts = get_erofs_compression_opts(compression, compression_level, block_size, processors)
+    return compression, compression_opts
 
-    with TempMount(variant.upper_image) as mount_point:
+@trace_phase("pack")
+def pack(variant, compression=None, compression_level=None, block_size=None, processors=None, benchmark=None, benchmark_jobs=1,
+         force=False, fingerprint_content=None, output_format=None):
+    if not os.path.isfile(variant.lower_image):
+        raise FileNotFoundError(f"Lower image {variant.lower_image} does not exist. Please run 'lower' first.")
+    if not os.path.isfile(variant.lower_files):
+        raise FileNotFoundError(f"Lower files {variant.lower_files} does not exist. Please run 'lower' first.")
+    if not upper_exists(variant):
+        raise FileNotFoundError(f"Upper layer image {variant.upper_image} does not exist. Please run 'upper' first.")
+    #else
+
+    if benchmark is not None:
+        benchmark_pack(variant, benchmark, benchmark_jobs)
+        return
+
+    output_format = get_output_format(output_format)
+    outfile = get_outfile(variant, output_format)
+
+    compression, compression_opts = get_compression_opts(output_format, compression, compression_level, block_size, processors)
+
+    if fingerprint_content is None:
+        fingerprint_content = genpack_json.get("fingerprint_content", False)
+
+    with mount_upper(variant) as mount_point:
         upper_dir = os.path.join(mount_point, "upper")
-        cmdline = ["mksquashfs", "/mnt/upper", os.path.join("/mnt/outdir",outfile), "-wildcards", "-noappend", "-no-exports"]
-        cmdline += compression_opts
-        cmdline += ["-e", "build", "build.d", "build.d/*", "var/log/*.log", "var/tmp/*"]
+        sort_entries = []
+        if output_format == "squashfs":
+            cmdline = ["mksquashfs", "/mnt/upper", os.path.join("/mnt/outdir",outfile), "-wildcards", "-noappend", "-no-exports"]
+            cmdline += compression_opts
+            cmdline += ["-e"] + PACK_EXCLUDES
+
+            if os.path.isfile(variant.boot_trace):
+                sort_entries = generate_sort_file(upper_dir, variant.boot_trace, variant.boot_sort_file)
+                logging.info(f"Placing {len(sort_entries)} files recorded in {variant.boot_trace} at the front of the image.")
+                cmdline += ["-sort", os.path.join("/mnt/outdir", variant.boot_sort_file)]
+        else:
+            cmdline = ["mkfs.erofs"] + compression_opts
+            cmdline += [f"--exclude-regex={pack_exclude_regex(pattern)}" for pattern in PACK_EXCLUDES]
+            cmdline += [os.path.join("/mnt/outdir",outfile), "/mnt/upper"]
+            if os.path.isfile(variant.boot_trace):
+                logging.warning(f"{variant.boot_trace} is ignored because erofs output does not support file ordering.")
+
+        manifest = genpack_json.get("manifest", True)
+        logging.info("Computing fingerprint of upper directory...")
+        def scan_upper(hash_contents):
+            with trace_phase("scan upper"):
+                return [entry for entry in load_tree(upper_dir, hash_contents) if not is_excluded_from_pack(entry[0])]
+        # metadata is enough to tell whether anything changed. contents are hashed for manifest only when it is going to be written
+        entries = scan_upper(fingerprint_content)
+        fingerprint, source_size = get_upper_fingerprint(entries, cmdline + sort_entries, fingerprint_content)
+        logging.debug(f"Upper directory fingerprint: {fingerprint}")
+        cached_outfile = os.path.join(pack_cache_dir, f"{fingerprint}.{output_format}")
+        if not force and os.path.isfile(cached_outfile):
+            os.utime(cached_outfile) # mark as recently used
+            if manifest and not os.path.isfile(cached_outfile + ".manifest"): # packed while manifest was disabled
+                write_manifest(entries if fingerprint_content else scan_upper(True), variant, cached_outfile + ".manifest", outfile)
+            if os.path.isfile(outfile) and os.path.samefile(outfile, cached_outfile) and (not manifest or os.path.isfile(outfile + ".manifest")):
+                logging.info(f"Upper directory is unchanged since {outfile} was created, skipping.")
+                return outfile
+            #else
+            logging.info(f"Restoring {outfile} from pack cache ({fingerprint}).")
+            for suffix in ["", ".manifest"]:
+                if os.path.exists(outfile + suffix): os.remove(outfile + suffix)
+                if os.path.isfile(cached_outfile + suffix): link_or_copy(cached_outfile + suffix, outfile + suffix)
+            return outfile
 
-        logging.info(f"Creating SquashFS image: {outfile} with compression {compression}")
+        logging.info(f"Creating {output_format} image: {outfile} with compression {compression} ({' '.join(compression_opts)})")
         if os.path.exists(outfile):
             logging.info(f"Output file {outfile} already exists, removing it.")
-            os.remove(outfile)
+            os.remove(outfile) # never truncate in place, it may be hard-linked from pack cache
+
+        start = time.monotonic()
+        with trace_phase(cmdline[0]), container_usage(f"pack: {cmdline[0]}"):
+            run_command(sudo(pack_nspawn_cmdline(variant, upper_dir, ".") + cmdline), check=True)
+        elapsed = time.monotonic() - start
+
+        if manifest:
+            # contents were just read by mksquashfs/mkfs.erofs, hashing them again is mostly served from page cache
+            write_manifest(entries if fingerprint_content else scan_upper(True), variant, outfile + ".manifest", outfile)
+
+    outfile_size = os.path.getsize(outfile)
+    logging.info(f"Created {outfile}: {outfile_size / 1024 / 1024:.1f} MiB from {source_size / 1024 / 1024:.1f} MiB "
+                 f"({outfile_size * 100 / source_size if source_size > 0 else 0:.1f}%) in {elapsed:.1f} seconds.")
+
+    os.makedirs(pack_cache_dir, exist_ok=True)
+    for suffix in ["", ".manifest"]:
+        if os.path.exists(cached_outfile + suffix): os.remove(cached_outfile + suffix)
+        if os.path.isfile(outfile + suffix): link_or_copy(outfile + suffix, cached_outfile + suffix)
+    prune_pack_cache(genpack_json.get("pack_cache_keep", DEFAULT_PACK_CACHE_KEEP))
+    return outfile
+
+@trace_phase("pack layered")
+def pack_layered(variants, compression=None, compression_level=None, block_size=None, processors=None):
+    """Pack files shared by all variants into a base image and the rest of each variant into a delta image to be stacked with overlayfs."""
+    if len(variants) < 2:
+        raise ValueError("Layered output requires at least two variants")
+    for variant in variants:
+        if not os.path.isfile(variant.lower_image) or not upper_exists(variant):
+            raise FileNotFoundError(f"Lower image {variant.lower_image} or upper image {variant.upper_image} does not exist. Please build variant '{variant.name}' first.")
+    #else
+    compression, compression_opts = get_compression_opts("squashfs", compression, compression_level, block_size, processors)
+    name = genpack_json["name"]
+    base_outfile = f"{name}-base-{arch}.squashfs"
+
+    def entry_key(entry):
+        # mtime is ignored as the same file is usually created at different time in each variant
+        return (entry[1], entry[2], entry[3], entry[4], entry[5] if entry[1] != "d" else None, entry[7])
+
+    def write_exclude_file(exclude_file, paths):
+        # directories are excluded along with their contents, so their descendants need not to be listed
+        paths = set(paths)
+        with open(exclude_file, "w") as f:
+            for path in sorted(paths):
+                parent = os.path.dirname(path)
+                while parent != "" and parent not in paths:
+                    parent = os.path.dirname(parent)
+                if parent == "":
+                    if "\n" in path: raise ValueError(f"Cannot exclude path containing newline: {path!r}")
+                    #else
+                    # -wildcards makes each line an extended glob, so every character glob treats specially is escaped
+                    f.write(re.sub(r'([\\*?\[\]+@!()|\s])', r'\\\1', path) + '\n')
 
-        nspawn_cmdline = ["systemd-nspawn", "-q", "--suppress-sync=true", 
-            "--as-pid2", "-M", container_name, f"--image={variant.lower_image}",
-            f"--bind={upper_dir}:/mnt/upper",
-            f"--bind=.:/mnt/outdir{':rootidmap' if os.geteuid() != 0 else ''}"
-        ]
-        nspawn_cmdline += cmdline
-        subprocess.run(sudo(nspawn_cmdline), check=True)
+    tmp_dir = tempfile.mkdtemp(prefix="genpack_layered_", dir=work_dir)
+    try:
+        with contextlib.ExitStack() as stack:
+            upper_dirs = [os.path.join(stack.enter_context(mount_upper(variant)), "upper") for variant in variants]
+            trees = []
+            for variant, upper_dir in zip(variants, upper_dirs):
+                logging.info(f"Scanning upper directory of variant {variant.name}...")
+                trees.append({entry[0]: entry for entry in load_tree(upper_dir, True) if not is_excluded_from_pack(entry[0])})
+
+            common = set()
+            for path in sorted(trees[0].keys(), key=lambda p: p.count('/')):
+                parent = os.path.dirname(path)
+                if parent != "" and parent not in common: continue
+                #else
+                key = entry_key(trees[0][path])
+                if all(path in tree and entry_key(tree[path]) == key for tree in trees[1:]):
+                    common.add(path)
+            common_bytes = sum(trees[0][path][5] for path in common if trees[0][path][1] == "f")
+
+            def run_mksquashfs(variant, upper_dir, outfile, excludes):
+                exclude_file = os.path.join(tmp_dir, outfile + ".exclude")
+                write_exclude_file(exclude_file, excludes)
+                cmdline = layered_mksquashfs_cmdline(outfile, exclude_file, compression_opts)
+                if os.path.exists(outfile): os.remove(outfile)
+                with container_usage(f"pack: mksquashfs {outfile}"):
+                    run_command(sudo(pack_nspawn_cmdline(variant, upper_dir, ".") + cmdline), check=True)
+
+            logging.info(f"Creating base image {base_outfile} with {len(common)} entries shared by {len(variants)} variants...")
+            run_mksquashfs(variants[0], upper_dirs[0], base_outfile, [path for path in trees[0] if path not in common])
+            delta_outfiles = []
+            for variant, upper_dir, tree in zip(variants, upper_dirs, trees):
+                delta_outfile = f"{name}-{variant.name}-delta-{arch}.squashfs"
+                logging.info(f"Creating delta image {delta_outfile}...")
+                # directories are kept so that delta image is a complete overlay of base image
+                run_mksquashfs(variant, upper_dir, delta_outfile, [path for path in tree if path in common and tree[path][1] != "d"])
+                delta_outfiles.append(delta_outfile)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    logging.info(f"Base image {base_outfile}: {os.path.getsize(base_outfile) / 1024 / 1024:.1f} MiB")
+    for delta_outfile in delta_outfiles:
+        logging.info(f"Delta image {delta_outfile}: {os.path.getsize(delta_outfile) / 1024 / 1024:.1f} MiB")
+    logging.info(f"Deduplicated {common_bytes * (len(variants) - 1) / 1024 / 1024:.1f} MiB of uncompressed files "
+                 f"({common_bytes / 1024 / 1024:.1f} MiB shared by {len(variants)} variants).")
+    return base_outfile, delta_outfiles
+
+def read_package_ownership(lower_image):
+    """Map each file and symlink path installed by portage in lower image to its owning package (category/package-version)."""
+    owners = {}
+    with TempMount(lower_image) as mount_point:
+        vdb_dir = os.path.join(mount_point, "var/db/pkg")
+        for category in sorted(os.listdir(vdb_dir)):
+            category_dir = os.path.join(vdb_dir, category)
+            if not os.path.isdir(category_dir): continue
+            #else
+            for package in sorted(os.listdir(category_dir)):
+                contents = os.path.join(category_dir, package, "CONTENTS")
+                if not os.path.isfile(contents): continue
+                #else
+                with open(contents, errors="surrogateescape") as f:
+                    for line in f:
+                        line = line.rstrip('\n')
+                        if line.startswith("obj "):
+                            path = line[4:].rsplit(' ', 2)[0] # obj <path> <md5> <mtime>
+                        elif line.startswith("sym "):
+                            path = line[4:].split(" -> ", 1)[0] # sym <path> -> <target> <mtime>
+                        else:
+                            continue # directories are shared by many packages
+                        owners[path.lstrip('/')] = f"{category}/{package}"
+    return owners
+
+def escape_manifest_field(field):
+    return str(field).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+@trace_phase("write manifest")
+def write_manifest(entries, variant, manifest_file, image_name):
+    """Write per-file manifest of the image from entries scanned with hash_contents (see load_tree):
+    path, type, mode, size, sha256 (or symlink target) and owning package. Lines are sorted by escaped path, as diff() walks them."""
+    logging.info(f"Writing manifest {manifest_file}...")
+    start = time.monotonic()
+    entries = sorted(entries, key=lambda entry: os.fsencode(entry[0]))
+    lines = []
+    with load_lower_index(variant) if os.path.isfile(variant.lower_files) else contextlib.nullcontext() as index:
+        owners = index.owners_of(entry[0] for entry in entries) if index is not None else itertools.repeat(None)
+        for (path, file_type, mode, uid, gid, size, mtime_ns, extra), owner in zip(entries, owners):
+            fields = [escape_manifest_field(field) for field in [path, file_type, "%04o" % mode, size if file_type == "f" else 0,
+                                                                 extra if file_type in ["f", "l"] else "-", owner or "-"]]
+            lines.append((fields[0], "\t".join(fields) + "\n"))
+    lines.sort()
+    with open(manifest_file, "w", errors="surrogateescape") as f:
+        f.write(f"# genpack manifest v1 {os.path.basename(image_name)}\n")
+        f.writelines(line for _, line in lines)
+    logging.info(f"Wrote manifest of {len(lines)} entries in {time.monotonic() - start:.1f} seconds.")
+
+def diff(old_manifest_file, new_manifest_file):
+    """Compare two sorted manifests in a single pass and print added(+), removed(-) and modified(M) entries."""
+    def read_entries(manifest_file):
+        with open(manifest_file, errors="surrogateescape") as f:
+            for line in f:
+                if line.startswith('#'): continue
+                #else
+                fields = line.rstrip('\n').split('\t')
+                yield fields[0], fields[1:]
+    field_names = ["type", "mode", "size", "content", "package"]
+    added, removed, modified = 0, 0, 0
+    old_entries, new_entries = read_entries(old_manifest_file), read_entries(new_manifest_file)
+    old, new = next(old_entries, None), next(new_entries, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            print(f"- {old[0]}")
+            removed += 1
+            old = next(old_entries, None)
+        elif old is None or new[0] < old[0]:
+            print(f"+ {new[0]}{'' if new[1][4] == '-' else ' (' + new[1][4] + ')'}")
+            added += 1
+            new = next(new_entries, None)
+        else:
+            if old[1] != new[1]:
+                changes = [f"{name}: {o} -> {n}" for name, o, n in zip(field_names, old[1], new[1]) if o != n and name != "content"]
+                if old[1][3] != new[1][3]: changes.insert(0, "content")
+                print(f"M {new[0]} ({', '.join(changes)})")
+                modified += 1
+            old, new = next(old_entries, None), next(new_entries, None)
+    print(f"{added} added, {removed} removed, {modified} modified")
+    return added, removed, modified
+
+def estimate_compressed_sizes(root, block_size="131072", jobs="0"):
+    # executed as root by size_report(). must not depend on anything outside this function.
+    # prints "<zlib-compressed bytes>\t<path>" for each regular file, compressing block by block like squashfs does
+    import os, zlib, concurrent.futures
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path) and not os.path.islink(path): paths.append(path)
+    def compressed_size(path):
+        total = 0
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(int(block_size))
+                if not data: break
+                # incompressible blocks are stored as is
+                total += min(len(zlib.compress(data, 6)), len(data))
+        return total
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(jobs) or os.cpu_count()) as executor:
+        for path, size in zip(paths, executor.map(compressed_size, paths)):
+            print(f"{size}\t{os.path.relpath(path, root)}")
+
+def size_report(variant, top=20):
+    """Print ranking of uncompressed and (estimated) compressed bytes per package, files layer and build step."""
+    if not upper_exists(variant) or not os.path.isfile(variant.lower_image):
+        raise FileNotFoundError(f"Lower image {variant.lower_image} or upper image {variant.upper_image} does not exist. Please run 'upper' first.")
+    #else
+    layers = {}
+    if os.path.isfile(variant.upper_files_manifest):
+        with open(variant.upper_files_manifest) as f:
+            layers = {path: entry["source"][0] for path, entry in json.load(f).items() if not entry["is_dir"]}
+    steps = {}
+    if os.path.isfile(variant.upper_attribution):
+        with open(variant.upper_attribution) as f:
+            steps = json.load(f)
+    else:
+        logging.warning(f"{variant.upper_attribution} not found. Run 'genpack upper --size-profile' to attribute bytes to build steps.")
+
+    block_size = parse_size(genpack_json.get("block_size", 128 * 1024))
+    with mount_upper(variant) as mount_point:
+        upper_dir = os.path.join(mount_point, "upper")
+        sizes = {entry[0]: entry[5] for entry in load_tree(upper_dir) if entry[1] == "f" and not is_excluded_from_pack(entry[0])}
+        logging.info(f"Estimating compressed size of {len(sizes)} files...")
+        compressed_sizes = {}
+        estimate = start_command(sudo(python_cmdline(sys.executable, estimate_compressed_sizes, upper_dir, block_size)), stdout=subprocess.PIPE, text=True)
+        try:
+            for line in estimate.stdout:
+                compressed_size, path = line.rstrip('\n').split('\t', 1)
+                compressed_sizes[path] = int(compressed_size)
+        finally:
+            if wait_command(estimate) != 0:
+                raise subprocess.CalledProcessError(estimate.returncode, estimate.args)
+
+    with load_lower_index(variant) as index:
+        paths = sorted(sizes, key=os.fsencode)
+        owners = {path: owner for path, owner in zip(paths, index.owners_of(paths)) if owner is not None}
+
+    total_size, total_compressed_size = sum(sizes.values()), sum(compressed_sizes.get(path, 0) for path in sizes)
+    print(f"Total: {total_size / 1024 / 1024:.1f} MiB, estimated compressed: {total_compressed_size / 1024 / 1024:.1f} MiB in {len(sizes)} files")
+    for title, attribution, limit in [("Packages", owners, top), ("Files layers", layers, None), ("Build steps", steps, None)]:
+        totals = {}
+        for path, size in sizes.items():
+            origin = attribution.get(path, "(unattributed)")
+            t = totals.setdefault(origin, [0, 0, 0])
+            t[0] += size
+            t[1] += compressed_sizes.get(path, 0)
+            t[2] += 1
+        print(f"\n{title}:")
+        print(f"{'MiB':>10} {'comp MiB':>10} {'files':>8}  name")
+        for origin, (size, compressed_size, count) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+            print(f"{size / 1024 / 1024:>10.1f} {compressed_size / 1024 / 1024:>10.1f} {count:>8}  {origin}")
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def prune_pack_cache(keep):
+    if not os.path.isdir(pack_cache_dir): return
+    #else
+    cached = sorted((os.path.join(pack_cache_dir, f) for f in os.listdir(pack_cache_dir) if not f.endswith(".manifest")), key=os.path.getmtime, reverse=True)
+    for path in cached[keep:]:
+        logging.debug(f"Removing old pack cache entry {path}")
+        os.remove(path)
+        if os.path.exists(path + ".manifest"): os.remove(path + ".manifest")
+
+def layered_mksquashfs_cmdline(outfile, exclude_file, compression_opts):
+    """mksquashfs command line for pack_layered(), run in container by pack_nspawn_cmdline() with current directory as outdir."""
+    exclude_file = os.path.relpath(exclude_file) # mkdtemp() returns absolute host path, only current directory is visible in container
+    if exclude_file.split(os.sep)[0] == "..":
+        raise ValueError(f"Exclude file {exclude_file} is outside of current directory")
+    #else
+    cmdline = ["mksquashfs", "/mnt/upper", os.path.join("/mnt/outdir", outfile), "-wildcards", "-noappend", "-no-exports"]
+    cmdline += compression_opts
+    return cmdline + ["-ef", os.path.join("/mnt/outdir", exclude_file), "-e"] + PACK_EXCLUDES
+
+def pack_nspawn_cmdline(variant, upper_dir, outdir):
+    return ["systemd-nspawn", "-q", "--suppress-sync=true", 
+        "--as-pid2", "-M", container_name, f"--image={variant.lower_image}",
+        f"--bind={upper_dir}:/mnt/upper",
+        f"--bind={escape_colon(os.path.abspath(outdir))}:/mnt/outdir{':rootidmap' if os.geteuid() != 0 else ''}"
+    ] + resource_properties("pack")
+
+def python_cmdline(python, func, *args):
+    """Build a command line that runs a self-contained function of this module by another interpreter (as root or in a container)."""
+    return [python, "-c", f"import sys\n{inspect.getsource(func)}\n{func.__name__}(*sys.argv[1:])\n"] + [str(arg) for arg in args]
+
+def run_mksquashfs_jobs(jobs_json, parallel):
+    # executed inside the lower image by benchmark_pack(). must not depend on anything outside this function.
+    import os, json, time, subprocess, concurrent.futures
+    def run_job(job):
+        start = time.monotonic()
+        proc = subprocess.Popen(job["cmdline"], stdout=subprocess.DEVNULL)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return {"returncode": proc.returncode, "wall_time": time.monotonic() - start, "cpu_time": rusage.ru_utime + rusage.ru_stime}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(parallel)) as executor:
+        results = list(executor.map(run_job, json.loads(jobs_json)))
+    print(json.dumps(results))
+
+def measure_read_throughput(root, mode, seed="0"):
+    # executed as root by benchmark_pack(). must not depend on anything outside this function.
+    import os, json, time, random
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append((path, os.path.getsize(path)))
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("1") # page cache only, directory lookups are not what is measured
+    total_bytes, reads = 0, 0
+    start = time.monotonic()
+    if mode == "sequential":
+        for path, size in files:
+            with open(path, "rb", buffering=0) as f:
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data: break
+                    total_bytes += len(data)
+                    reads += 1
+    else:
+        rnd = random.Random(int(seed))
+        files = [(path, size) for path, size in files if size > 0]
+        for _ in range(min(20000, len(files) * 4)):
+            path, size = rnd.choice(files)
+            with open(path, "rb", buffering=0) as f:
+                f.seek(rnd.randrange(0, size) & ~4095)
+                total_bytes += len(f.read(4096))
+                reads += 1
+    print(json.dumps({"bytes": total_bytes, "reads": reads, "seconds": time.monotonic() - start}))
+
+def benchmark_pack(variant, output_format="table", jobs=1):
+    """Pack upper directory with each of BENCHMARK_PROFILES and compare size, pack time and read throughput.
+    Profiles are packed one by one unless jobs > 1, in which case wall times include contention between the jobs."""
+    if jobs > 1:
+        logging.warning(f"Benchmarking {len(BENCHMARK_PROFILES)} compression profiles with {jobs} jobs in parallel, wall times are not comparable with sequential runs.")
+    else:
+        logging.info(f"Benchmarking {len(BENCHMARK_PROFILES)} compression profiles one by one...")
+    processors = max(1, (os.cpu_count() or 1) // jobs)
+    results = []
+    bench_dir = tempfile.mkdtemp(prefix="genpack_benchmark_", dir=work_dir)
+    try:
+        with mount_upper(variant) as mount_point:
+            upper_dir = os.path.join(mount_point, "upper")
+            mksquashfs_jobs = []
+            for i, (compression, level) in enumerate(BENCHMARK_PROFILES):
+                compression_opts = get_squashfs_compression_opts(compression, level) + ["-processors", str(processors)]
+                cmdline = ["mksquashfs", "/mnt/upper", f"/mnt/outdir/{i}.squashfs", "-wildcards", "-noappend", "-no-exports", "-quiet", "-no-progress"]
+                cmdline += compression_opts + ["-e"] + PACK_EXCLUDES
+                mksquashfs_jobs.append({"cmdline": cmdline})
+                results.append({"compression": compression, "level": level, "options": " ".join(compression_opts)})
+            nspawn_cmdline = pack_nspawn_cmdline(variant, upper_dir, bench_dir)
+            stdout = run_command(sudo(nspawn_cmdline + python_cmdline("python3", run_mksquashfs_jobs, json.dumps(mksquashfs_jobs), jobs)),
+                                    check=True, stdout=subprocess.PIPE, text=True).stdout
+            for result, job_result in zip(results, json.loads(stdout.strip().splitlines()[-1])):
+                if job_result["returncode"] != 0:
+                    raise Exception(f"mksquashfs failed with {result['options']}")
+                result.update(job_result)
+
+        for i, result in enumerate(results):
+            image = os.path.join(bench_dir, f"{i}.squashfs")
+            result["size"] = os.path.getsize(image)
+            logging.info(f"Measuring read throughput of {result['options']}...")
+            for mode in ["sequential", "random"]:
+                # measure_read_throughput() drops page cache, which holds both the image file and files read from it
+                with TempMount(image) as image_mount_point:
+                    stdout = run_command(sudo(python_cmdline(sys.executable, measure_read_throughput, image_mount_point, mode)),
+                                            check=True, stdout=subprocess.PIPE, text=True).stdout
+                    measured = json.loads(stdout)
+                result[f"{mode}_read_mib_per_sec"] = measured["bytes"] / 1024 / 1024 / measured["seconds"] if measured["seconds"] > 0 else None
+                if mode == "random":
+                    result["random_read_iops"] = measured["reads"] / measured["seconds"] if measured["seconds"] > 0 else None
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+    if output_format == "json":
+        print(json.dumps(results, indent=2))
+        return results
+    #else
+    print(f"{'compression':<12} {'level':>5} {'size(MiB)':>10} {'wall(s)':>8} {'cpu(s)':>8} {'seq(MiB/s)':>11} {'rand(MiB/s)':>12} {'rand(IOPS)':>11}")
+    for result in results:
+        print(f"{result['compression']:<12} {str(result['level'] or '-'):>5} {result['size'] / 1024 / 1024:>10.1f} {result['wall_time']:>8.1f} {result['cpu_time']:>8.1f} "
+              f"{result['sequential_read_mib_per_sec'] or 0:>11.1f} {result['random_read_mib_per_sec'] or 0:>12.1f} {result['random_read_iops'] or 0:>11.0f}")
+    return results
+
+def trace_file_access(mount_point):
+    # executed as root by trace_boot(). must not depend on anything outside this function.
+    # prints "<elapsed seconds>\t<path>" for each file opened for the first time on the filesystem mounted at mount_point
+    import os, ctypes, struct, signal, time
+    FAN_CLASS_NOTIF, FAN_CLOEXEC, FAN_MARK_ADD, FAN_MARK_FILESYSTEM, FAN_OPEN, AT_FDCWD = 0x0, 0x1, 0x1, 0x100, 0x20, -100
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+    libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+    fd = libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC, os.O_RDONLY | os.O_LARGEFILE | os.O_CLOEXEC)
+    if fd < 0: raise OSError(ctypes.get_errno(), "fanotify_init failed")
+    # mark whole filesystem, as the container sees it through its own bind mount
+    if libc.fanotify_mark(fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM, FAN_OPEN, AT_FDCWD, mount_point.encode()) < 0:
+        raise OSError(ctypes.get_errno(), "fanotify_mark failed")
+    class Stop(Exception): pass
+    def stop(signum, frame): raise Stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    seen = set()
+    start = time.monotonic()
+    print("ready", flush=True)
+    try:
+        while True:
+            buf = os.read(fd, 65536)
+            offset = 0
+            while offset < len(buf):
+                event_len, _, _, _, _, event_fd, _ = struct.unpack_from("IBBHQii", buf, offset)
+                offset += event_len
+                if event_fd < 0: continue
+                try:
+                    path = os.readlink(f"/proc/self/fd/{event_fd}")
+                finally:
+                    os.close(event_fd)
+                if path in seen or "\n" in path: continue
+                seen.add(path)
+                print(f"{time.monotonic() - start:.3f}\t{path}", flush=True)
+    except Stop:
+        pass
+
+def trace_boot(variant, max_duration=120, idle_timeout=10):
+    """Boot the packed image in a container and record the order of files read until reads settle."""
+    outfile = get_outfile(variant)
+    if not os.path.isfile(outfile):
+        raise FileNotFoundError(f"{outfile} does not exist. Please run 'pack' first.")
+    #else
+    events = []
+    with TempMount(outfile) as mount_point:
+        tracer = start_command(sudo(python_cmdline(sys.executable, trace_file_access, mount_point)), stdout=subprocess.PIPE, text=True)
+        if tracer.stdout.readline().strip() != "ready":
+            wait_command(tracer)
+            raise Exception("Failed to start file access tracer")
+        #else
+        def read_events():
+            for line in tracer.stdout:
+                elapsed, path = line.rstrip('\n').split('\t', 1)
+                if path.startswith(mount_point + "/"): path = path[len(mount_point) + 1:]
+                events.append((float(elapsed), path.lstrip('/')))
+        reader = threading.Thread(target=read_events)
+        reader.start()
+
+        logging.info(f"Booting {outfile} to record file access order...")
+        start = time.monotonic()
+        nspawn = start_command(sudo(["systemd-nspawn", "-q", "-M", container_name, "-D", mount_point, "--volatile=state",
+                                        "--console=passive", "-b"]), stdin=subprocess.DEVNULL)
+        try:
+            while poll_command(nspawn) is None:
+                now = time.monotonic() - start
+                last_event = events[-1][0] if len(events) > 0 else 0.0
+                if now > max_duration or (len(events) > 0 and now - last_event > idle_timeout):
+                    break
+                time.sleep(0.5)
+        finally:
+            if poll_command(nspawn) is None:
+                run_command(sudo(["machinectl", "poweroff", container_name]), check=False)
+                try:
+                    wait_command(nspawn, timeout=30)
+                except subprocess.TimeoutExpired:
+                    run_command(sudo(["machinectl", "terminate", container_name]), check=False)
+                    wait_command(nspawn)
+            tracer.terminate()
+            wait_command(tracer)
+            reader.join()
+
+    if len(events) == 0:
+        raise Exception("No file access recorded.")
+    #else
+    with open(variant.boot_trace, "w") as f:
+        for elapsed, path in events:
+            f.write(path + '\n')
+    logging.info(f"Recorded {len(events)} files in {variant.boot_trace}, reads settled after {events[-1][0]:.1f} seconds.")
+
+def generate_sort_file(upper_dir, boot_trace, sort_file):
+    """Convert a boot trace into mksquashfs sort file. Files read earlier get higher priority (placed first)."""
+    entries = []
+    with open(boot_trace) as f:
+        for line in f:
+            path = line.rstrip('\n')
+            # mksquashfs sort file cannot express whitespaces in path. entries must exist in the source tree.
+            if path == "" or any(c.isspace() for c in path) or not os.path.lexists(os.path.join(upper_dir, path)): continue
+            #else
+            entries.append(f"{path} {max(32767 - len(entries), 1)}")
+    with open(sort_file, "w") as f:
+        for entry in entries:
+            f.write(entry + '\n')
+    return entries
+
+CHUNK_GEAR = [random.Random(0x67656e7061636b + i).getrandbits(32) for i in range(256)]
+# i-th byte of gear value of each byte value, for bytes.translate()
+CHUNK_GEAR_BYTES = [bytes((gear >> (8 * i)) & 0xff for gear in CHUNK_GEAR) for i in range(4)]
+CHUNK_HASH_WINDOW = 32 # gear hash is shifted left once per byte, so a 32-bit hash depends only on the last 32 bytes
+
+chunk_lane_constants = {} # window length -> big integers used by find_chunk_cut()
+
+def find_chunk_cut(data, start, limit):
+    """Return the position right after the first byte in data[start:limit] at which gear hash started at `start` has
+    its top CHUNK_AVG_BITS bits zero, or limit. Equivalent to the byte by byte loop
+        h = ((h << 1) + CHUNK_GEAR[data[i]]) & 0xffffffff; if h & mask == 0: return i + 1
+    but hashes of a whole block are computed with a few big integer operations: gear values are laid out in 64-bit lanes
+    and lane i accumulates gear[i - k] << k for k < 32 by shift-and-add doubling, without carrying into the next lane."""
+    overlap = 0 # bytes before block start only feeding hashes, their own hashes are checked in the previous block
+    block_start = start
+    while block_start < limit:
+        window_start = block_start - overlap
+        window = data[window_start:min(block_start + CHUNK_SCAN_BLOCK, limit)]
+        size = CHUNK_SCAN_BLOCK + overlap # windows are padded to one of two sizes so that constants can be reused
+        if size not in chunk_lane_constants:
+            mask = ((1 << CHUNK_AVG_BITS) - 1) << (32 - CHUNK_AVG_BITS)
+            chunk_lane_constants[size] = [int.from_bytes(lane.to_bytes(8, "little") * size, "little") for lane in (0xffffffff, 1 << 32, mask)]
+        ones, bit32s, masks = chunk_lane_constants[size]
+        lanes = bytearray(8 * size)
+        for i in range(4):
+            lanes[i:8 * len(window):8] = window.translate(CHUNK_GEAR_BYTES[i])
+        h = int.from_bytes(lanes, "little")
+        for shift in (1, 2, 4, 8, 16):
+            h += h << (65 * shift) # lane i += lane i-shift << shift
+        # adding 0xffffffff carries into bit 32 of a lane unless its masked bits are all zero
+        zero_lanes = (bit32s ^ (((h & masks) + ones) & bit32s)) >> (64 * overlap)
+        if zero_lanes != 0:
+            cut = window_start + overlap + ((zero_lanes & -zero_lanes).bit_length() - 33) // 64 + 1
+            if cut <= limit: return cut
+            #else
+            break # found in padding
+        #else
+        block_start += len(window) - overlap
+        overlap = CHUNK_HASH_WINDOW - 1
+    return limit
+
+def chunk_segment(image, start, end, store_dir):
+    """Split image[start:end] into content-defined chunks, store missing chunks and return [(sha256, size), ...]."""
+    chunks = []
+    with open(image, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    pos = 0
+    while pos < len(data):
+        cut = find_chunk_cut(data, pos + CHUNK_MIN_SIZE, min(pos + CHUNK_MAX_SIZE, len(data)))
+        chunk = data[pos:cut]
+        digest = hashlib.sha256(chunk).hexdigest()
+        chunk_path = os.path.join(store_dir, digest[:2], digest)
+        if not os.path.exists(chunk_path):
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            tmp_path = f"{chunk_path}.tmp-{os.getpid()}"
+            with open(tmp_path, "wb") as c:
+                c.write(chunk)
+            os.rename(tmp_path, chunk_path)
+        chunks.append((digest, len(chunk)))
+        pos = cut
+    return chunks
+
+@trace_phase("chunk index")
+def write_chunk_index(image, index_file=None):
+    """Store image into chunk store and write its chunk index (<image>.index by default)."""
+    if index_file is None:
+        index_file = image + ".index"
+    image_size = os.path.getsize(image)
+    image_mtime_ns = os.stat(image).st_mtime_ns
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get("size") == image_size and index.get("mtime_ns") == image_mtime_ns:
+            logging.info(f"Chunk index {index_file} is up-to-date, skipping.")
+            return index_file
+    #else
+    logging.info(f"Storing {image} into chunk store {chunk_store_dir}...")
+    start = time.monotonic()
+    segments = [(offset, min(offset + CHUNK_SEGMENT_SIZE, image_size)) for offset in range(0, image_size, CHUNK_SEGMENT_SIZE)]
+    chunks = []
+    os.makedirs(os.path.join(chunk_store_dir, "indexes"), exist_ok=True)
+    with open(os.path.join(chunk_store_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH) # chunks stored but not yet referenced by any index must survive prune_chunk_store() of others
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            for segment_chunks in executor.map(chunk_segment, *zip(*((image, s, e, chunk_store_dir) for s, e in segments))):
+                chunks += segment_chunks
+        with open(index_file, "w") as f:
+            json.dump({"image": os.path.basename(image), "size": image_size, "mtime_ns": image_mtime_ns, "chunks": chunks}, f)
+        # the store keeps its own copy of index to know which chunks are in use
+        with open(index_file, "rb") as f:
+            stored_index = os.path.join(chunk_store_dir, "indexes", hashlib.sha256(f.read()).hexdigest() + ".json")
+        shutil.copyfile(index_file, stored_index)
+    logging.info(f"Wrote chunk index {index_file}: {len(chunks)} chunks ({len(set(c[0] for c in chunks))} unique) in {time.monotonic() - start:.1f} seconds.")
+    prune_chunk_store(genpack_json.get("chunk_store_keep", DEFAULT_CHUNK_STORE_KEEP))
+    return index_file
+
+def prune_chunk_store(keep):
+    """Remove chunks which are not referenced by the `keep` most recently written chunk indexes."""
+    index_dir = os.path.join(chunk_store_dir, "indexes")
+    with open(os.path.join(chunk_store_dir, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.debug("Chunk store is being written by another genpack process, not pruning.")
+            return
+        #else
+        indexes = sorted((os.path.join(index_dir, f) for f in os.listdir(index_dir)), key=os.path.getmtime, reverse=True)
+        referenced = set()
+        for index in indexes[:keep]:
+            with open(index) as f:
+                referenced.update(chunk[0] for chunk in json.load(f)["chunks"])
+        for index in indexes[keep:]:
+            os.remove(index)
+        removed, removed_bytes = 0, 0
+        for prefix in os.listdir(chunk_store_dir):
+            prefix_dir = os.path.join(chunk_store_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir): continue
+            #else
+            for name in os.listdir(prefix_dir):
+                if name in referenced: continue
+                #else
+                chunk_path = os.path.join(prefix_dir, name)
+                removed_bytes += os.path.getsize(chunk_path)
+                os.remove(chunk_path) # including *.tmp-<pid> left by interrupted runs, nobody is writing now
+                removed += 1
+    if removed > 0:
+        logging.info(f"Removed {removed} unreferenced chunks ({removed_bytes / 1024 / 1024:.1f} MiB) from chunk store.")
+
+def delta(old_index_file, new_index_file, export_dir=None):
+    """Report chunks of new image missing from old image and optionally export them along with new index."""
+    with open(old_index_file) as f:
+        old_chunks = set(chunk[0] for chunk in json.load(f)["chunks"])
+    with open(new_index_file) as f:
+        new_index = json.load(f)
+    missing = {}
+    for digest, size in new_index["chunks"]:
+        if digest not in old_chunks: missing[digest] = size
+    missing_bytes = sum(missing.values())
+    print(f"{new_index['image']}: {len(new_index['chunks'])} chunks, {new_index['size']} bytes")
+    print(f"missing from {os.path.basename(old_index_file)}: {len(missing)} chunks, {missing_bytes} bytes "
+          f"({missing_bytes * 100 / new_index['size'] if new_index['size'] > 0 else 0:.1f}%)")
+    if export_dir is None: return missing
+    #else
+    for digest in missing:
+        chunk_path = os.path.join(chunk_store_dir, digest[:2], digest)
+        if not os.path.isfile(chunk_path):
+            raise FileNotFoundError(f"Chunk {digest} is not found in chunk store {chunk_store_dir}")
+        #else
+        os.makedirs(os.path.join(export_dir, digest[:2]), exist_ok=True)
+        shutil.copyfile(chunk_path, os.path.join(export_dir, digest[:2], digest))
+    shutil.copyfile(new_index_file, os.path.join(export_dir, os.path.basename(new_index_file)))
+    logging.info(f"Exported {len(missing)} chunks and {os.path.basename(new_index_file)} to {export_dir}")
+    return missing
 
 def get_latest_mtime(*args):
     latest = 0.0
@@ -1194,7 +3426,7 @@ def create_archive():
     if os.path.isdir("kernel"): targets.append("kernel")
     if os.path.isdir("overlay"): targets.append("overlay")
 
-    subprocess.run(["tar", "zcvf", archive_name] + targets, check=True)
+    run_command(["tar", "zcvf", archive_name] + targets, check=True)
 
     logging.info(f"Archive created: {archive_name}")
     return archive_name
@@ -1205,12 +3437,64 @@ if __name__ == "__main__":
     parser.add_argument("--overlay-override", default=None, help="Directory to override genpack-overlay")
     parser.add_argument("--independent-binpkgs", action="store_true", help="Use independent binpkgs, do not use shared one")
     parser.add_argument("--deep-depclean", action="store_true", help="Perform deep depclean, removing all non-runtime packages"  )
-    parser.add_argument("--compression", choices=["gzip", "xz", "lzo", "none"], default=None, help="Compression type for the final SquashFS image")
+    parser.add_argument("--format", choices=["squashfs", "erofs"], default=None, help="Filesystem format of the final image")
+    parser.add_argument("--compression", choices=sorted(set(SQUASHFS_COMPRESSION_LEVELS.keys()) | set(EROFS_COMPRESSION_LEVELS.keys())), default=None, help="Compression type for the final image")
+    parser.add_argument("--compression-level", type=int, default=None, help="Compression level for the final image")
+    parser.add_argument("--block-size", default=None, help="Block size (squashfs) or physical cluster size (erofs) of the final image (e.g. 128K, 1M)")
+    parser.add_argument("--processors", type=int, default=None, help="Number of processors mksquashfs or mkfs.erofs uses")
+    parser.add_argument("--benchmark", nargs="?", const="table", choices=["table", "json"], default=None, help="Compare compression profiles instead of creating the final image (pack only)")
+    parser.add_argument("--benchmark-jobs", type=int, default=1, help="Number of mksquashfs processes run in parallel by --benchmark (default 1; more is faster but skews wall times)")
+    parser.add_argument("--force-pack", action="store_true", help="Create the final image even if upper directory is unchanged")
+    parser.add_argument("--fingerprint-content", action="store_true", default=None, help="Hash file contents to detect changes in upper directory (slower, ignores mtime)")
+    parser.add_argument("--layered", action="store_true", help="Pack all variants as a shared base image plus per-variant delta images (pack only)")
+    parser.add_argument("--offline", action="store_true", help="Do not access network: use downloaded tarballs, genpack-overlay and mix-ins as they are, and run containers without network")
+    parser.add_argument("--lower-snapshots", type=int, default=None, help=f"Number of lower image snapshots kept for rollback, 0 disables snapshots (default: {DEFAULT_LOWER_SNAPSHOT_KEEP})")
+    parser.add_argument("--lower-snapshot-full-copy", action="store_true", help="Take full copies of lower image as snapshots where the filesystem does not support reflink")
+    parser.add_argument("--auto-rollback", action="store_true", default=None, help="Restore the snapshot taken before a lower phase when the phase fails")
+    parser.add_argument("--rollback", action="store_true", help="Restore lower image to its latest snapshot instead of building it (lower only)")
+    parser.add_argument("--ram-upper", nargs="?", const="auto", choices=["auto", "tmpfs", "zram"], default=None, help="Place upper directory on tmpfs or zram instead of upper image during upper and pack (default: auto)")
+    parser.add_argument("--ram-upper-persist", action="store_true", help="Copy upper directory on RAM into upper image after upper, for upper-bash")
+    parser.add_argument("--cpu-weight", help="CPUWeight of build containers (1-10000, default 100)")
+    parser.add_argument("--cpu-quota", help="CPUQuota of build containers (e.g. 400%%)")
+    parser.add_argument("--memory-high", help="MemoryHigh of build containers, above which they are throttled (e.g. 8G)")
+    parser.add_argument("--memory-max", help="MemoryMax of build containers, above which the OOM killer acts inside them (e.g. 12G)")
+    parser.add_argument("--io-weight", help="IOWeight of build containers (1-10000, default 100)")
+    parser.add_argument("--tmpfs-size", help="Size limit of /var/tmp tmpfs in lower containers (e.g. 16G)")
+    parser.add_argument("--repack", action="store_true", help=f"Repack the final image with fast compression ({WATCH_COMPRESSION} unless --compression is given) after each rebuild (watch only)")
+    parser.add_argument("--mixin-ttl", type=int, help=f"Do not fetch mix-ins fetched within this many seconds (default: {DEFAULT_MIXIN_TTL})")
+    parser.add_argument("--no-broker", action="store_true", help="Use sudo for each privileged operation instead of genpack-helper broker")
+    parser.add_argument("--timing", action="store_true", help="Record time, CPU and I/O of each phase and external command, write a Chrome trace and print a summary")
+    parser.add_argument("--size-profile", action="store_true", help="Record which build step created each file during upper, for size-report")
+    parser.add_argument("--top", type=int, default=20, help="Number of packages shown by size-report")
+    parser.add_argument("--chunk-store", action="store_true", default=None, help="Store the final image into chunk store and write its chunk index")
+    parser.add_argument("--export-dir", default=None, help="Directory to export missing chunks to (delta only)")
     parser.add_argument("--devel", action="store_true", help="Generate development image, if supported by genpack.json")
     parser.add_argument("--variant", default=None, help="Variant to use from genpack.json, if supported")
-    parser.add_argument("action", choices=["build", "lower", "bash", "upper", "upper-bash", "upper-clean", "pack", "archive"], nargs="?", default="build", help="Action to perform")
+    parser.add_argument("action", choices=["build", "lower", "bash", "upper", "upper-bash", "upper-clean", "pack", "trace", "size-report", "archive", "delta", "diff", "watch"], nargs="?", default="build", help="Action to perform")
+    parser.add_argument("args", nargs="*", help="Arguments for the action (delta: OLD_INDEX NEW_INDEX, diff: OLD_MANIFEST NEW_MANIFEST)")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    if args.layered and args.action != "pack":
+        parser.error("--layered is supported by pack only, build each variant first")
+
+    if args.timing:
+        enable_tracing()
+        # written on exit so that failed builds are traced as well
+        atexit.register(write_trace, os.path.join(work_dir, "build-trace.json"))
+
+    if args.action == "delta":
+        if len(args.args) != 2:
+            parser.error("delta requires OLD_INDEX and NEW_INDEX")
+        delta(args.args[0], args.args[1], args.export_dir)
+        exit(0)
+    elif args.action == "diff":
+        if len(args.args) != 2:
+            parser.error("diff requires OLD_MANIFEST and NEW_MANIFEST")
+        diff(args.args[0], args.args[1])
+        exit(0)
+
+    if not args.no_broker:
+        start_broker()
 
     genpack_json, genpack_json_time = load_genpack_json()
     if "name" not in genpack_json:
@@ -1243,9 +3527,24 @@ if __name__ == "__main__":
         exit(0)
 
     overlay_override = args.overlay_override
+    format_override = args.format
+    offline = args.offline
+    mixin_ttl = args.mixin_ttl
+    lower_snapshot_keep = args.lower_snapshots if args.lower_snapshots is not None else genpack_json.get("lower_snapshots", DEFAULT_LOWER_SNAPSHOT_KEEP)
+    lower_snapshot_full_copy = args.lower_snapshot_full_copy or genpack_json.get("lower_snapshot_full_copy", False)
+    auto_rollback = args.auto_rollback or genpack_json.get("lower_auto_rollback", False)
 
     independent_binpkgs = args.independent_binpkgs or genpack_json.get("independent_binpkgs", False)
     deep_depclean = args.deep_depclean
+    # before dispatching any action, lower, bash and trace run containers too
+    resources = genpack_json.get("resources", {})
+    for key in list(RESOURCE_PROPERTIES.keys()) + ["tmpfs_size"]:
+        value = getattr(args, key)
+        if value is None: continue
+        #else
+        resources[key] = value
+        for stage in ["lower", "upper", "pack"]:
+            resources.get(stage, {}).pop(key, None) # command line wins over stage-specific ones
 
     variant = Variant(args.variant or genpack_json.get("default_variant", None))
     if variant.name is not None:
@@ -1253,18 +3552,31 @@ if __name__ == "__main__":
         if variant.name not in available_variants:
             raise ValueError(f"Variant '{variant.name}' is not available in genpack.json. Available variants: {list(available_variants.keys())}")
 
-    download_mixins()
-
     if args.action == "bash":
         bash(variant)
         exit(0)
-    elif args.action == "upper-bash":
-        upper_bash(variant)
+    elif args.action == "trace":
+        trace_boot(variant)
+        exit(0)
+    elif args.action == "size-report":
+        size_report(variant, args.top)
+        exit(0)
+    elif args.action == "lower" and args.rollback:
+        rollback_lower_image(variant)
         exit(0)
     elif args.action == "upper-clean":
         raise ValueError("upper-clean is not implemented yet, use 'upper' and then remove upper directory manually.")
     #else
 
+    # only actions which build something fetch mix-ins from network, upper-bash uses those fetched last time
+    if args.action in ["build", "lower", "upper", "upper-bash", "watch"]:
+        download_mixins(fetch=not offline and args.action != "upper-bash")
+    logging.debug(f"Startup took {(time.monotonic() - startup_time) * 1000:.0f} ms")
+
+    if args.action == "upper-bash":
+        upper_bash(variant)
+        exit(0)
+
     if args.action in ["build", "lower"]:
         if os.path.exists(variant.lower_files):
             latest_mtime = get_latest_mtime(genpack_json_time, "savedconfig", "patches", "kernel", "overlay", mixin_root)
@@ -1274,7 +3586,35 @@ if __name__ == "__main__":
             elif args.action == "lower":
                 os.remove(variant.lower_files)
         lower(variant, args.devel)
+
+    ram_upper_mode = args.ram_upper or genpack_json.get("ram_upper", None)
+    if args.action in ["build", "upper", "watch"] and ram_upper_mode is not None:
+        start_ram_upper(variant, ram_upper_mode)
+        atexit.register(stop_ram_upper)
+
+    if args.action == "watch":
+        watch_until_interrupted(variant, args.repack, args.compression, args.ram_upper_persist or genpack_json.get("ram_upper_persist", False))
+        exit(0)
+
     if args.action in ["build", "upper"]:
-        upper(variant)
+        size_profile = args.size_profile or genpack_json.get("size_profile", False)
+        try:
+            upper(variant, size_profile)
+        except Exception:
+            if ram_upper is None or not ram_upper.is_full(): raise
+            #else
+            logging.warning(f"Upper directory exceeded {ram_upper.kind} size limit, retrying with {variant.upper_image}.")
+            stop_ram_upper()
+            upper(variant, size_profile)
+        # upper directory on RAM is lost at exit, so 'upper' alone always persists it
+        if ram_upper is not None and (args.action == "upper" or args.ram_upper_persist or genpack_json.get("ram_upper_persist", False)):
+            persist_ram_upper(variant)
+    if args.action == "pack" and args.layered:
+        pack_layered([Variant(name) for name in genpack_json.get("variants", {}).keys()],
+                     args.compression, args.compression_level, args.block_size, args.processors)
+        exit(0)
     if args.action in ["build", "pack"]:
-        pack(variant, args.compression)
+        outfile = pack(variant, args.compression, args.compression_level, args.block_size, args.processors, args.benchmark, args.benchmark_jobs,
+             args.force_pack, args.fingerprint_content, args.format)
+        if outfile is not None and (args.chunk_store or genpack_json.get("chunk_store", False)):
+            write_chunk_index(outfile)
@@ -0,0 +1,185 @@
+import sys,os,time,json,argparse,tempfile,tracemalloc,subprocess,platform,random,shutil
+
+sys.path.insert(0,"src")
+import genpack
+
+# Benchmarks for the parts of genpack whose cost grows with image size.
+# Runs without root or systemd-nspawn. Example:
+#   python3 test/benchmark.py --sizes 10000,100000,1000000 --json bench-$(git rev-parse --short HEAD).json
+#   python3 test/benchmark.py --compare bench-old.json
+
+TOP_DIRS = ["usr/lib", "usr/lib64", "usr/share", "usr/include", "usr/bin", "etc", "lib", "var/lib"]
+
+def synthetic_paths(n, seed=0):
+    """Generate n unique relative paths shaped like package contents (a few hundred files per directory, 3-7 levels deep)."""
+    rng = random.Random(seed)
+    paths = []
+    dir_index = 0
+    while len(paths) < n:
+        depth = rng.randint(1, 5)
+        directory = "/".join([rng.choice(TOP_DIRS)] + [f"d{dir_index}-{level}" for level in range(depth)])
+        dir_index += 1
+        for i in range(min(rng.randint(1, 300), n - len(paths))):
+            paths.append(f"{directory}/file{i}.{rng.choice(['so', 'py', 'h', 'conf', 'txt'])}")
+    rng.shuffle(paths) # list-pkg-files output is not sorted
+    return paths
+
+def synthetic_genpack_json(n, num_mixins, num_variants):
+    """Generate main genpack.json and mixin genpack.json dicts holding n package/USE entries in total."""
+    per_branch = max(1, n // (num_mixins + num_variants + 1))
+    def branch(prefix):
+        return {
+            "packages": [f"{prefix}/pkg{i}" for i in range(per_branch)],
+            "accept_keywords": {f"{prefix}/kw{i}": None for i in range(per_branch // 10)},
+            "use": {f"{prefix}/use{i}": "foo -bar" for i in range(per_branch // 4)},
+            "arch": {"x86_64|aarch64|riscv64": {"packages": [f"{prefix}/arch-pkg{i}" for i in range(per_branch // 10)]}},
+        }
+    mixins = [branch(f"mixin{m}") for m in range(num_mixins)]
+    main = branch("main")
+    main["variants"] = {f"variant{v}": branch(f"variant{v}") for v in range(num_variants)}
+    return main, mixins
+
+def bench_write_lower_files(n, workdir):
+    files = synthetic_paths(n)
+    lower_files = os.path.join(workdir, "lower.files")
+    return lambda: genpack.write_lower_files(lower_files, files, True)
+
+def bench_load_lower_files(n, workdir):
+    lower_files = os.path.join(workdir, "lower.files")
+    genpack.write_lower_files(lower_files, synthetic_paths(n), True)
+    return lambda: genpack.load_lower_files(lower_files)
+
+def bench_files_to_remove(n, workdir):
+    lower_files = os.path.join(workdir, "lower.files")
+    genpack.write_lower_files(lower_files, synthetic_paths(n), True)
+    # upper directory holds lower files plus 10% files created by build scripts
+    existing = genpack.load_lower_files(lower_files) | set(synthetic_paths(n // 10, seed=1))
+    def run():
+        files_to_preserve = genpack.load_lower_files(lower_files)
+        return genpack.get_files_to_remove(existing, files_to_preserve)
+    return run
+
+def bench_index_files_to_remove(n, workdir):
+    lower_index = os.path.join(workdir, "lower.files.idx")
+    genpack.FileIndex.write(lower_index, synthetic_paths(n))
+    with genpack.FileIndex(lower_index) as index:
+        existing = set(index) | set(synthetic_paths(n // 10, seed=1))
+    def run():
+        with genpack.FileIndex(lower_index) as index:
+            return genpack.get_files_to_remove(set(index.difference(sorted(existing, key=os.fsencode))), set())
+    return run
+
+def bench_get_latest_mtime(n, workdir):
+    root = os.path.join(workdir, "tree")
+    for path in synthetic_paths(n):
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+    return lambda: genpack.get_latest_mtime(root)
+
+def bench_merge_genpack_json(n, workdir):
+    main, mixins = synthetic_genpack_json(n, 20, 10)
+    def run():
+        merged = {}
+        for i, mixin in enumerate(mixins):
+            genpack.merge_genpack_json(merged, mixin, [f"mixin({i})"])
+        genpack.merge_genpack_json(merged, main, ["genpack.json"], variant="variant0")
+        return merged
+    return run
+
+# (name, setup, largest size run without --no-limit)
+BENCHMARKS = [
+    ("write_lower_files", bench_write_lower_files, None),
+    ("load_lower_files", bench_load_lower_files, None),
+    ("files_to_remove", bench_files_to_remove, None),
+    ("index_files_to_remove", bench_index_files_to_remove, None),
+    ("get_latest_mtime", bench_get_latest_mtime, None),
+    ("merge_genpack_json", bench_merge_genpack_json, 100000), # list merging is quadratic, 1M entries takes hours
+]
+
+def measure(setup, n, repeat):
+    workdir = tempfile.mkdtemp(prefix="genpack_bench_")
+    try:
+        run = setup(n, workdir)
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        # peak memory is measured in a separate run because tracemalloc slows down allocation heavily
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return min(times), peak
+    finally:
+        shutil.rmtree(workdir)
+
+# Local-only actions (bash, upper-bash, size-report, --help) should not pay for network modules.
+STARTUP_TARGET = 0.15
+
+def measure_startup(repeat):
+    """Time a fresh interpreter importing genpack, fastest of repeat runs."""
+    code = "import sys; sys.path.insert(0, 'src'); import genpack"
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", code])
+        times.append(time.perf_counter() - start)
+    modules = subprocess.check_output([sys.executable, "-c", code + "; print(' '.join(m for m in ('requests', 'json5') if m in sys.modules))"], text=True).split()
+    return min(times), modules
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD", "--", "src"], stderr=subprocess.DEVNULL).returncode != 0
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark genpack's Python-side hot paths")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma separated numbers of entries")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs, the fastest one is reported")
+    parser.add_argument("--only", help="Comma separated benchmark names to run")
+    parser.add_argument("--no-limit", action="store_true", help="Run every benchmark at every size even if it is known to take hours")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Results file of a previous run to compare against")
+    args = parser.parse_args()
+
+    genpack.arch = "x86_64"
+    sizes = [int(size) for size in args.sizes.split(",")]
+    only = args.only.split(",") if args.only else None
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {(result["name"], result["size"]): result for result in json.load(f)["results"]}
+
+    results = []
+    print(f"{'benchmark':<20} {'entries':>9} {'seconds':>9} {'peak MiB':>9}" + ("  vs baseline" if baseline else ""))
+    if only is None or "startup" in only:
+        seconds, modules = measure_startup(max(args.repeat, 5))
+        results.append({"name": "startup", "size": 0, "seconds": seconds, "peak_bytes": 0})
+        line = f"{'startup':<20} {'':>9} {seconds:>9.3f}  {'OK' if seconds <= STARTUP_TARGET else 'SLOW'} (target {STARTUP_TARGET:.3f})"
+        if modules: line += f", eagerly imports {', '.join(modules)}"
+        if ("startup", 0) in baseline:
+            line += f"  time x{seconds / baseline[('startup', 0)]['seconds']:.2f}"
+        print(line, flush=True)
+    for name, setup, max_size in BENCHMARKS:
+        if only is not None and name not in only: continue
+        for size in sizes:
+            if max_size is not None and size > max_size and not args.no_limit:
+                print(f"{name:<20} {size:>9}   skipped, use --no-limit to run")
+                continue
+            seconds, peak = measure(setup, size, args.repeat)
+            results.append({"name": name, "size": size, "seconds": seconds, "peak_bytes": peak})
+            line = f"{name:<20} {size:>9} {seconds:>9.3f} {peak / 1024 / 1024:>9.1f}"
+            if (name, size) in baseline:
+                line += f"  time x{seconds / baseline[(name, size)]['seconds']:.2f}, memory x{peak / max(baseline[(name, size)]['peak_bytes'], 1):.2f}"
+            print(line, flush=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"revision": git_revision(), "python": platform.python_version(), "machine": platform.machine(),
+                       "repeat": args.repeat, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
@@ -0,0 +1,26 @@
+import sys,os,tempfile
+
+sys.path.insert(0,"src")
+import genpack
+
+# pack_layered() writes exclude files under work directory and mksquashfs reads them in container where current directory is /mnt/outdir
+created_work_root = not os.path.exists(genpack.work_root)
+os.makedirs(genpack.work_dir, exist_ok=True)
+tmp_dir = tempfile.mkdtemp(prefix="genpack_layered_", dir=genpack.work_dir)
+try:
+    exclude_file = os.path.join(tmp_dir, "test-base.squashfs.exclude")
+    with open(exclude_file, "w") as f:
+        f.write("etc/hostname\n")
+    cmdline = genpack.layered_mksquashfs_cmdline("test-base.squashfs", exclude_file, ["-comp", "zstd"])
+    print(cmdline)
+    container_path = cmdline[cmdline.index("-ef") + 1]
+    assert container_path.startswith("/mnt/outdir/"), container_path
+    host_path = os.path.join(os.getcwd(), os.path.relpath(container_path, "/mnt/outdir"))
+    assert os.path.samefile(host_path, exclude_file), host_path
+    assert cmdline[2] == "/mnt/outdir/test-base.squashfs", cmdline
+finally:
+    os.remove(exclude_file)
+    os.rmdir(tmp_dir)
+    if created_work_root: os.removedirs(genpack.work_dir)
+
+print("Exclude file of layered pack is reachable in container: OK")
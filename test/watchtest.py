@@ -0,0 +1,55 @@
+import sys,os,subprocess,tempfile
+
+# Ctrl+C on 'genpack watch' reaches the whole foreground process group.
+# genpack-helper broker must survive it, so that RAM upper directory can still be persisted through it afterwards.
+# The scenario runs in its own session because it sends SIGINT to its process group.
+
+FAKE_HELPER = """
+import sys,struct
+# answers "ok" to every request like genpack-helper broker, but dies on SIGINT as an ordinary process
+while True:
+    header = sys.stdin.buffer.read(4)
+    if len(header) < 4: break
+    sys.stdin.buffer.read(struct.unpack("=I", header)[0])
+    sys.stdout.buffer.write(struct.pack("=I", 2) + b"ok")
+    sys.stdout.buffer.flush()
+"""
+
+SCENARIO = """
+import sys,os,signal,time
+sys.path.insert(0, "src")
+import genpack
+
+genpack.broker = genpack.Broker(sys.argv[1])
+genpack.broker.request("ping")
+genpack.ram_upper = object() # only its presence matters here
+persisted = []
+
+def watch(variant, repack, compression):
+    os.killpg(0, signal.SIGINT) # like Ctrl+C on terminal
+    time.sleep(10)
+
+def persist_ram_upper(variant):
+    assert signal.getsignal(signal.SIGINT) == signal.SIG_IGN, "SIGINT must be ignored while persisting"
+    genpack.broker.request("mount", "upper.img", "/mnt") # persisting needs broker to mount upper image
+    persisted.append(variant)
+
+genpack.watch = watch
+genpack.persist_ram_upper = persist_ram_upper
+genpack.watch_until_interrupted("test-variant", persist=True)
+assert persisted == ["test-variant"], persisted
+assert signal.getsignal(signal.SIGINT) == signal.default_int_handler
+genpack.broker.close()
+print("ok")
+"""
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    helper = os.path.join(temp_dir, "genpack-helper")
+    with open(helper, "w") as f:
+        f.write(f"#!{sys.executable}\n" + FAKE_HELPER)
+    os.chmod(helper, 0o755)
+    result = subprocess.run([sys.executable, "-c", SCENARIO, helper], start_new_session=True, capture_output=True, text=True, timeout=30)
+    print(result.stdout + result.stderr)
+    assert result.returncode == 0 and result.stdout.strip() == "ok", "persisting after Ctrl+C failed"
+
+print("Ctrl+C on watch persists upper directory through broker: OK")